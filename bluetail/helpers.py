@@ -1,12 +1,18 @@
+import csv
+import io
 import json
 import logging
 import os
-from copy import deepcopy
+from itertools import chain, islice
 
+import ijson
+from django.core.files import File
 from django.core.files.base import ContentFile
+from django.core.serializers.json import DjangoJSONEncoder
 from django.conf import settings
+from django.db import connection
 from django.db.models import Q
-from ocdskit.combine import merge
+from ocdskit.combine import merge, package_records, package_releases
 
 from bluetail import models
 from bluetail.models import FlagAttachment, Flag, BODSEntityStatement, BODSOwnershipStatement, BODSPersonStatement, \
@@ -218,6 +224,9 @@ class ContextHelperFunctions():
 
 
 class UpsertDataHelpers:
+    # Releases written per INSERT
+    release_chunk_size = 1000
+
     def upload_record_package(self, package_json, supplied_data=None):
         """
         Upload a record package
@@ -229,13 +238,13 @@ class UpsertDataHelpers:
             supplied_data.current_app = "bluetail"
             supplied_data.save()
 
-        package_data = deepcopy(package_json)
-        records = package_data.pop("records")
-        package, created = OCDSPackageDataJSON.objects.update_or_create(
-            supplied_data=supplied_data,
-            package_data=package_data
-        )
+        package = self.upsert_package_data(self.package_metadata(package_json), supplied_data)
+        self.upsert_records(package_json["records"], package)
 
+    def upsert_records(self, records, package):
+        """
+        Upsert records with the OCDSPackageDataJSON object of the package they came from
+        """
         for record in records:
             ocid = record.get("ocid")
             record_json, created = OCDSRecordJSON.objects.update_or_create(
@@ -247,19 +256,16 @@ class UpsertDataHelpers:
                 }
             )
 
-    def upload_release_package(self, package_json, supplied_data=None):
+    def package_metadata(self, package_json):
         """
-        Upload a release package
-            creates a SuppliedData object if not given
-            creates a OCDSPackageDataJSON object
+        Shallow copy of the package metadata, the releases and records are written as they are
         """
-        if not supplied_data:
-            supplied_data = FileSubmission()
-            supplied_data.current_app = "bluetail"
-            supplied_data.save()
+        return {key: value for key, value in package_json.items() if key not in ("releases", "records")}
 
-        package_data = deepcopy(package_json)
-        releases = package_data.pop("releases")
+    def upsert_package_data(self, package_data, supplied_data):
+        """
+        Update or create the one OCDSPackageDataJSON object of a submission
+        """
         package, created = OCDSPackageDataJSON.objects.update_or_create(
             supplied_data=supplied_data,
             defaults={
@@ -268,40 +274,73 @@ class UpsertDataHelpers:
 
             }
         )
+        return package
 
-        for release in releases:
-            ocid = release.get("ocid")
-            release_id = release.get("id")
-            release_json, created = OCDSReleaseJSON.objects.update_or_create(
-                ocid=ocid,
-                release_id=release_id,
-                defaults={
-                    "release_json": release,
-                    "package_data": package,
+    def upload_release_package(self, package_json, supplied_data=None):
+        """
+        Upload a release package
+            creates a SuppliedData object if not given
+            creates a OCDSPackageDataJSON object
+        """
+        self.upsert_releases(package_json["releases"], self.package_metadata(package_json), supplied_data=supplied_data)
 
-                }
-            )
+    def upsert_releases(self, releases, package_data, supplied_data=None):
+        """
+        Upsert an iterable of releases with the metadata of the package they came from
+            creates a SuppliedData object if not given
+            creates a OCDSPackageDataJSON object
 
-    def upsert_ocds_data(self, ocds_json_path_or_string, supplied_data=None, process_json=None):
+        The releases can be a generator, they are written in chunks of release_chunk_size as they are read.
         """
-        Takes a path to an OCDS Package or a string containing OCDS JSON data
-        Upserts all data to the Bluetail database
+        if not supplied_data:
+            supplied_data = FileSubmission()
+            supplied_data.current_app = "bluetail"
+            supplied_data.save()
+
+        package = self.upsert_package_data(package_data, supplied_data)
+
+        for chunk in BulkLoadHelpers().chunked(releases, self.release_chunk_size):
+            self.bulk_upsert_releases(chunk, package)
+
+    def bulk_upsert_releases(self, releases, package):
         """
-        if os.path.exists(ocds_json_path_or_string):
-            ocds_json = json.load(open(ocds_json_path_or_string))
-            filename = os.path.split(ocds_json_path_or_string)[1]
-        else:
-            ocds_json = json.loads(ocds_json_path_or_string)
-            filename = "package.json"
+        Insert or update a list of releases in one statement
 
-        if process_json:
-            ocds_json = process_json(ocds_json)
+        When a release appears more than once the last copy wins, as it did
+        when releases were written one at a time.
+        """
+        rows = {}
+        for release in releases:
+            rows[(release.get("ocid"), release.get("id"))] = release
+        if not rows:
+            return
+
+        params = []
+        for (ocid, release_id), release in rows.items():
+            params.extend([ocid, release_id, json.dumps(release, cls=DjangoJSONEncoder), package.pk])
+        values = ", ".join(["(%s, %s, %s::jsonb, %s)"] * len(rows))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {OCDSReleaseJSON._meta.db_table} (ocid, release_id, release_json, package_data_id)
+                VALUES {values}
+                ON CONFLICT (ocid, release_id) DO UPDATE
+                SET release_json = EXCLUDED.release_json,
+                    package_data_id = EXCLUDED.package_data_id
+                """,
+                params
+            )
 
+    def upsert_ocds_package(self, ocds_json, supplied_data=None, filename="package.json"):
+        """
+        Takes an already parsed OCDS record or release package
+        Upserts all data to the Bluetail database without copying it
+        """
         if not supplied_data:
             # Create FileSubmission entry
             supplied_data = FileSubmission()
             supplied_data.current_app = "bluetail"
-            supplied_data.original_file.save(filename, ContentFile(json.dumps(ocds_json)))
+            supplied_data.original_file.save(filename, ContentFile(json.dumps(ocds_json, cls=DjangoJSONEncoder)))
             supplied_data.save()
 
         if ocds_json.get("records"):
@@ -312,6 +351,120 @@ class UpsertDataHelpers:
             # We have a release package
             self.upload_release_package(ocds_json, supplied_data=supplied_data)
 
+    def ocds_item_type(self, item):
+        """
+        Whether a JSON value is a bare "release" or "record", or None for a package
+        """
+        if not isinstance(item, dict) or "ocid" not in item:
+            return None
+        if "releases" in item or "compiledRelease" in item:
+            return "record"
+        return "release"
+
+    def iter_ocds_packages(self, json_file, use_float=True):
+        """
+        Yield the packages of a file of one OCDS package, or of JSON Lines or
+        concatenated JSON of packages, releases or records, parsing it as it's read
+
+        :param json_file: File object opened in binary mode
+        :param use_float: Parse numbers with fractions as floats, rather than Decimals
+        :return: Iterator of (number, package), number being the number of the last JSON value in the package
+        """
+        return self.package_ocds_items(
+            BulkLoadHelpers().iter_json_items(json_file, use_float=use_float, with_numbers=True)
+        )
+
+    def package_ocds_items(self, numbered_items):
+        """
+        Wrap consecutive bare releases or records in synthetic packages of up to
+        release_chunk_size items, as ocdskit's package-releases does. Packages
+        are passed through.
+
+        :param numbered_items: Iterator of (number, JSON value)
+        :return: Iterator of (number, package), number being the number of the last value in the package
+        """
+        package_items = {"release": package_releases, "record": package_records}
+        pending_type = None
+        pending = []
+        pending_number = number = 0
+        for number, item in numbered_items:
+            item_type = self.ocds_item_type(item)
+            if pending and item_type != pending_type:
+                yield pending_number, package_items[pending_type](pending)
+                pending = []
+            if item_type is None:
+                yield number, item
+                continue
+            pending_type = item_type
+            pending_number = number
+            pending.append(item)
+            if len(pending) == self.release_chunk_size:
+                yield number, package_items[pending_type](pending)
+                pending = []
+        if pending:
+            yield number, package_items[pending_type](pending)
+
+    def upsert_ocds_data(self, ocds_json_path_or_string, supplied_data=None, process_json=None):
+        """
+        Takes a path to an OCDS Package or a string containing OCDS JSON data
+        Upserts all data to the Bluetail database
+
+        The data can also be JSON Lines or concatenated JSON of packages, releases
+        or records, such as bulk data feeds. Those are upserted a package at a
+        time as they are read, into one FileSubmission.
+
+        Use upsert_ocds_package when the data has already been parsed
+        """
+        if os.path.exists(ocds_json_path_or_string):
+            json_file = open(ocds_json_path_or_string, "rb")
+            filename = os.path.split(ocds_json_path_or_string)[1]
+        else:
+            json_file = io.BytesIO(ocds_json_path_or_string.encode("utf-8"))
+            filename = "package.json"
+
+        with json_file:
+            packages = self.iter_ocds_packages(json_file)
+            first_packages = list(islice(packages, 2))
+            if len(first_packages) == 1:
+                # One package, as before
+                number, ocds_json = first_packages[0]
+                if process_json:
+                    ocds_json = process_json(ocds_json)
+                self.upsert_ocds_package(ocds_json, supplied_data=supplied_data, filename=filename)
+                return
+
+            if not supplied_data:
+                supplied_data = FileSubmission()
+                supplied_data.current_app = "bluetail"
+                if isinstance(json_file, io.BytesIO):
+                    supplied_data.original_file.save(filename, ContentFile(ocds_json_path_or_string))
+                else:
+                    with open(ocds_json_path_or_string, "rb") as original_file:
+                        supplied_data.original_file.save(filename, File(original_file))
+                supplied_data.save()
+
+            # The submission has one OCDSPackageDataJSON object, with the metadata of
+            # the first package and the extensions of them all
+            package = None
+            extensions = []
+            for number, ocds_json in chain(first_packages, packages):
+                if process_json:
+                    ocds_json = process_json(ocds_json)
+                metadata = self.package_metadata(ocds_json)
+                if package is None:
+                    package = self.upsert_package_data(metadata, supplied_data)
+                    extensions = list(metadata.get("extensions") or [])
+                for extension in metadata.get("extensions") or []:
+                    if extension not in extensions:
+                        extensions.append(extension)
+                for chunk in BulkLoadHelpers().chunked(ocds_json.get("releases") or [], self.release_chunk_size):
+                    self.bulk_upsert_releases(chunk, package)
+                self.upsert_records(ocds_json.get("records") or [], package)
+                logger.info("Upserted %s to JSON value %s", filename, number)
+            if package is not None and extensions != (package.package_data.get("extensions") or []):
+                package.package_data = dict(package.package_data, extensions=extensions)
+                package.save(update_fields=["package_data"])
+
     def upsert_bods_data(self, bods_json_path_or_string, process_json=None):
         """
         Takes a path to an BODS JSON or a string containing BODS JSON statement array
@@ -337,3 +490,79 @@ class UpsertDataHelpers:
                     "statement_json": statement,
                 }
             )
+
+
+class BulkLoadHelpers:
+    """
+    Load large reference data files (authority types, PEP and sanctions lists)
+    in chunks with one INSERT per chunk
+    """
+    chunk_size = 5000
+
+    def iter_csv_rows(self, csv_path):
+        """
+        Yield each row of a CSV file as a dict, without reading the whole file
+        """
+        with open(csv_path, newline='', encoding='utf-8') as csv_file:
+            yield from csv.DictReader(csv_file)
+
+    def iter_json_items(self, json_file, prefix="", use_float=True, with_numbers=False):
+        """
+        Yield each value of a file of concatenated JSON values such as JSON Lines,
+        or with the prefix "item" each item of a top level array, parsing the file
+        with ijson as it's read
+
+        :param json_file: File object opened in binary mode
+        :param prefix: ijson prefix of the values to yield
+        :param use_float: Parse numbers with fractions as floats, rather than Decimals
+        :param with_numbers: Yield (number, item), numbering the values from 1,
+            which is the line of each value in JSON Lines
+        """
+        items = ijson.items(json_file, prefix, multiple_values=True, use_float=use_float)
+        if with_numbers:
+            return enumerate(items, 1)
+        return items
+
+    def chunked(self, iterable, size=None):
+        """
+        Yield lists of up to size items from an iterable
+        """
+        iterator = iter(iterable)
+        while True:
+            chunk = list(islice(iterator, size or self.chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def load(self, model, objects, unique_fields):
+        """
+        Insert model instances that don't already exist, relying on a unique
+        constraint on unique_fields to skip existing rows
+
+        :param model: Django model class
+        :param objects: iterable of unsaved model instances, can be a generator
+        :param unique_fields: fields that identify a row, used to drop duplicates in the input
+        :return: dict of created, existing and duplicate counts
+        """
+        seen = set()
+        processed = 0
+        duplicates = 0
+        count_before = model.objects.count()
+        for chunk in self.chunked(objects):
+            new_objects = []
+            for obj in chunk:
+                key = tuple(getattr(obj, field) for field in unique_fields)
+                if key in seen:
+                    duplicates += 1
+                    continue
+                seen.add(key)
+                new_objects.append(obj)
+            model.objects.bulk_create(new_objects, ignore_conflicts=True)
+            processed += len(new_objects)
+            logger.debug("Loaded %s %s objects", processed, model.__name__)
+        created = model.objects.count() - count_before
+        return {
+            "created": created,
+            "existing": processed - created,
+            "duplicates": duplicates,
+        }
@@ -134,7 +134,7 @@ class Command(BaseCommand):
 
         for root, dirs, files in os.walk(ocds_path):
             for f in files:
-                if not f.endswith(".json"):
+                if not f.endswith((".json", ".jsonl")):
                     continue
                 f_path = os.path.join(root, f)
                 try:
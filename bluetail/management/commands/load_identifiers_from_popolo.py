@@ -1,7 +1,6 @@
-import json
-
 from django.core.management import BaseCommand
 
+from bluetail.helpers import BulkLoadHelpers
 from bluetail.models import Flag, ExternalPerson
 
 
@@ -22,32 +21,24 @@ class Command(BaseCommand):
                 "Couldn't find flag with flag_name={}".format(flag_name))
             return
 
-        with open(file_name) as popolo_json:
-            data = json.load(popolo_json)
-            for person in data:
-                identifiers = person.get('identifiers')
-                if not identifiers:
-                    continue
-
-                for identifier in identifiers:
-                    external_person, created = ExternalPerson.objects.get_or_create(
-                        name=person['full_name'],
-                        scheme=identifier['scheme'],
-                        identifier=identifier['identifier'],
-                        flag=flag
-                    )
-                    if created:
-                        self.stdout.write(self.style.SUCCESS(
-                            "{}:{} -> {}\n".format(
-                                external_person.scheme,
-                                external_person.identifier,
-                                external_person.flag.flag_name
-                            )
-                        ))
-                    else:
-                        self.stdout.write(self.style.WARNING(
-                            "Existing record found for {}:{}".format(
-                                identifier['scheme'],
-                                identifier['identifier']
-                            )
-                        ))
+        bulk_load = BulkLoadHelpers()
+        with open(file_name, "rb") as popolo_json:
+            external_people = (
+                ExternalPerson(
+                    name=person['full_name'],
+                    scheme=identifier['scheme'],
+                    identifier=identifier['identifier'],
+                    flag=flag
+                )
+                for person in bulk_load.iter_json_items(popolo_json, prefix="item")
+                for identifier in person.get('identifiers') or []
+            )
+            counts = bulk_load.load(ExternalPerson, external_people, ['name', 'scheme', 'identifier', 'flag_id'])
+
+        self.stdout.write(self.style.SUCCESS(
+            "Created {} ExternalPerson records for {}".format(counts['created'], flag.flag_name)
+        ))
+        if counts['existing'] or counts['duplicates']:
+            self.stdout.write(self.style.WARNING(
+                "Skipped {} existing and {} duplicate records".format(counts['existing'], counts['duplicates'])
+            ))
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.16 on 2020-09-14 10:12
+
+import django.contrib.postgres.fields.jsonb
+import django.core.serializers.json
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bluetail', '0007_ocdsreleasejson'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ocdspackagedatajson',
+            name='package_data',
+            field=django.contrib.postgres.fields.jsonb.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder, null=True),
+        ),
+        migrations.AlterField(
+            model_name='ocdsrecordjson',
+            name='record_json',
+            field=django.contrib.postgres.fields.jsonb.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder),
+        ),
+        migrations.AlterField(
+            model_name='ocdsreleasejson',
+            name='release_json',
+            field=django.contrib.postgres.fields.jsonb.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.contrib.postgres.fields import JSONField
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 from django_pgviews import view as pgviews
 
@@ -10,7 +11,7 @@ class OCDSPackageDataJSON(models.Model):
     """
     Model to store OCDS JSON package data.
     """
-    package_data = JSONField(null=True)
+    package_data = JSONField(null=True, encoder=DjangoJSONEncoder)
     supplied_data = models.ForeignKey(FileSubmission, on_delete=None, null=True)
 
     class Meta:
@@ -64,7 +65,7 @@ class OCDSRecordJSON(models.Model):
     Model to store OCDS JSON records.
     """
     ocid = models.TextField(primary_key=True)
-    record_json = JSONField()
+    record_json = JSONField(encoder=DjangoJSONEncoder)
     package_data = models.ForeignKey(OCDSPackageDataJSON, on_delete=None, null=True)
 
     class Meta:
@@ -78,7 +79,7 @@ class OCDSReleaseJSON(models.Model):
     """
     ocid = models.TextField()
     release_id = models.TextField()
-    release_json = JSONField()
+    release_json = JSONField(encoder=DjangoJSONEncoder)
     package_data = models.ForeignKey(OCDSPackageDataJSON, on_delete=None, null=True)
 
     class Meta:
@@ -1,11 +1,13 @@
 import csv
+import io
+import json
 import os
 
 from django.conf import settings
 from django.test import TestCase
 
 from bluetail import models
-from bluetail.helpers import FlagHelperFunctions, UpsertDataHelpers
+from bluetail.helpers import FlagHelperFunctions, UpsertDataHelpers, BulkLoadHelpers
 from bluetail.models import BODSPersonStatement
 from bluetail.tests.fixtures import insert_flags, insert_flag_attachments
 
@@ -81,3 +83,87 @@ class TestFlagHelperFunctions(TestCase):
         flags = self.flag_helper.get_flags_for_bods_identifier(identifier)
         assert not any(flag.flag_name == "person_in_multiple_applications_to_tender" for flag in flags)
         assert any(flag.flag_name == "person_id_matches_cabinet_minister" for flag in flags)
+
+
+class TestBulkLoadHelpers(TestCase):
+    bulk_load = BulkLoadHelpers()
+
+    def setUp(self):
+        insert_flags()
+
+    def test_iter_json_items(self):
+        items = [{"full_name": "A"}, {"full_name": "B"}, 3]
+        json_array = io.BytesIO(b'[{"full_name": "A"}, {"full_name": "B"}, 3]')
+        self.assertEqual(list(self.bulk_load.iter_json_items(json_array, prefix="item")), items)
+        json_lines = io.BytesIO(b'{"full_name": "A"}\n{"full_name": "B"}\n3\n')
+        self.assertEqual(list(self.bulk_load.iter_json_items(json_lines)), items)
+        concatenated = io.BytesIO(b'{"full_name": "A"}\n\n{"full_name":\n "B"}\n3\n')
+        self.assertEqual(list(self.bulk_load.iter_json_items(concatenated, with_numbers=True)),
+                         [(1, items[0]), (2, items[1]), (3, items[2])])
+
+    def test_load_skips_existing_and_duplicate_rows(self):
+        flag = models.Flag.objects.get(flag_name="person_id_matches_cabinet_minister")
+        models.ExternalPerson.objects.create(name="A", scheme="GB-X", identifier="1", flag=flag)
+
+        people = [
+            models.ExternalPerson(name="A", scheme="GB-X", identifier="1", flag=flag),
+            models.ExternalPerson(name="B", scheme="GB-X", identifier="2", flag=flag),
+            models.ExternalPerson(name="B", scheme="GB-X", identifier="2", flag=flag),
+            models.ExternalPerson(name="C", scheme="GB-X", identifier="3", flag=flag),
+        ]
+        bulk_load = BulkLoadHelpers()
+        bulk_load.chunk_size = 2
+        counts = bulk_load.load(models.ExternalPerson, iter(people), ['name', 'scheme', 'identifier', 'flag_id'])
+
+        self.assertEqual(counts, {"created": 2, "existing": 1, "duplicates": 1})
+        self.assertEqual(models.ExternalPerson.objects.count(), 3)
+
+
+class TestUpsertDataHelpers(TestCase):
+    upsert_helper = UpsertDataHelpers()
+
+    def test_iter_ocds_packages(self):
+        json_lines = io.BytesIO(
+            b'{"ocid": "ocds-1", "id": "1"}\n'
+            b'{"ocid": "ocds-1", "id": "2"}\n'
+            b'{"uri": "a", "releases": [{"ocid": "ocds-2", "id": "1"}]}\n'
+            b'{"ocid": "ocds-3", "releases": [], "compiledRelease": {"ocid": "ocds-3"}}\n'
+        )
+        packages = list(self.upsert_helper.iter_ocds_packages(json_lines))
+
+        self.assertEqual([number for number, package in packages], [2, 3, 4])
+        self.assertEqual([release["id"] for release in packages[0][1]["releases"]], ["1", "2"])
+        self.assertEqual(packages[1][1]["uri"], "a")
+        self.assertEqual(packages[2][1]["records"][0]["ocid"], "ocds-3")
+
+        # A pretty printed package is one value
+        concatenated = io.BytesIO((
+            '{"ocid": "ocds-1", "id": "1"}\n'
+            + json.dumps({"uri": "a", "releases": [{"ocid": "ocds-2", "id": "1", "value": 1.5}]}, indent=2)
+            + '\n{"ocid": "ocds-1", "id": "2"}\n'
+        ).encode())
+        packages = list(self.upsert_helper.iter_ocds_packages(concatenated))
+        self.assertEqual([number for number, package in packages], [1, 2, 3])
+        self.assertEqual(packages[1][1]["releases"][0]["value"], 1.5)
+
+    def test_upsert_ocds_data_json_lines(self):
+        json_lines = "\n".join(json.dumps({"ocid": "ocds-1", "id": str(i), "date": "2020-01-01T00:00:00Z"})
+                               for i in range(5))
+        upsert_helper = UpsertDataHelpers()
+        upsert_helper.release_chunk_size = 2
+        upsert_helper.upsert_ocds_data(json_lines)
+
+        self.assertEqual(models.OCDSReleaseJSON.objects.filter(ocid="ocds-1").count(), 5)
+        self.assertEqual(models.OCDSPackageDataJSON.objects.count(), 1)
+
+    def test_upsert_ocds_data_concatenated_packages(self):
+        packages = [
+            {"uri": "a", "extensions": ["lots"], "records": [{"ocid": "ocds-1", "releases": []}]},
+            {"uri": "b", "extensions": ["lots", "bids"], "records": [{"ocid": "ocds-2", "releases": []}]},
+        ]
+        self.upsert_helper.upsert_ocds_data("\n".join(json.dumps(package) for package in packages))
+
+        package = models.OCDSPackageDataJSON.objects.get()
+        self.assertEqual(package.package_data["uri"], "a")
+        self.assertEqual(package.package_data["extensions"], ["lots", "bids"])
+        self.assertEqual(models.OCDSRecordJSON.objects.filter(package_data=package).count(), 2)
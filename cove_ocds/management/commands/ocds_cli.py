@@ -7,6 +7,8 @@ from django.conf import settings
 from django.core.management.base import CommandError
 from libcoveocds.api import APIException, ocds_json_output
 
+from bluetail.helpers import UpsertDataHelpers
+
 
 class Command(CoveBaseCommand):
     help = "Run Command Line version of Cove OCDS"
@@ -24,6 +26,13 @@ class Command(CoveBaseCommand):
             action="store_true",
             help="Convert data from nested (json) to flat format (spreadsheet) or vice versa",
         )
+        parser.add_argument(
+            "--json-lines",
+            "-l",
+            action="store_true",
+            help="Validate JSON Lines or concatenated JSON of packages, releases or records "
+                 "a package at a time, writing results.jsonl",
+        )
         super(Command, self).add_arguments(parser)
 
     def handle(self, file, *args, **options):
@@ -40,6 +49,12 @@ class Command(CoveBaseCommand):
                 )
             )
 
+        if options.get("json_lines"):
+            if convert:
+                raise CommandError("--convert can't be used with --json-lines")
+            self.handle_json_lines(file, schema_version)
+            return
+
         try:
             result = ocds_json_output(
                 self.output_dir, file, schema_version, convert, cache_schema=True
@@ -50,3 +65,27 @@ class Command(CoveBaseCommand):
 
         with open(os.path.join(self.output_dir, "results.json"), "w+") as result_file:
             json.dump(result, result_file, indent=2, sort_keys=True, cls=SetEncoder)
+
+    def handle_json_lines(self, file, schema_version):
+        """
+        Validate each package as it's read, bare releases and records being
+        wrapped in packages, and write a line of results for each
+        """
+        results_path = os.path.join(self.output_dir, "results.jsonl")
+        with open(file, "rb") as json_file, open(results_path, "w+") as results_file:
+            # Packages are numbered by their last JSON value, which is its line in JSON Lines
+            for line, package in UpsertDataHelpers().iter_ocds_packages(json_file):
+                try:
+                    result = ocds_json_output(
+                        self.output_dir, file, schema_version, False, cache_schema=True, file_type="json",
+                        json_data=package
+                    )
+                except APIException as e:
+                    self.stdout.write("Line {}: {}".format(line, e))
+                    sys.exit(1)
+
+                result["line"] = line
+                results_file.write(json.dumps(result, sort_keys=True, cls=SetEncoder) + "\n")
+                self.stdout.write(
+                    "Line {}: {} validation errors".format(line, len(result.get("validation_errors", [])))
+                )
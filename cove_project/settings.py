@@ -44,6 +44,32 @@ if STORE_OCDS_IN_S3:
     AWS_STORAGE_BUCKET_NAME = os.getenv('AWS_STORAGE_BUCKET_NAME', 'spendnetwork-silvereye')
     AWS_LOCATION = os.getenv('AWS_LOCATION', 'media')
     AWS_DEFAULT_ACL = None
+    # Spool S3 downloads larger than this many bytes to disk rather than memory
+    AWS_S3_MAX_MEMORY_SIZE = int(os.getenv('AWS_S3_MAX_MEMORY_SIZE', 8 * 1024 * 1024))
+
+# Local disk cache of submission files stored in S3, see silvereye.storage.TieredStorage
+S3_CACHE_INDEX_PATH = os.getenv('S3_CACHE_INDEX_PATH', os.path.join(MEDIA_ROOT, ".s3_cache_index.sqlite3"))
+S3_CACHE_MAX_SIZE = int(os.getenv('S3_CACHE_MAX_SIZE', 5 * 1024 * 1024 * 1024))
+S3_CACHE_MAX_AGE = int(os.getenv('S3_CACHE_MAX_AGE', 30 * 24 * 60 * 60))
+# Submissions are uploaded to S3 in the background by the upload_to_s3 command
+S3_UPLOAD_RETRY_DELAY = int(os.getenv('S3_UPLOAD_RETRY_DELAY', 60))
+S3_UPLOAD_MAX_ATTEMPTS = int(os.getenv('S3_UPLOAD_MAX_ATTEMPTS', 10))
+# Rebuilding the database from the S3 bucket with get_supplied_data_from_S3
+S3_BACKFILL_WORKERS = int(os.getenv('S3_BACKFILL_WORKERS', 8))
+S3_BACKFILL_CHECKPOINT_PATH = os.getenv('S3_BACKFILL_CHECKPOINT_PATH',
+                                        os.path.join(MEDIA_ROOT, ".s3_backfill_checkpoint"))
+
+# Reading the files of a zip upload in parallel, see silvereye.lib.inputs
+UPLOAD_ARCHIVE_WORKERS = int(os.getenv('UPLOAD_ARCHIVE_WORKERS', 4))
+
+# Downloading the Contracts Finder daily CSVs in get_cf_data
+CONTRACTS_FINDER_HARVESTER_URL = os.getenv('CONTRACTS_FINDER_HARVESTER_URL',
+                                           'https://www.contractsfinder.service.gov.uk/Harvester/Notices/Data/CSV')
+CONTRACTS_FINDER_HARVESTER_WORKERS = int(os.getenv('CONTRACTS_FINDER_HARVESTER_WORKERS', 8))
+CONTRACTS_FINDER_HARVESTER_RETRIES = int(os.getenv('CONTRACTS_FINDER_HARVESTER_RETRIES', 5))
+CONTRACTS_FINDER_HARVESTER_TIMEOUT = int(os.getenv('CONTRACTS_FINDER_HARVESTER_TIMEOUT', 60))
+# Days before today that Contracts Finder may still change, older days are only downloaded once
+CONTRACTS_FINDER_MUTABLE_DAYS = int(os.getenv('CONTRACTS_FINDER_MUTABLE_DAYS', 2))
 
 # Heroku doesn't have git support when deploying
 DEALER_TYPE = 'null'
@@ -313,4 +339,19 @@ INTERNAL_IPS = [
 ]
 
 # Silvereye
-CSV_MAPPINGS_PATH = os.path.join(BASE_DIR, "silvereye", "data", "csv_mappings", "release_mappings.csv")
\ No newline at end of file
+CSV_MAPPINGS_PATH = os.path.join(BASE_DIR, "silvereye", "data", "csv_mappings", "release_mappings.csv")
+
+# Seconds a queued publisher metrics update can wait to be batched with later
+# submissions before it is refreshed. Run `update_publisher_metrics --queued`
+# periodically when this is more than 0.
+PUBLISHER_METRICS_MAX_STALENESS = int(os.getenv('PUBLISHER_METRICS_MAX_STALENESS', 0))
+
+# Cached publisher metrics are keyed by a generation counter kept in the
+# database, so a per-process cache such as the default locmem one still sees
+# refreshes made by other processes (get_cf_data, update_publisher_metrics).
+CACHES = {
+    'default': env.cache(default='locmemcache://'),
+}
+# Safety expiry in seconds for cached publisher metrics. Cached values are
+# also discarded whenever the metrics are refreshed.
+PUBLISHER_METRICS_CACHE_TIMEOUT = int(os.getenv('PUBLISHER_METRICS_CACHE_TIMEOUT', 60 * 60))
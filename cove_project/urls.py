@@ -21,6 +21,7 @@ urlpatterns = [
         },
         name='index'),
     url(r"^review/", include(urlpatterns_core)),
+    url(r"^data/(.+)/flattened\.(xlsx|zip)$", views_cove_ocds.explore_ocds_flattened, name="explore_flattened"),
     url(r"^data/(.+)$", views_cove_ocds.explore_ocds, name="explore"),
     path(r'', include('bluetail.urls')),
     path('publisher-hub/', include('silvereye.urls')),
@@ -1,6 +1,8 @@
 from django.contrib import admin
 
-from silvereye.models import Publisher, PublisherMetrics, FileSubmission, PublisherMonthlyCounts
+from silvereye.helpers import retry_failed_s3_uploads
+from silvereye.models import Publisher, PublisherMetrics, FileSubmission, PublisherMonthlyCounts, PublisherCountsRollup, \
+    S3UploadOutbox
 
 
 class PublisherAdmin(admin.ModelAdmin):
@@ -41,6 +43,15 @@ class PublisherMonthlyCountsAdmin(admin.ModelAdmin):
 admin.site.register(PublisherMonthlyCounts, PublisherMonthlyCountsAdmin)
 
 
+class PublisherCountsRollupAdmin(admin.ModelAdmin):
+    list_display = [field.name for field in PublisherCountsRollup._meta.get_fields()]
+    readonly_fields = [field.name for field in PublisherCountsRollup._meta.get_fields()]
+    list_filter = ['grain']
+
+
+admin.site.register(PublisherCountsRollup, PublisherCountsRollupAdmin)
+
+
 class FileSubmissionAdmin(admin.ModelAdmin):
     list_display = ['id',
                     'source_url',
@@ -57,3 +68,17 @@ class FileSubmissionAdmin(admin.ModelAdmin):
 
 
 admin.site.register(FileSubmission, FileSubmissionAdmin)
+
+
+class S3UploadOutboxAdmin(admin.ModelAdmin):
+    list_display = ['name', 'created', 'attempts', 'next_attempt_at', 'failed', 'last_error']
+    list_filter = ['failed']
+    actions = ['retry_uploads']
+
+    def retry_uploads(self, request, queryset):
+        count = retry_failed_s3_uploads(queryset)
+        self.message_user(request, f"Queued {count} failed uploads to be retried")
+    retry_uploads.short_description = "Retry failed uploads"
+
+
+admin.site.register(S3UploadOutbox, S3UploadOutboxAdmin)
@@ -0,0 +1,228 @@
+"""
+Download the daily Contracts Finder notices CSVs
+https://www.contractsfinder.service.gov.uk/apidocumentation/Notices/1/GET-Harvester-Notices-Data-CSV
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def write_atomic(path, write):
+    """
+    Write a file through a temporary file in the same directory, so readers
+    never see a partly written file
+
+    :param path: Path of the file to write
+    :param write: Function taking the open binary temporary file
+    """
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            write(temp_file)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+class ContractsFinderHarvester():
+    """
+    Keep a directory of Contracts Finder daily CSVs up to date
+
+    Days are downloaded by a pool of threads sharing one HTTP connection pool,
+    retrying connection errors and server errors with exponential backoff.
+    A manifest next to the CSVs records the checksum, ETag and Last-Modified of
+    every day. Days older than mutable_days are treated as final and aren't
+    requested again while their file matches its checksum. Recent days are
+    requested conditionally, so unchanged days aren't downloaded again.
+    """
+    manifest_name = "manifest.json"
+    # Bytes read from the response at a time
+    chunk_size = 64 * 1024
+
+    def __init__(self, source_dir, base_url=None, workers=None, retries=None, timeout=None,
+                 mutable_days=None, today=None):
+        self.source_dir = source_dir
+        self.base_url = (base_url or settings.CONTRACTS_FINDER_HARVESTER_URL).rstrip("/")
+        self.workers = workers or settings.CONTRACTS_FINDER_HARVESTER_WORKERS
+        self.timeout = timeout or settings.CONTRACTS_FINDER_HARVESTER_TIMEOUT
+        self.mutable_days = settings.CONTRACTS_FINDER_MUTABLE_DAYS if mutable_days is None else mutable_days
+        self.today = today or date.today()
+        retries = settings.CONTRACTS_FINDER_HARVESTER_RETRIES if retries is None else retries
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.workers,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=1,
+                status_forcelist=[429, 500, 502, 503, 504],
+                raise_on_status=False,
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        os.makedirs(self.source_dir, exist_ok=True)
+        self.manifest = self.read_manifest()
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.source_dir, self.manifest_name)
+
+    def read_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path) as manifest_file:
+            return json.load(manifest_file)
+
+    def write_manifest(self):
+        write_atomic(
+            self.manifest_path,
+            lambda manifest_file: manifest_file.write(json.dumps(self.manifest, indent=2, sort_keys=True).encode())
+        )
+
+    def file_name(self, day):
+        return day.strftime("%Y%m%d") + ".csv"
+
+    def url(self, day):
+        return f"{self.base_url}/{day.year}/{day.month:02}/{day.day:02}"
+
+    def is_final(self, day):
+        return day < self.today - timedelta(days=self.mutable_days)
+
+    def is_cached(self, day):
+        """
+        Whether a final day has already been downloaded and its file is intact
+        """
+        entry = self.manifest.get(self.file_name(day))
+        path = os.path.join(self.source_dir, self.file_name(day))
+        if not entry or not os.path.exists(path):
+            return False
+        if file_sha256(path) != entry["sha256"]:
+            logger.warning("Checksum mismatch for %s, downloading it again", path)
+            return False
+        return True
+
+    def fetch(self, day):
+        """
+        Download one day if it changed, run in a worker thread
+
+        :return: Manifest entry for the day, or None if it hasn't changed
+        """
+        file_name = self.file_name(day)
+        path = os.path.join(self.source_dir, file_name)
+        url = self.url(day)
+        headers = {}
+        entry = self.manifest.get(file_name)
+        if entry and os.path.exists(path):
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as response:
+            if response.status_code == 304:
+                logger.debug("Not modified: %s", url)
+                return None
+            response.raise_for_status()
+            logger.info("Downloading URL: %s", url)
+            sha256 = hashlib.sha256()
+
+            def write(temp_file):
+                for chunk in response.iter_content(self.chunk_size):
+                    sha256.update(chunk)
+                    temp_file.write(chunk)
+
+            write_atomic(path, write)
+            stat = os.stat(path)
+            return {
+                "url": url,
+                "sha256": sha256.hexdigest(),
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "fetched": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            }
+
+    def checksums(self, days):
+        """
+        SHA-256 of the days' files, taken from the manifest while a file's size and
+        modification time match its entry. Files that changed or aren't in the
+        manifest, e.g. ones copied in by hand, are hashed and their entries updated.
+
+        :param days: Days to return checksums for
+        :return: dict of day to SHA-256, for the days that have a file
+        """
+        hashes = {}
+        changed = False
+        for day in days:
+            file_name = self.file_name(day)
+            path = os.path.join(self.source_dir, file_name)
+            if not os.path.exists(path):
+                continue
+            stat = os.stat(path)
+            entry = self.manifest.get(file_name, {})
+            if (entry.get("size"), entry.get("mtime_ns")) != (stat.st_size, stat.st_mtime_ns):
+                entry = dict(entry, sha256=file_sha256(path), size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+                self.manifest[file_name] = entry
+                changed = True
+            hashes[day] = entry["sha256"]
+        if changed:
+            self.write_manifest()
+        return hashes
+
+    def harvest(self, start_date, end_date):
+        """
+        Download the days from start_date to end_date inclusive that aren't up to date
+
+        :return: dict of downloaded, unchanged, cached and failed counts
+        """
+        days = [start_date + timedelta(days=n) for n in range((end_date - start_date).days + 1)]
+        counts = {"downloaded": 0, "unchanged": 0, "cached": 0, "failed": 0}
+        to_fetch = []
+        for day in days:
+            if self.is_final(day) and self.is_cached(day):
+                counts["cached"] += 1
+            else:
+                to_fetch.append(day)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.fetch, day): day for day in to_fetch}
+            for future in as_completed(futures):
+                day = futures[future]
+                try:
+                    entry = future.result()
+                except requests.RequestException:
+                    logger.exception("Error with URL: %s", self.url(day))
+                    counts["failed"] += 1
+                    continue
+                if entry is None:
+                    counts["unchanged"] += 1
+                    continue
+                self.manifest[self.file_name(day)] = entry
+                self.write_manifest()
+                counts["downloaded"] += 1
+        return counts
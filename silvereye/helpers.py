@@ -1,5 +1,12 @@
+import hashlib
 import json
-from datetime import datetime, timezone
+from array import array
+from collections import deque
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 import logging
 import os
@@ -7,36 +14,54 @@ import re
 from urllib.parse import urlparse, parse_qsl, urlencode
 
 from django.conf import settings
-from django.core.files.base import ContentFile
-from django.core.files.storage import get_storage_class
+from django.core.cache import cache
 import requests
-from django.db import connections
-from django.db.models import Sum, Avg
+from django.db import connections, transaction
+from django.db.models import Avg, Count, OuterRef, Q, Subquery, Sum
 from django.db.models.functions import Coalesce
+from django.utils import timezone
 from django.utils.safestring import mark_safe
 
 import silvereye
-from silvereye.lib.converters import convert_csv
-from silvereye.models import FileSubmission, FieldCoverage
+from bluetail.helpers import UpsertDataHelpers
+from silvereye.lib.converters import convert_csv, unflatten_csv_text
+from silvereye.storage import get_tiered_storage
+from silvereye.models import AuthorityType, FileSubmission, FieldCoverage, Publisher, PublisherCountsRollup, \
+    PublisherMonthlyCounts, PublisherMonthlyCountsQueue, S3UploadOutbox
 
 logger = logging.getLogger(__name__)
 
 SILVEREYE_DIR = silvereye.__path__[0]
+# Arbitrary key for the Postgres advisory lock around publisher metrics refreshes
+PUBLISHER_METRICS_LOCK_ID = 5170601
+# Postgres sequence holding the current generation of cached MetricHelpers values
+METRICS_CACHE_GENERATION_SEQUENCE = "silvereye_metrics_generation"
+
+
+def s3_submission_created(filename):
+    """
+    Extract the created date of a submission from its S3 filename, eg. 20200101T120000Z.json
+
+    :return: datetime or None if the filename isn't a date
+    """
+    filename_root = os.path.splitext(filename)[0]
+    try:
+        return datetime.strptime(filename_root, "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+    except ValueError:
+        logger.debug("Couldn't extract datetime from filename")
 
 
 class S3_helpers():
     def retrieve_data_from_S3(self, id):
         logger.info("Attempting to download file for SuppliedData from S3: %s", id)
 
-        upsert_helper = UpsertDataHelpers()
-        s3_storage = get_storage_class(settings.S3_FILE_STORAGE)()
+        s3_storage = get_tiered_storage().remote_storage
 
         directories, filenames = s3_storage.listdir(name=id)
 
         for filename in filenames:
             original_file_path = os.path.join(id, filename)
             logger.info(f"Downloading {original_file_path}")
-            filename_root = os.path.splitext(filename)[0]
 
             # Create FileSubmission entry
             supplied_data, created = FileSubmission.objects.update_or_create(
@@ -48,47 +73,210 @@ class S3_helpers():
             )
 
             # Extract created date from filename if possible
-            try:
-                filename_datetime = datetime.strptime(filename_root, "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+            filename_datetime = s3_submission_created(filename)
+            if filename_datetime:
                 supplied_data.created = filename_datetime
-            except ValueError:
-                logger.debug("Couldn't extract datetime from filename")
 
             supplied_data.save()
             sync_with_s3(supplied_data)
 
-            # package_json_raw = s3_storage._open(original_file_path)
-            # package_json_dict = json.load(package_json_raw)
-            # package_json = json.dumps(package_json_dict)
-            #
-            # upsert_helper.upsert_ocds_data(package_json, supplied_data=supplied_data)
+
+class S3BackfillHelpers():
+    """
+    Rebuild the submissions in the database from the files in the S3 bucket
+
+    Files are downloaded to the local cache and parsed by a pool of threads,
+    while the main thread writes the parsed packages to the database, so
+    downloads overlap with the upserts. Only a few packages more than there
+    are workers are held in memory at once.
+    Submissions already in the database are skipped, and the ids that have
+    been loaded are appended to a checkpoint file so an interrupted run can
+    resume where it stopped.
+    """
+    def __init__(self, current_app="silvereye", workers=None, checkpoint_path=None, tiered_storage=None):
+        self.current_app = current_app
+        self.workers = workers or settings.S3_BACKFILL_WORKERS
+        self.checkpoint_path = checkpoint_path or settings.S3_BACKFILL_CHECKPOINT_PATH
+        self.tiered_storage = tiered_storage or get_tiered_storage()
+
+    def read_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return set()
+        with open(self.checkpoint_path) as checkpoint_file:
+            return set(line.strip() for line in checkpoint_file if line.strip())
+
+    def pending_ids(self):
+        """
+        Directories in the bucket that are neither in the database nor in the checkpoint
+        """
+        known_ids = set(str(pk) for pk in FileSubmission.objects.values_list("pk", flat=True))
+        known_ids |= self.read_checkpoint()
+        directories, filenames = self.tiered_storage.remote_storage.listdir(name=".")
+        return [id for id in directories if id not in known_ids]
+
+    def fetch(self, id):
+        """
+        Download and parse the files of one submission, run in a worker thread
+
+        :return: List of (original_file_path, created, package_json)
+        """
+        directories, filenames = self.tiered_storage.remote_storage.listdir(name=id)
+        files = []
+        for filename in filenames:
+            original_file_path = os.path.join(id, filename)
+            self.tiered_storage.record(original_file_path, in_remote=True)
+            self.tiered_storage.ensure_local(original_file_path)
+            with self.tiered_storage.local_storage.open(original_file_path) as package_file:
+                package_json = json.load(package_file)
+            files.append((original_file_path, s3_submission_created(filename), package_json))
+        return files
+
+    def load(self, id, files):
+        """
+        Write the parsed files of one submission to the database
+        """
+        upsert_helper = UpsertDataHelpers()
+        with transaction.atomic():
+            for original_file_path, created, package_json in files:
+                supplied_data = FileSubmission(
+                    id=id,
+                    original_file=original_file_path,
+                )
+                if created:
+                    supplied_data.created = created
+                supplied_data.current_app = self.current_app
+                supplied_data.save()
+                upsert_helper.upsert_ocds_package(package_json, supplied_data=supplied_data,
+                                                  filename=os.path.basename(original_file_path))
+
+    def run(self):
+        """
+        :return: dict of loaded and failed counts
+        """
+        ids = self.pending_ids()
+        logger.info("Loading %s submissions from S3 with %s workers", len(ids), self.workers)
+        counts = {"loaded": 0, "failed": 0}
+        id_iterator = iter(ids)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor, \
+                open(self.checkpoint_path, "a") as checkpoint_file:
+            # Keep a bounded window of downloads running ahead of the database writes
+            pending = deque(
+                (id, executor.submit(self.fetch, id)) for id in islice(id_iterator, self.workers * 2)
+            )
+            while pending:
+                id, future = pending.popleft()
+                for next_id in islice(id_iterator, 1):
+                    pending.append((next_id, executor.submit(self.fetch, next_id)))
+                try:
+                    self.load(id, future.result())
+                except Exception:
+                    logger.exception("Failed to load submission %s from S3", id)
+                    counts["failed"] += 1
+                    continue
+                checkpoint_file.write(f"{id}\n")
+                checkpoint_file.flush()
+                counts["loaded"] += 1
+                if counts["loaded"] % 100 == 0:
+                    logger.info("Loaded %s of %s submissions", counts["loaded"], len(ids))
+        return counts
 
 
 def sync_with_s3(supplied_data):
-    logger.info("Syncing supplied_data original_file with S3")
-    s3_storage = get_storage_class(settings.S3_FILE_STORAGE)()
-    original_filename = supplied_data.original_file.name.split(os.path.sep)[1]
-    original_file_path = supplied_data.original_file.path
-    # Sync to S3
-    if os.path.exists(original_file_path):
-        if not s3_storage.exists(supplied_data.original_file.name):
-            logger.info("Storing to S3: %s", supplied_data.original_file.name)
-            local_file = supplied_data.original_file.read()
-            # Temporarily change the storage for the original_file FileField to save to S3
-            supplied_data.original_file.storage = s3_storage
-            supplied_data.original_file.save(original_filename, ContentFile(local_file))
-            # Put storage back to DEFAULT_FILE_STORAGE for
-            supplied_data.original_file.storage = get_storage_class(settings.DEFAULT_FILE_STORAGE)()
-    # Sync from S3 if not local
-    if not os.path.exists(original_file_path):
-        if s3_storage.exists(supplied_data.original_file.name):
-            logger.info("Retrieving from S3: %s", supplied_data.original_file.name)
-            # Switch to S3 storage and read file
-            supplied_data.original_file.storage = s3_storage
-            s3_file = supplied_data.original_file.read()
-            # Switch storage back and save file locally
-            supplied_data.original_file.storage = get_storage_class(settings.DEFAULT_FILE_STORAGE)()
-            supplied_data.original_file.save(original_filename, ContentFile(s3_file))
+    """
+    Make sure the original file of a submission is available locally, and
+    queue it for upload to S3 unless it is already known to be there.
+    Neither makes an S3 call for a file that is cached and known to be in S3.
+    """
+    tiered_storage = get_tiered_storage()
+    name = supplied_data.original_file.name
+    if tiered_storage.local_storage.exists(name):
+        if not tiered_storage.is_remote(name):
+            queue_s3_upload(name)
+    else:
+        tiered_storage.ensure_local(name)
+
+
+def queue_s3_upload(name):
+    """
+    Record a local file in the outbox for upload to S3 by the upload_to_s3 command
+    """
+    S3UploadOutbox.objects.bulk_create([S3UploadOutbox(name=name)], ignore_conflicts=True)
+
+
+def retry_failed_s3_uploads(queryset=None):
+    """
+    Queue outbox entries that were given up on to be uploaded again
+
+    :param queryset: S3UploadOutbox entries to retry, all failed entries by default
+    :return: Number of entries queued
+    """
+    if queryset is None:
+        queryset = S3UploadOutbox.objects.all()
+    return queryset.filter(failed=True).update(failed=False, attempts=0, next_attempt_at=timezone.now())
+
+
+def claim_s3_uploads(batch_size, lease_seconds, exclude=()):
+    """
+    Claim due outbox entries for this worker by moving their next attempt
+    past the lease, so that other workers skip them while they are uploaded
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        entries = list(
+            S3UploadOutbox.objects
+            .select_for_update(skip_locked=True)
+            .filter(failed=False, next_attempt_at__lte=now)
+            .exclude(pk__in=exclude)
+            .order_by('next_attempt_at')[:batch_size]
+        )
+        S3UploadOutbox.objects \
+            .filter(pk__in=[entry.pk for entry in entries]) \
+            .update(next_attempt_at=now + timedelta(seconds=lease_seconds))
+    return entries
+
+
+def process_s3_upload_outbox(tiered_storage=None, batch_size=10, max_attempts=None, lease_seconds=600):
+    """
+    Upload the files that are due in the outbox, retrying failures with exponential backoff
+
+    :param tiered_storage: TieredStorage to upload with
+    :param batch_size: Number of entries to claim at a time
+    :param max_attempts: Attempts before an upload is given up on, S3_UPLOAD_MAX_ATTEMPTS by default
+    :param lease_seconds: Time before an entry claimed by a worker that died is retried
+    :return: dict of uploaded and failed counts
+    """
+    tiered_storage = tiered_storage or get_tiered_storage()
+    if max_attempts is None:
+        max_attempts = settings.S3_UPLOAD_MAX_ATTEMPTS
+    counts = {"uploaded": 0, "failed": 0}
+    # Entries whose file was saved on another host, left for a worker running there
+    skipped = []
+    while True:
+        entries = claim_s3_uploads(batch_size, lease_seconds, exclude=skipped)
+        if not entries:
+            return counts
+        for entry in entries:
+            if not tiered_storage.local_storage.exists(entry.name):
+                skipped.append(entry.pk)
+                S3UploadOutbox.objects.filter(pk=entry.pk).update(next_attempt_at=entry.next_attempt_at)
+                continue
+            try:
+                tiered_storage.ensure_remote(entry.name)
+            except Exception as e:
+                attempts = entry.attempts + 1
+                logger.exception("Failed to upload %s to S3, attempt %s", entry.name, attempts)
+                backoff = settings.S3_UPLOAD_RETRY_DELAY * 2 ** (attempts - 1)
+                S3UploadOutbox.objects.filter(pk=entry.pk).update(
+                    attempts=attempts,
+                    next_attempt_at=timezone.now() + timedelta(seconds=backoff),
+                    # Leave the entry in the outbox, but don't try it again until it's retried
+                    failed=attempts >= max_attempts,
+                    last_error=str(e),
+                )
+                counts["failed"] += 1
+            else:
+                S3UploadOutbox.objects.filter(pk=entry.pk).delete()
+                counts["uploaded"] += 1
 
 
 class GoogleSheetHelpers():
@@ -128,33 +316,293 @@ class GoogleSheetHelpers():
 
 
 def get_published_release_metrics(release_queryset):
-    count_tenders = release_queryset.filter(release_tag__contains="tender").count()
-    count_awards = release_queryset.filter(release_tag__contains="award").count()
-    count_spend = release_queryset.filter(release_tag__contains="spend").count()
+    counts = release_queryset.aggregate(
+        tenders=Count("ocid", filter=Q(release_tag__contains="tender")),
+        awards=Count("ocid", filter=Q(release_tag__contains="award")),
+        spend=Count("ocid", filter=Q(release_tag__contains="spend")),
+    )
 
     context = {
-            "tenders_count": count_tenders,
-            "awards_count": count_awards,
-            "spend_count": count_spend,
+            "tenders_count": counts["tenders"],
+            "awards_count": counts["awards"],
+            "spend_count": counts["spend"],
     }
     return context
 
 
-def update_publisher_monthly_counts():
-    sql_path = os.path.join(SILVEREYE_DIR, "metrics", "monthly_counts.sql")
+def link_publisher_authority_types():
+    """
+    Set the authority type of publishers without one from the AuthorityType with the same name
+    """
+    matching_authority_types = AuthorityType.objects \
+        .filter(authority_name=OuterRef('publisher_name')) \
+        .order_by('pk') \
+        .values('pk')[:1]
+    return Publisher.objects \
+        .filter(authority_type__isnull=True) \
+        .update(authority_type=Subquery(matching_authority_types))
+
+
+def get_metrics_cache_generation():
+    """
+    The generation is kept in the database rather than the cache, so that a
+    refresh in any process expires the values cached by every web process,
+    whatever the cache backend
+    """
+    with connections['default'].cursor() as cursor:
+        cursor.execute(f"SELECT last_value, is_called FROM {METRICS_CACHE_GENERATION_SEQUENCE}")
+        last_value, is_called = cursor.fetchone()
+    return last_value if is_called else 0
+
+
+def next_metrics_cache_generation():
+    with connections['default'].cursor() as cursor:
+        cursor.execute("SELECT nextval(%s)", [METRICS_CACHE_GENERATION_SEQUENCE])
+
+
+def invalidate_metrics_cache():
+    """
+    Expire all cached MetricHelpers values, called whenever the metrics are refreshed
+    """
+    next_metrics_cache_generation()
+    if connections['default'].in_atomic_block:
+        # Other processes can cache values read before the refresh is committed
+        transaction.on_commit(next_metrics_cache_generation)
+
+
+def read_metrics_sql(file_name):
+    sql_path = os.path.join(SILVEREYE_DIR, "metrics", file_name)
+    with open(sql_path) as sql_file:
+        return sql_path, sql_file.read()
+
+
+def get_submission_monthly_buckets(supplied_data_ids):
+    """
+    Get the (publisher id, month) buckets that hold releases from the given submissions
+
+    :param supplied_data_ids: FileSubmission ids
+    :return: list of (publisher_id, date) tuples
+    """
+    sql_path, sql = read_metrics_sql("submission_buckets.sql")
+    with connections['default'].cursor() as cursor:
+        cursor.execute(sql, {"supplied_data_ids": [str(supplied_data_id) for supplied_data_id in supplied_data_ids]})
+        return cursor.fetchall()
+
+
+def get_package_monthly_buckets(package):
+    """
+    Get the (publisher id, month) buckets that already hold the releases and
+    records of a package, before it is upserted
+
+    A release that moves to another month or publisher when it's uploaded again
+    leaves its old bucket to be recomputed as well as its new one.
+
+    :param package: Parsed OCDS release or record package
+    :return: list of (publisher_id, date) tuples
+    """
+    releases = [release for release in package.get("releases") or [] if isinstance(release, dict)]
+    record_ocids = [record.get("ocid") for record in package.get("records") or [] if isinstance(record, dict)]
+    if not releases and not record_ocids:
+        return []
+    sql_path, sql = read_metrics_sql("package_buckets.sql")
+    with connections['default'].cursor() as cursor:
+        cursor.execute(sql, {
+            "ocids": [release.get("ocid") for release in releases],
+            "release_ids": [release.get("id") for release in releases],
+            "record_ocids": record_ocids,
+        })
+        return cursor.fetchall()
+
+
+def update_publisher_monthly_counts(buckets=None):
+    """
+    Update PublisherCountsRollup from the releases in the database, and
+    PublisherMonthlyCounts from its month rows
+
+    Rebuilds every publisher and month unless given the (publisher id, month)
+    buckets to recompute.
+
+    :param buckets: iterable of (publisher_id, date) tuples
+    """
+    if buckets is None:
+        sql_files = ["rollup_counts.sql", "monthly_counts.sql"]
+        params = None
+    else:
+        buckets = list(buckets)
+        if not buckets:
+            return
+        sql_files = ["rollup_counts_buckets.sql", "monthly_counts_buckets.sql"]
+        publisher_ids, months = zip(*buckets)
+        params = {"publisher_ids": list(publisher_ids), "months": list(months)}
+
+    with transaction.atomic(), connections['default'].cursor() as cursor:
+        for file_name in sql_files:
+            sql_path, sql = read_metrics_sql(file_name)
+            logger.info(f"Executing metric sql from file {sql_path}")
+            cursor.execute(sql, params)
+    invalidate_metrics_cache()
+
+
+def update_publisher_activity(publisher_ids=None):
+    """
+    Update the submission and release summary columns on Publisher
 
+    :param publisher_ids: Publisher ids to update, all publishers if None
+    """
+    if publisher_ids is not None:
+        publisher_ids = [publisher_id for publisher_id in publisher_ids if publisher_id is not None]
+        if not publisher_ids:
+            return
+    sql_path, sql = read_metrics_sql("publisher_activity.sql")
     with connections['default'].cursor() as cursor:
-        sql = open(sql_path).read()
         logger.info(f"Executing metric sql from file {sql_path}")
-        cursor.execute(sql)
+        cursor.execute(sql, {"publisher_ids": publisher_ids})
+
+
+@contextmanager
+def publisher_metrics_lock(wait=True):
+    """
+    Hold the Postgres advisory lock that serialises PublisherMonthlyCounts refreshes
+
+    :param wait: Block until the lock is free, otherwise give up straight away
+    :return: True if the lock is held
+    """
+    with connections['default'].cursor() as cursor:
+        if wait:
+            cursor.execute("SELECT pg_advisory_lock(%s)", [PUBLISHER_METRICS_LOCK_ID])
+            acquired = True
+        else:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", [PUBLISHER_METRICS_LOCK_ID])
+            acquired = cursor.fetchone()[0]
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [PUBLISHER_METRICS_LOCK_ID])
+
+
+def rebuild_publisher_monthly_counts():
+    """
+    Rebuild PublisherMonthlyCounts for every publisher and month
+    """
+    with publisher_metrics_lock():
+        # Everything queued so far is covered by the rebuild
+        PublisherMonthlyCountsQueue.objects.all().delete()
+        update_publisher_monthly_counts()
+    update_publisher_activity()
+
+
+def queue_publisher_monthly_counts(buckets):
+    """
+    Mark (publisher id, month) buckets as needing to be recomputed.
+    A bucket that is already queued keeps its original queued_at time.
+    """
+    PublisherMonthlyCountsQueue.objects.bulk_create(
+        [PublisherMonthlyCountsQueue(publisher_id=publisher_id, date=date) for publisher_id, date in buckets],
+        ignore_conflicts=True,
+    )
+
+
+def publisher_monthly_counts_queue_is_stale():
+    """
+    Check whether any queued bucket has waited longer than PUBLISHER_METRICS_MAX_STALENESS
+    """
+    max_staleness = timedelta(seconds=settings.PUBLISHER_METRICS_MAX_STALENESS)
+    return PublisherMonthlyCountsQueue.objects.filter(queued_at__lte=timezone.now() - max_staleness).exists()
+
+
+def refresh_queued_publisher_monthly_counts(force=False):
+    """
+    Recompute every queued PublisherMonthlyCounts bucket in as few runs as possible
+
+    Only one process refreshes at a time. Others queue their buckets and
+    return, leaving the lock holder to pick them up before it finishes.
+
+    :param force: Refresh even if no bucket has reached PUBLISHER_METRICS_MAX_STALENESS
+    """
+    queue_table = PublisherMonthlyCountsQueue._meta.db_table
+    while force or publisher_monthly_counts_queue_is_stale():
+        with publisher_metrics_lock(wait=False) as acquired:
+            if not acquired:
+                logger.info("Publisher metrics refresh already running, leaving queued buckets to it")
+                return
+            while True:
+                with transaction.atomic():
+                    with connections['default'].cursor() as cursor:
+                        cursor.execute(f"DELETE FROM {queue_table} RETURNING publisher_id, date")
+                        buckets = cursor.fetchall()
+                    if not buckets:
+                        break
+                    logger.info("Refreshing %s queued publisher metrics buckets", len(buckets))
+                    update_publisher_monthly_counts(buckets)
+        # Buckets queued while the lock was being released would otherwise be missed
+        if not PublisherMonthlyCountsQueue.objects.exists():
+            return
+
+
+def update_submission_monthly_counts(supplied_data, refresh=True, previous_buckets=()):
+    """
+    Queue the PublisherMonthlyCounts buckets touched by the releases in a submission,
+    and update the activity summary of its publisher
+
+    :param supplied_data: FileSubmission object
+    :param refresh: Refresh the queue, subject to PUBLISHER_METRICS_MAX_STALENESS
+    :param previous_buckets: Buckets that held the submission's releases before it
+        was upserted, from get_package_monthly_buckets
+    """
+    with transaction.atomic():
+        buckets = set(get_submission_monthly_buckets([supplied_data.id]))
+        buckets.update(previous_buckets)
+        queue_publisher_monthly_counts(buckets)
+        # Releases moved from another publisher change its activity too
+        publisher_ids = {supplied_data.publisher_id}
+        publisher_ids.update(publisher_id for publisher_id, date in previous_buckets)
+        update_publisher_activity(publisher_ids)
+    if refresh:
+        refresh_queued_publisher_monthly_counts()
 
 
 class MetricHelpers():
+    # How each metrics model is aggregated into tenders, awards and spend values
+    measures = {
+        PublisherCountsRollup: {
+            "aggregate": Sum,
+            "date_field": "date",
+            "window_filter": "rollup_window_filter",
+            "fields": {
+                "tenders": "count_tenders",
+                "awards": "count_awards",
+                "spend": "count_spend",
+            },
+        },
+        PublisherMonthlyCounts: {
+            "aggregate": Sum,
+            "date_field": "date",
+            "fields": {
+                "tenders": "count_tenders",
+                "awards": "count_awards",
+                "spend": "count_spend",
+            },
+        },
+        FieldCoverage: {
+            "aggregate": Avg,
+            "date_field": "file_submission__created",
+            "fields": {
+                "tenders": "tenders_field_coverage",
+                "awards": "awards_field_coverage",
+                "spend": "spend_field_coverage",
+            },
+        },
+    }
+
     def __init__(self):
         self.get_values_func = self.period_counts
 
     def period_descriptions(self):
         return  {
+            'week': 'this week',
+            '7_day': 'last 7 days',
+            '30_day': 'last 30 days',
             'current': 'this month',
             '1_month': 'last month',
             '3_month': 'last 3 months',
@@ -174,33 +622,90 @@ class MetricHelpers():
         raw_percent = (100 * (current - previous) / previous) if previous else 0
         return round(raw_percent)
 
-    def period_counts(self, queryset, period_start, period_end):
-        if not (period_start is None and period_end is None):
-            queryset = queryset.filter(
-                date__gte=period_start,
-                date__lt=period_end
-            )
-        return queryset.aggregate(
-            tenders=Coalesce(Sum('count_tenders'), 0),
-            awards=Coalesce(Sum('count_awards'), 0),
-            spend=Coalesce(Sum('count_spend'), 0)
+    def window_values(self, queryset, windows):
+        """
+        Aggregate the queryset over several date windows with a single query
+
+        :param queryset: PublisherMonthlyCounts or FieldCoverage queryset
+        :param windows: iterable of (start, end) tuples, (None, None) for all time
+        :return: dict of values for each window, keyed by (start, end)
+        """
+        measure = self.measures[queryset.model]
+        get_window_filter = getattr(self, measure.get("window_filter", "date_window_filter"))
+        windows = list(dict.fromkeys(windows))
+        aggregates = {}
+        for i, (window_start, window_end) in enumerate(windows):
+            window_filter = get_window_filter(measure, window_start, window_end)
+            for name, field in measure["fields"].items():
+                aggregates[f"{name}_{i}"] = Coalesce(measure["aggregate"](field, filter=window_filter), 0)
+        results = queryset.aggregate(**aggregates)
+        return {
+            window: {name: results[f"{name}_{i}"] for name in measure["fields"]}
+            for i, window in enumerate(windows)
+        }
+
+    def date_window_filter(self, measure, window_start, window_end):
+        """
+        Filter on the measure's date field, or None for all time
+        """
+        if window_start is None and window_end is None:
+            return None
+        return Q(**{
+            f"{measure['date_field']}__gte": window_start,
+            f"{measure['date_field']}__lt": window_end,
+        })
+
+    def rollup_window_filter(self, measure, window_start, window_end):
+        """
+        Filter PublisherCountsRollup to the fewest rows covering the window.
+        Whole years use year rows, whole months month rows and the remainder day rows.
+        """
+        if window_start is None and window_end is None:
+            return Q(grain=PublisherCountsRollup.GRAIN_YEAR)
+        window_filter = Q(pk__in=[])
+        for grain, range_start, range_end in rollup_window_ranges(window_start, window_end):
+            window_filter |= Q(grain=grain, date__gte=range_start, date__lt=range_end)
+        return window_filter
+
+    def all_windows(self, reference_date):
+        """
+        Every period and comparison window offered by the publisher hub
+        """
+        windows = []
+        for period_option in self.period_descriptions():
+            period_start, period_end = self.period_bounds(reference_date, period_option)
+            windows.append((period_start, period_end))
+            if period_option == 'all':
+                continue
+            for comparison_option in self.comparison_descriptions():
+                windows.append(self.comparison_bounds(period_start, period_end, period_option, comparison_option))
+        return windows
+
+    def all_window_values(self, queryset, reference_date):
+        """
+        Values for every period and comparison window, from one query per model.
+        Cached until the next metrics refresh.
+        """
+        query_hash = hashlib.md5(str(queryset.query).encode("utf-8")).hexdigest()
+        cache_key = "silvereye-metrics-{}-{}-{}-{}".format(
+            get_metrics_cache_generation(),
+            queryset.model._meta.label_lower,
+            query_hash,
+            reference_date.isoformat(),
         )
+        values = cache.get(cache_key)
+        if values is None:
+            values = self.window_values(queryset, self.all_windows(reference_date))
+            cache.set(cache_key, values, settings.PUBLISHER_METRICS_CACHE_TIMEOUT)
+        return values
+
+    def period_counts(self, queryset, period_start, period_end):
+        return self.window_values(queryset, [(period_start, period_end)])[(period_start, period_end)]
 
     def field_coverages(self, queryset, period_start, period_end):
-        if not (period_start is None and period_end is None):
-            queryset = queryset.filter(
-                file_submission__created__gte=period_start,
-                file_submission__created__lt=period_end
-            )
-        queryset = queryset.aggregate(
-            tenders=Coalesce(Avg('tenders_field_coverage'), 0),
-            awards=Coalesce(Avg('awards_field_coverage'), 0),
-            spend=Coalesce(Avg('spend_field_coverage'), 0),
-        )
-        return queryset
+        return self.window_values(queryset, [(period_start, period_end)])[(period_start, period_end)]
 
-    def period_data(self, queryset, period_start, period_end):
-        period_counts = self.get_values_func(queryset, period_start, period_end)
+    def period_data_from_values(self, period_counts):
         return {
             "counts": {
                 "tenders": period_counts.get("tenders"),
@@ -209,9 +714,7 @@ class MetricHelpers():
             }
         }
 
-    def comparison_data(self, queryset, comparison_start, comparison_end, period_counts):
-        comparison_counts = self.get_values_func(queryset, comparison_start, comparison_end)
-
+    def comparison_data_from_values(self, comparison_counts, period_counts):
         return { "change": {
                     "tenders": round(period_counts.get("tenders") - comparison_counts.get("tenders"), 1),
                     "awards": round(period_counts.get("awards") - comparison_counts.get("awards"), 1),
@@ -229,17 +732,25 @@ class MetricHelpers():
                     },
                 }
 
+    def period_data(self, queryset, period_start, period_end):
+        period_counts = self.get_values_func(queryset, period_start, period_end)
+        return self.period_data_from_values(period_counts)
+
+    def comparison_data(self, queryset, comparison_start, comparison_end, period_counts):
+        comparison_counts = self.get_values_func(queryset, comparison_start, comparison_end)
+        return self.comparison_data_from_values(comparison_counts, period_counts)
+
     def metric_data(self, queryset, reference_date, period_option, comparison_option):
-        data = {}
+        window_values = self.all_window_values(queryset, reference_date)
 
         period_start, period_end = self.period_bounds(reference_date=reference_date,
                                                       period_option=period_option)
-        period_data = self.period_data(queryset, period_start, period_end)
+        period_data = self.period_data_from_values(window_values[(period_start, period_end)])
 
         if period_option != 'all':
-            period_data['comparison'] = {}
             comparison_start, comparison_end = self.comparison_bounds(period_start, period_end, period_option, comparison_option)
-            period_data['comparison'] = self.comparison_data(queryset, comparison_start, comparison_end, period_data['counts'])
+            period_data['comparison'] = self.comparison_data_from_values(window_values[(comparison_start, comparison_end)],
+                                                                         period_data['counts'])
         return period_data
 
     def period_bounds(self, reference_date, period_option):
@@ -249,6 +760,12 @@ class MetricHelpers():
         elif period_option == 'current':
             period_end = reference_date + relativedelta(days=1)
             period_start = reference_date.replace(day=1)
+        elif period_option == 'week':
+            period_end = reference_date + relativedelta(days=1)
+            period_start = reference_date - relativedelta(days=reference_date.weekday())
+        elif self.parse_period_unit(period_option) == 'day':
+            period_end = reference_date + relativedelta(days=1)
+            period_start = period_end - relativedelta(days=self.parse_period_option(period_option))
         else:
             period_span = self.parse_period_option(period_option)
             period_end = reference_date.replace(day=1)
@@ -257,12 +774,17 @@ class MetricHelpers():
 
     def comparison_bounds(self, period_start, period_end, period_option, comparison_option):
         if period_option == 'current':
-            period_span = 1
-            period_end = period_start.replace(day=1) + relativedelta(months=period_span)
+            period_span = relativedelta(months=1)
+            period_end = period_start.replace(day=1) + period_span
+        elif period_option == 'week':
+            period_span = relativedelta(days=7)
+            period_end = period_start + period_span
+        elif self.parse_period_unit(period_option) == 'day':
+            period_span = relativedelta(days=self.parse_period_option(period_option))
         else:
-            period_span = self.parse_period_option(period_option)
+            period_span = relativedelta(months=self.parse_period_option(period_option))
         if comparison_option == 'preceding':
-            comparison_start = period_start - relativedelta(months=period_span)
+            comparison_start = period_start - period_span
             comparison_end = period_start
         else:
             comparison_span = self.parse_comparison_option(comparison_option)
@@ -276,15 +798,66 @@ class MetricHelpers():
         return int(comparison_option.split('_')[0])
 
     def parse_period_option(self, period_option):
+        # 7_day
+        # 30_day
         # 1_month
         # 3_month
         # 6_month
         # 12_month
         return int(period_option.split('_')[0])
 
+    def parse_period_unit(self, period_option):
+        return period_option.split('_')[1]
+
+
+def rollup_window_ranges(window_start, window_end):
+    """
+    Split a date window into runs of whole years, whole months and days
+
+    :param window_start: First date in the window
+    :param window_end: Date after the last date in the window
+    :return: list of (grain, range_start, range_end) tuples
+    """
+    if isinstance(window_start, datetime):
+        window_start = window_start.date()
+    if isinstance(window_end, datetime):
+        window_end = window_end.date()
+
+    def first_of_month(d):
+        return d.replace(day=1)
+
+    def first_of_year(d):
+        return d.replace(month=1, day=1)
+
+    month_start = first_of_month(window_start)
+    if month_start < window_start:
+        month_start += relativedelta(months=1)
+    month_end = first_of_month(window_end)
+    if month_start >= month_end:
+        return [(PublisherCountsRollup.GRAIN_DAY, window_start, window_end)]
+
+    year_start = first_of_year(month_start)
+    if year_start < month_start:
+        year_start += relativedelta(years=1)
+    year_end = first_of_year(month_end)
+    if year_start >= year_end:
+        ranges = [(PublisherCountsRollup.GRAIN_MONTH, month_start, month_end)]
+    else:
+        ranges = [
+            (PublisherCountsRollup.GRAIN_MONTH, month_start, year_start),
+            (PublisherCountsRollup.GRAIN_YEAR, year_start, year_end),
+            (PublisherCountsRollup.GRAIN_MONTH, year_end, month_end),
+        ]
+    ranges = [
+        (PublisherCountsRollup.GRAIN_DAY, window_start, month_start),
+        *ranges,
+        (PublisherCountsRollup.GRAIN_DAY, month_end, window_end),
+    ]
+    return [(grain, range_start, range_end) for grain, range_start, range_end in ranges if range_start < range_end]
+
 
 def get_publisher_metrics_context(queryset=None, period_option='1_month', comparison_option='preceding'):
-    if not queryset:
+    if queryset is None or not queryset.exists():
         return {}
 
     today = date_today()
@@ -300,7 +873,7 @@ def get_publisher_metrics_context(queryset=None, period_option='1_month', compar
 
 def get_coverage_metrics_context(queryset=None, period_option='1_month', comparison_option='preceding'):
 
-    if not queryset:
+    if queryset is None or not queryset.exists():
         return {}
 
     today = date_today()
@@ -328,28 +901,57 @@ def date_today():
     return datetime.now().date()
 
 
+class RequiredFieldMissingRows(Sequence):
+    """
+    Rows of a simple CSV missing a required field, kept as an array of row
+    numbers and expanded to validation error values only when they're read,
+    eg. the first few rows shown by the explore page
+    """
+
+    def __init__(self, header, row_numbers):
+        """
+        :param header: Simple CSV header of the missing field
+        :param row_numbers: Iterable of the row numbers missing it
+        """
+        self.header = header
+        self.row_numbers = array("l", row_numbers)
+
+    def __len__(self):
+        return len(self.row_numbers)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.value(row) for row in self.row_numbers[index]]
+        return self.value(self.row_numbers[index])
+
+    def value(self, row):
+        return {
+            'header': self.header,
+            'path': f'releases/{row}',
+            'row_number': row,
+            'sheet': 'releases'
+        }
+
+
 def prepare_simple_csv_validation_errors(validation_errors, mapper, required_fields_missing=None):
     """
     Rename  OCDS uri headers to simple CSV headers in validation errors
 
-    :param validation_errors:
-    :param mapper:
-    :param required_fields_missing:
-    :return:
+    :param validation_errors: list of [error_json, values] from libcove
+    :param mapper: CSVMapper of the simple CSV
+    :param required_fields_missing: dict of simple CSV header to the row numbers missing it
+    :return: OCDS validation errors, simple CSV errors
     """
-
-    mapping_dict = {}
-    for i, row in mapper.mappings_df.iterrows():
-        if row["csv_header"]:
-            mapping_dict[row["uri"]] = row["csv_header"]
+    mapping_dict = mapper.csv_headers_by_uri
 
     ocds_validation_errors = []
     simple_csv_errors = []
+    simple_csv_headers = set()
     for error_json, values in validation_errors:
         error_json_dict = json.loads(error_json)
         ocds_header = error_json_dict.get("header")
-        if ocds_header in mapping_dict.keys():
-            simple_csv_header = mapping_dict[ocds_header]
+        simple_csv_header = mapping_dict.get(ocds_header)
+        if simple_csv_header:
             error_json_dict["header"] = simple_csv_header
             error_json_dict["message"] = error_json_dict["message"].replace(f"'{ocds_header}'",
                                                                             f"'{simple_csv_header}'")
@@ -358,47 +960,42 @@ def prepare_simple_csv_validation_errors(validation_errors, mapper, required_fie
             if error_json_dict["validator_value"] == "date-time":
                 error_json_dict["message_safe"] = mark_safe(
                     'Incorrect date format. Use a standard date format such as ISO 8601: YYYY-MM-DDT00:00:00Z.')
-            for i, value in enumerate(values):
-                values[i]["header"] = simple_csv_header
-                values[i]["row_number"] -= 1
+            for value in values:
+                value["header"] = simple_csv_header
+                value["row_number"] -= 1
             simple_csv_errors.append([error_json_dict, values])
+            simple_csv_headers.add(simple_csv_header)
         elif error_json_dict["validator"] != "required":
             ocds_validation_errors.append([error_json, values])
-        # else:
-        #     ocds_validation_errors.append([error_json, values])
 
     # Append extra "required" files as specified in the mappings
-    for missing_csv_header, rows in required_fields_missing.items():
+    for missing_csv_header, rows in (required_fields_missing or {}).items():
         # Only add new headers
-        if missing_csv_header in [error[0].get("header") for error in simple_csv_errors]:
+        if missing_csv_header in simple_csv_headers:
             continue
-        else:
-            simple_csv_errors.append([
-                {
-                    'assumption': None,
-                    'error_id': None,
-                    'header': f'{missing_csv_header}',
-                    'header_extra': 'releases/[number]',
-                    'message': f"'{missing_csv_header}' is missing but required",
-                    'message_safe': f'<code>{missing_csv_header}</code> is missing but required',
-                    'message_type': 'required',
-                    'null_clause': '',
-                    'path_no_number': 'releases',
-                    'validator': 'required',
-                    'validator_value': None
-                },
-                [{
-                    'header': f'{missing_csv_header}',
-                    'path': f'releases/{row}',
-                    'row_number': row,
-                    'sheet': 'releases'
-                } for row in rows]
-            ])
+        simple_csv_headers.add(missing_csv_header)
+        simple_csv_errors.append([
+            {
+                'assumption': None,
+                'error_id': None,
+                'header': f'{missing_csv_header}',
+                'header_extra': 'releases/[number]',
+                'message': f"'{missing_csv_header}' is missing but required",
+                'message_safe': f'<code>{missing_csv_header}</code> is missing but required',
+                'message_type': 'required',
+                'null_clause': '',
+                'path_no_number': 'releases',
+                'validator': 'required',
+                'validator_value': None
+            },
+            RequiredFieldMissingRows(missing_csv_header, rows)
+        ])
 
     return ocds_validation_errors, simple_csv_errors
 
 
-def convert_simple_csv_submission(db_data, lib_cove_ocds_config, schema_url, file_type="csv", replace=True):
+def convert_simple_csv_submission(db_data, lib_cove_ocds_config, schema_url, file_type="csv", replace=True,
+                                  submission=None):
     # Silvereye CSV unflatten
     # Prepare base_json
     upload_dir = db_data.upload_dir()
@@ -415,13 +1012,14 @@ def convert_simple_csv_submission(db_data, lib_cove_ocds_config, schema_url, fil
         lib_cove_ocds_config,
         schema_url=schema_url,
         replace=replace,
-        base_json_path=base_json_path
+        base_json_path=base_json_path,
+        submission=submission,
     )
     return conversion_context
 
 
-def prepare_simple_csv_submission_base_json(base_json_path, publisher):
-    base_json = {
+def simple_csv_submission_base_json(publisher):
+    return {
         "version": "1.1",
         "publisher": {
             "name": publisher.publisher_name,
@@ -433,5 +1031,32 @@ def prepare_simple_csv_submission_base_json(base_json_path, publisher):
         # "publicationPolicy": "https://www.gov.uk/government/publications/open-contracting",
         "uri": "https://ocds-silvereye.herokuapp.com/"
     }
+
+
+def prepare_simple_csv_submission_base_json(base_json_path, publisher):
+    base_json = simple_csv_submission_base_json(publisher)
     with open(base_json_path, "w") as writer:
-        json.dump(base_json, writer, indent=2)
\ No newline at end of file
+        json.dump(base_json, writer, indent=2)
+
+
+def convert_simple_csv_in_memory(submission, publisher, lib_cove_ocds_config, schema_url):
+    """
+    Convert a simple CSV held in memory to an OCDS release package, giving the
+    same package as convert_simple_csv_submission without any files
+
+    :param submission: SimpleCSVSubmission
+    :param publisher: Publisher object for the package metadata
+    :param lib_cove_ocds_config: LibCoveOCDSConfig
+    :param schema_url: Release schema
+    :return: dict with the package and conversion_warning_messages
+    """
+    package, conversion_warning_messages = unflatten_csv_text(
+        submission.ocds_csv_text,
+        lib_cove_ocds_config,
+        schema_url,
+        simple_csv_submission_base_json(publisher),
+    )
+    return {
+        "package": package,
+        "conversion_warning_messages": conversion_warning_messages,
+    }
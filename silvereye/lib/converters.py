@@ -1,18 +1,33 @@
+import io
 import json
 import logging
 import os
 import shutil
+import tempfile
 import warnings
+import zipfile
+from collections import OrderedDict
+from csv import reader as csvreader
 from datetime import datetime
+from functools import lru_cache
 
 import flattentool
+import numpy as np
+import pandas as pd
+from flattentool import decimal_default
+from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
+from flattentool.input import convert_type
 from flattentool.json_input import BadlyFormedJSONError
+from flattentool.lib import isint
+from flattentool.schema import SchemaParser
 
 from libcove.lib.exceptions import cove_spreadsheet_conversion_error
 
-import silvereye.ocds_csv_mapper
 from silvereye import helpers
+from silvereye.lib.inputs import is_compressed, is_json_lines, is_zip, map_zip_members, merge_csv_texts, \
+    open_input, write_json_input
+from silvereye.ocds_csv_mapper import CSVMapper
 
 logger = logging.getLogger(__name__)
 
@@ -41,6 +56,7 @@ def convert_csv(
     cache=True,
     base_json_path=None,
     output_file="unflattened.json",
+    submission=None,
 ):
     context = {}
     converted_path = os.path.join(upload_dir, "unflattened.json")
@@ -49,61 +65,10 @@ def convert_csv(
     encoding = "utf-8-sig"
 
     if file_type == "csv":
-        # flatten-tool expects a directory full of CSVs with file names
-        # matching what xlsx titles would be.
-        # If only one upload file is specified, we rename it and move into
-        # a new directory, such that it fits this pattern.
-        input_name = os.path.join(upload_dir, "csv_dir")
-        os.makedirs(input_name, exist_ok=True)
-        destination = os.path.join(
-            input_name, lib_cove_config.config["root_list_path"] + ".csv"
-        )
-        shutil.copy(file_name, destination)
-        try:
-            with open(destination, encoding="utf-8-sig") as main_sheet_file:
-                main_sheet_file.read()
-        except UnicodeDecodeError:
-            try:
-                with open(destination, encoding="cp1252") as main_sheet_file:
-                    main_sheet_file.read()
-                encoding = "cp1252"
-            except UnicodeDecodeError:
-                encoding = "latin_1"
-
-        # Convert Simple CSV to OCDS URIs
-        df = silvereye.ocds_csv_mapper.CSVMapper(csv_path=destination).convert_simple_csv_to_ocds_csv(destination)
-
-    flattentool_options = {
-        "output_name": converted_path,
-        "base_json": base_json_path,
-        "input_format": file_type,
-        "default_configuration": "RootListPath {}".format(
-            lib_cove_config.config["root_list_path"]
-        ),
-        "encoding": encoding,
-        "cell_source_map": cell_source_map_path,
-        "heading_source_map": heading_source_map_path,
-        # "metatab_schema": pkg_schema_url,
-        # "metatab_name": metatab_name,
-        # "metatab_vertical_orientation": True,
-        "disable_local_refs": lib_cove_config.config["flatten_tool"][
-            "disable_local_refs"
-        ],
-    }
-
-
-    if lib_cove_config.config.get("hashcomments"):
-        flattentool_options["default_configuration"] += ",hashcomments"
-
-    flattentool_options.update(
-        {
-            "schema": schema_url,
-            "convert_titles": True,
-            "root_id": lib_cove_config.config["root_id"],
-            "root_is_list": lib_cove_config.config.get("root_is_list", False),
-            "id_name": lib_cove_config.config.get("id_name", None),
-        }
-    )
+        # Simple CSVs are read once and shared with field coverage and notice type detection
+        if submission is None:
+            submission = SimpleCSVSubmission(path=file_name)
+        encoding = submission.encoding
 
     conversion_warning_cache_path = os.path.join(
         upload_dir, "conversion_warning_messages.json"
@@ -113,11 +78,38 @@ def convert_csv(
         or not os.path.exists(cell_source_map_path)
         or replace
     ):
-        with warnings.catch_warnings(record=True) as conversion_warnings:
-            flattentool.unflatten(input_name, **flattentool_options)
-            context["conversion_warning_messages"] = filter_conversion_warnings(
-                conversion_warnings
+        if file_type == "csv":
+            # Convert Simple CSV to OCDS URIs
+            ocds_csv_text = submission.ocds_csv_text
+            with warnings.catch_warnings(record=True) as conversion_warnings:
+                submission.converted_json = write_simple_csv_conversion(
+                    ocds_csv_text,
+                    lib_cove_config,
+                    schema_url,
+                    base_json_path,
+                    converted_path,
+                    cell_source_map_path,
+                    heading_source_map_path,
+                )
+                context["conversion_warning_messages"] = filter_conversion_warnings(
+                    conversion_warnings
+                )
+        else:
+            flattentool_options = unflatten_options(lib_cove_config, schema_url, encoding)
+            flattentool_options.update(
+                {
+                    "output_name": converted_path,
+                    "base_json": base_json_path,
+                    "input_format": file_type,
+                    "cell_source_map": cell_source_map_path,
+                    "heading_source_map": heading_source_map_path,
+                }
             )
+            with warnings.catch_warnings(record=True) as conversion_warnings:
+                flattentool.unflatten(file_name, **flattentool_options)
+                context["conversion_warning_messages"] = filter_conversion_warnings(
+                    conversion_warnings
+                )
 
         if cache:
             with open(conversion_warning_cache_path, "w+") as fp:
@@ -141,3 +133,444 @@ def convert_csv(
     )
     return context
 
+
+def unflatten_options(lib_cove_config, schema_url, encoding):
+    """
+    Options of flattentool.unflatten for OCDS spreadsheets, without the input and output paths
+    """
+    options = {
+        "default_configuration": "RootListPath {}".format(
+            lib_cove_config.config["root_list_path"]
+        ),
+        "encoding": encoding,
+        "disable_local_refs": lib_cove_config.config["flatten_tool"][
+            "disable_local_refs"
+        ],
+        "schema": schema_url,
+        "convert_titles": True,
+        "root_id": lib_cove_config.config["root_id"],
+        "root_is_list": lib_cove_config.config.get("root_is_list", False),
+        "id_name": lib_cove_config.config.get("id_name", None),
+    }
+    if lib_cove_config.config.get("hashcomments"):
+        options["default_configuration"] += ",hashcomments"
+    return options
+
+
+def get_schema_parser(schema_url, root_id, disable_local_refs):
+    """
+    Parse a schema for unflattening once per process, parsing is slow and
+    the parser isn't changed by unflattening. Local schema files are parsed
+    again if they change.
+    """
+    modified = os.path.getmtime(schema_url) if os.path.exists(schema_url) else None
+    return _parse_schema(schema_url, modified, root_id, disable_local_refs)
+
+
+@lru_cache(maxsize=8)
+def _parse_schema(schema_url, modified, root_id, disable_local_refs, truncation_length=3):
+    parser = SchemaParser(
+        schema_filename=schema_url,
+        rollup=True,
+        root_id=root_id,
+        disable_local_refs=disable_local_refs,
+        truncation_length=truncation_length,
+    )
+    parser.parse()
+    return parser
+
+
+def decode_csv_file(fp):
+    """
+    Decode a CSV from a seekable binary file object as it's read, trying the
+    encodings cove accepts in turn. The file is read from the start again for
+    each encoding.
+
+    :return: Tuple of the text and its encoding
+    """
+    for encoding in ("utf-8-sig", "cp1252", "latin_1"):
+        fp.seek(0)
+        # Decode with universal newlines, as open() would
+        text_file = io.TextIOWrapper(fp, encoding=encoding)
+        try:
+            return text_file.read(), encoding
+        except UnicodeDecodeError:
+            pass
+        finally:
+            # Leave fp open for the next encoding
+            text_file.detach()
+
+
+def read_csv_text(file_name):
+    """
+    Read an uploaded CSV once, decoding gzip and bz2 as they're decompressed
+    without holding the decompressed bytes. The CSVs of a zip are read in
+    parallel and merged into one.
+
+    :return: Tuple of the text and its encoding
+    """
+    if is_zip(file_name):
+        # Files in a zip can't be seeked before Python 3.7, so each is read into memory to decode
+        decoded = map_zip_members(file_name, lambda member: decode_csv_file(io.BytesIO(member.read())))
+        return merge_csv_texts([text for text, encoding in decoded]), decoded[0][1]
+    with open_input(file_name) as csv_file:
+        return decode_csv_file(csv_file)
+
+
+class SimpleCSVSubmission():
+    """
+    A simple CSV submission read and parsed once, then shared by conversion,
+    field coverage and notice type detection
+
+    :param path: Path of the uploaded CSV
+    :param text: Contents of the CSV, instead of a path
+    :param encoding: Encoding the text was decoded from
+    """
+    def __init__(self, path=None, text=None, encoding="utf-8-sig"):
+        if text is None:
+            text, encoding = read_csv_text(path)
+        self.text = text
+        self.encoding = encoding
+        # Package JSON, set when convert_csv converts the submission
+        self.converted_json = None
+
+    @cached_property
+    def raw_df(self):
+        """
+        The CSV as pd.read_csv reads it, which mapping to OCDS expects
+        """
+        return pd.read_csv(io.StringIO(self.text))
+
+    @cached_property
+    def df(self):
+        """
+        The CSV with missing values as None, as CSVMapper reads it
+        """
+        return self.raw_df.replace({np.nan: None})
+
+    @cached_property
+    def mapper(self):
+        return CSVMapper(input_df=self.df)
+
+    @property
+    def notice_type(self):
+        return self.mapper.release_type
+
+    @cached_property
+    def ocds_csv_text(self):
+        """
+        The CSV mapped to flat OCDS release columns
+        """
+        ocds_df = self.mapper.convert_simple_df_to_ocds_df(self.raw_df)
+        return ocds_df.to_csv(index=False, header=True)
+
+
+class ListItems(OrderedDict):
+    """
+    Items of an array by their column index, while a release is built
+    """
+
+
+@lru_cache(maxsize=32)
+def compile_release_columns(parser, headings, id_name):
+    """
+    Work out where each column of a CSV of flat OCDS releases goes in a release
+
+    Only headings that are plain OCDS URIs, that agree with each other and the
+    schema about the shape of every field, are compiled. Anything else, e.g.
+    titles, duplicate headings or a field used both as an object and a value,
+    is left to flattentool, which warns about it.
+
+    :param parser: SchemaParser of the release schema
+    :param headings: Tuple of the CSV's headings
+    :param id_name: Name of the id field of releases and array items
+    :return: List of (column index, path to the parent object, field name, type) tuples,
+        or None if the CSV has to be unflattened by flattentool
+    """
+    if len(set(headings)) != len(headings):
+        return None
+    shapes = {}
+    columns = []
+    for index, heading in enumerate(headings):
+        if not heading or heading.startswith("#") or parser.title_lookup.lookup_header(heading) != heading:
+            return None
+        path_list = [item.rstrip("[]") for item in heading.split("/")]
+        if isint(path_list[0]):
+            return None
+        steps = []
+        node = ()
+        for num, path_item in enumerate(path_list):
+            if isint(path_item):
+                continue
+            path_till_now = "/".join(item for item in path_list[:num + 1] if not isint(item))
+            current_type = parser.flattened.get(path_till_now)
+            next_path_item = path_list[num + 1] if num + 1 < len(path_list) else ""
+            if isint(next_path_item):
+                if current_type and current_type != "array":
+                    return None
+                node += (path_item,)
+                if shapes.setdefault(node, "array") != "array":
+                    return None
+                node += (int(next_path_item),)
+                steps.append((path_item, int(next_path_item)))
+            elif current_type == "array":
+                return None
+            elif current_type == "object" or (not current_type and next_path_item):
+                node += (path_item,)
+                if shapes.setdefault(node, "object") != "object":
+                    return None
+                steps.append((path_item, None))
+            elif next_path_item:
+                return None
+            else:
+                node += (path_item,)
+                if node in shapes:
+                    return None
+                shapes[node] = "value"
+                if path_till_now == id_name and current_type not in ("", None, "string"):
+                    # Release ids are compared as they are in the CSV
+                    return None
+                columns.append((index, tuple(steps), path_item, current_type or ""))
+    return columns
+
+
+def items_to_lists(unflattened, id_name):
+    """
+    Turn the ListItems of a built release into lists in place, in column index
+    order. Items that share an id are merged, as flattentool does.
+    """
+    for key, value in unflattened.items():
+        if isinstance(value, ListItems):
+            keyed = OrderedDict()
+            items_no_id = []
+            for list_index in sorted(value):
+                item = items_to_lists(value[list_index], id_name)
+                if id_name not in item:
+                    items_no_id.append(item)
+                elif item[id_name] in keyed:
+                    keyed[item[id_name]].update(item)
+                else:
+                    keyed[item[id_name]] = item
+            unflattened[key] = list(keyed.values()) + items_no_id
+        elif isinstance(value, dict):
+            items_to_lists(value, id_name)
+    return unflattened
+
+
+def build_releases(csv_text, parser, root_id, id_name):
+    """
+    Build the releases of a CSV of flat OCDS releases row by row, the same as
+    flattentool would unflatten them
+
+    Values are converted by flattentool's convert_type, with the types from
+    the schema parser. Releases are grouped by root_id in the order they're
+    first seen, and a release id used by more than one row of an ocid, whose
+    rows flattentool merges, leaves the CSV to flattentool.
+
+    :param csv_text: CSV with OCDS URI headers
+    :param parser: SchemaParser of the release schema
+    :param root_id: Name of the field releases are grouped by, e.g. ocid
+    :param id_name: Name of the id field of releases and array items
+    :return: List of releases, or None if the CSV has to be unflattened by flattentool
+    """
+    rows = csvreader(io.StringIO(csv_text))
+    headings = tuple(next(rows, ()))
+    columns = compile_release_columns(parser, headings, id_name) if headings else None
+    if columns is None:
+        return None
+    root_index = headings.index(root_id) if root_id in headings else None
+    id_index = headings.index(id_name) if id_name in headings else None
+
+    # Skip empty rows, and find rows that flattentool would merge before converting any values
+    rows = [row[:len(headings)] for row in rows if any(row[:len(headings)])]
+    seen_ids = set()
+    for row in rows:
+        release_id = row[id_index] if id_index is not None and id_index < len(row) else ""
+        if release_id:
+            root_id_or_none = row[root_index] if root_index is not None and root_index < len(row) else None
+            if (root_id_or_none, release_id) in seen_ids:
+                return None
+            seen_ids.add((root_id_or_none, release_id))
+
+    releases_by_root_id = OrderedDict()
+    for row in rows:
+        release = OrderedDict()
+        for index, steps, field, field_type in columns:
+            if index >= len(row) or row[index] == "":
+                continue
+            current_path = release
+            for path_item, list_index in steps:
+                if list_index is None:
+                    current_path = current_path.setdefault(path_item, OrderedDict())
+                else:
+                    current_path = current_path.setdefault(path_item, ListItems()).setdefault(
+                        list_index, OrderedDict()
+                    )
+            current_path[field] = convert_type(field_type, row[index])
+        items_to_lists(release, id_name)
+
+        root_id_or_none = row[root_index] if root_index is not None and root_index < len(row) else None
+        keyed, releases_no_id = releases_by_root_id.setdefault(root_id_or_none, (OrderedDict(), []))
+        if id_name in release:
+            keyed[release[id_name]] = release
+        else:
+            releases_no_id.append(release)
+
+    releases = []
+    for keyed, releases_no_id in releases_by_root_id.values():
+        releases.extend(keyed.values())
+        releases.extend(releases_no_id)
+    return releases
+
+
+def unflatten_csv_with_flattentool(csv_text, lib_cove_config, schema_url, output_name, **options):
+    """
+    Unflatten a CSV of flat OCDS releases held in memory with flattentool.unflatten,
+    which reads a directory of CSV files
+
+    :param csv_text: CSV with OCDS URI headers
+    :param lib_cove_config: LibCoveOCDSConfig
+    :param schema_url: Release schema
+    :param output_name: Path to write the package JSON to
+    :param options: Other options of flattentool.unflatten, e.g. the source map paths
+    """
+    csv_dir = tempfile.mkdtemp(prefix="csv-")
+    try:
+        csv_path = os.path.join(csv_dir, lib_cove_config.config["root_list_path"] + ".csv")
+        with open(csv_path, "w", encoding="utf-8", newline="") as fp:
+            fp.write(csv_text)
+        flattentool_options = unflatten_options(lib_cove_config, schema_url, "utf-8")
+        flattentool_options.update(options)
+        flattentool.unflatten(csv_dir, input_format="csv", output_name=output_name, **flattentool_options)
+    finally:
+        shutil.rmtree(csv_dir)
+
+
+def write_simple_csv_conversion(
+    csv_text,
+    lib_cove_config,
+    schema_url,
+    base_json_path,
+    converted_path,
+    cell_source_map_path,
+    heading_source_map_path,
+):
+    """
+    Write the package and source maps for a CSV of flat OCDS releases with
+    flattentool, which makes the source maps the review page needs
+
+    :return: The package JSON as written
+    """
+    unflatten_csv_with_flattentool(
+        csv_text,
+        lib_cove_config,
+        schema_url,
+        converted_path,
+        base_json=base_json_path,
+        cell_source_map=cell_source_map_path,
+        heading_source_map=heading_source_map_path,
+    )
+    with open(converted_path, encoding="utf-8") as fp:
+        return fp.read()
+
+
+def unflatten_csv_text(csv_text, lib_cove_config, schema_url, base_json):
+    """
+    Unflatten a flat OCDS CSV held in memory into a package, the same as
+    convert_csv does with files without writing the JSON or the source maps
+    to disk
+
+    The releases are built from the mapped columns by build_releases, and
+    flattentool unflattens the CSVs that they can't be built from.
+
+    :param csv_text: CSV with OCDS URI headers
+    :param lib_cove_config: LibCoveOCDSConfig
+    :param schema_url: Release schema
+    :param base_json: dict of package metadata
+    :return: Tuple of package dict and list of conversion warning messages
+    """
+    root_list_path = lib_cove_config.config["root_list_path"]
+    root_id = lib_cove_config.config["root_id"]
+    parser = get_schema_parser(schema_url, root_id, lib_cove_config.config["flatten_tool"]["disable_local_refs"])
+    with warnings.catch_warnings(record=True) as conversion_warnings:
+        releases = build_releases(csv_text, parser, root_id, lib_cove_config.config.get("id_name", None) or "id")
+        if releases is None:
+            with tempfile.NamedTemporaryFile(suffix=".json") as output_file:
+                unflatten_csv_with_flattentool(csv_text, lib_cove_config, schema_url, output_file.name)
+                releases = json.load(output_file, object_pairs_hook=OrderedDict)
+            if not lib_cove_config.config.get("root_is_list", False):
+                releases = releases[root_list_path]
+        package = OrderedDict(base_json)
+        package[root_list_path] = releases
+        warning_messages = filter_conversion_warnings(conversion_warnings)
+
+    # Decimals become numbers as they do in the JSON file written by flattentool
+    package = json.loads(json.dumps(package, default=decimal_default))
+    return package, warning_messages
+
+
+# Download formats of flattened JSON, and the flattentool output format of each
+FLATTENED_FORMATS = {
+    "xlsx": "xlsx",
+    "zip": "csv",
+}
+
+
+def get_flattened_file(upload_dir, file_name, lib_cove_config, schema_url, schema_version, file_format="xlsx"):
+    """
+    Flatten a JSON submission to a spreadsheet the first time it's downloaded
+
+    The file is kept in the upload directory for each schema version, so it's
+    only flattened again for another schema version. The CSVs are zipped into
+    one file.
+
+    This doesn't stream: flattentool.flatten loads the whole package, and a zip
+    or JSON Lines upload is merged into one package first, so memory use grows
+    with the size of the package. Flattening only happens once per schema
+    version, when the spreadsheet is first downloaded.
+
+    :param upload_dir: Directory of the submission
+    :param file_name: Path of the JSON upload, which may be compressed
+    :param lib_cove_config: LibCoveOCDSConfig
+    :param schema_url: Release schema
+    :param schema_version: Schema version the file is kept for
+    :param file_format: "xlsx" or "zip" of CSVs
+    :return: Path of the flattened file
+    """
+    path = os.path.join(upload_dir, f"flattened-{schema_version}.{file_format}")
+    if os.path.exists(path):
+        return path
+
+    # Flatten into a temporary directory so a download never gets a partly written file
+    temp_dir = tempfile.mkdtemp(dir=upload_dir, prefix=".flattened-")
+    try:
+        output_name = os.path.join(temp_dir, "flattened")
+        if is_compressed(file_name) or is_json_lines(file_name):
+            # flattentool reads the JSON file itself
+            json_path = os.path.join(temp_dir, "input.json")
+            write_json_input(file_name, json_path)
+            file_name = json_path
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore')  # flattentool uses UserWarning, so can't set a specific category
+            flattentool.flatten(
+                file_name,
+                output_name=output_name,
+                output_format=FLATTENED_FORMATS[file_format],
+                main_sheet_name=lib_cove_config.config["root_list_path"],
+                root_list_path=lib_cove_config.config["root_list_path"],
+                root_id=lib_cove_config.config["root_id"],
+                schema=schema_url,
+                disable_local_refs=lib_cove_config.config["flatten_tool"]["disable_local_refs"],
+                remove_empty_schema_columns=lib_cove_config.config["flatten_tool"]["remove_empty_schema_columns"],
+                root_is_list=lib_cove_config.config.get("root_is_list", False),
+            )
+        if file_format == "zip":
+            csv_dir = output_name
+            output_name = os.path.join(temp_dir, "flattened.zip")
+            with zipfile.ZipFile(output_name, "w", zipfile.ZIP_DEFLATED) as zip_file:
+                for csv_name in sorted(os.listdir(csv_dir)):
+                    zip_file.write(os.path.join(csv_dir, csv_name), csv_name)
+        os.replace(output_name, path)
+    finally:
+        shutil.rmtree(temp_dir)
+    return path
@@ -0,0 +1,229 @@
+"""
+Read uploads that are compressed with gzip or bz2, that are a zip of
+several JSON or CSV files, or that are JSON Lines
+"""
+import bz2
+import gzip
+import io
+import json
+import os
+import shutil
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+
+import ijson
+import pandas as pd
+from django.conf import settings
+from flattentool import decimal_default
+from libcove.lib.exceptions import UnrecognisedFileType
+from libcove.lib.tools import get_file_type as _get_file_type
+
+from bluetail.helpers import BulkLoadHelpers, UpsertDataHelpers
+
+# Openers of the single file compression formats, by file name suffix
+COMPRESSION_OPENERS = {
+    ".gz": gzip.open,
+    ".bz2": bz2.open,
+}
+# Types of file read from a compressed file or a zip
+INPUT_FILE_TYPES = ("json", "csv")
+# Extensions of JSON Lines files, which are read as JSON
+JSON_LINES_EXTENSIONS = ("jsonl", "ndjson")
+
+
+def compression_suffix(file_name):
+    for suffix in COMPRESSION_OPENERS:
+        if file_name.lower().endswith(suffix):
+            return suffix
+
+
+def is_zip(file_name):
+    return file_name.lower().endswith(".zip")
+
+
+def is_compressed(file_name):
+    return is_zip(file_name) or bool(compression_suffix(file_name))
+
+
+def is_json_lines(file_name):
+    suffix = compression_suffix(file_name)
+    if suffix:
+        file_name = file_name[:-len(suffix)]
+    return file_name.lower().endswith(tuple("." + extension for extension in JSON_LINES_EXTENSIONS))
+
+
+def open_input(file_name):
+    """
+    Open an uploaded file as bytes, decompressing gzip and bz2 as it's read
+    """
+    suffix = compression_suffix(file_name)
+    if suffix:
+        return COMPRESSION_OPENERS[suffix](file_name, "rb")
+    return open(file_name, "rb")
+
+
+def zip_members(file_name):
+    """
+    Names of the files in a zip, leaving out directories and hidden files such as __MACOSX
+    """
+    with zipfile.ZipFile(file_name) as zip_file:
+        return sorted(
+            info.filename for info in zip_file.infolist()
+            if not info.is_dir()
+            and not any(part.startswith((".", "__MACOSX")) for part in info.filename.split("/"))
+        )
+
+
+def member_file_type(name):
+    file_type = os.path.splitext(name)[1].lower().lstrip(".")
+    if file_type in JSON_LINES_EXTENSIONS:
+        return "json"
+    return file_type if file_type in INPUT_FILE_TYPES else None
+
+
+def get_file_type(file_name):
+    """
+    libcove's get_file_type, also giving the type of the files in a gzip,
+    bz2 or zip upload
+    """
+    if not isinstance(file_name, str) and hasattr(file_name, "path"):
+        file_name = file_name.path
+    if is_zip(file_name):
+        try:
+            member_types = set(member_file_type(name) for name in zip_members(file_name))
+        except zipfile.BadZipFile:
+            raise UnrecognisedFileType
+        # All the files in a zip are the same type
+        if len(member_types) == 1 and None not in member_types:
+            return member_types.pop()
+        raise UnrecognisedFileType
+    suffix = compression_suffix(file_name)
+    if suffix:
+        file_type = member_file_type(file_name[:-len(suffix)])
+        if file_type:
+            return file_type
+        try:
+            with open_input(file_name) as fp:
+                if fp.read(1) in [b"{", b"["]:
+                    return "json"
+        except (OSError, EOFError):
+            pass
+        raise UnrecognisedFileType
+    file_type = member_file_type(file_name)
+    if file_type:
+        return file_type
+    return _get_file_type(file_name)
+
+
+def map_zip_members(file_name, read_member, workers=None):
+    """
+    Read the files in a zip in parallel, each worker thread with its own
+    handle on the zip
+
+    :param file_name: Path of the zip
+    :param read_member: Function taking a binary file object of one file in the zip
+    :param workers: Number of threads, UPLOAD_ARCHIVE_WORKERS by default
+    :return: List of the results of read_member, in file name order
+    """
+    def read(name):
+        with zipfile.ZipFile(file_name) as zip_file, zip_file.open(name) as member:
+            return read_member(member)
+
+    with ThreadPoolExecutor(max_workers=workers or settings.UPLOAD_ARCHIVE_WORKERS) as executor:
+        return list(executor.map(read, zip_members(file_name)))
+
+
+def load_json(fp):
+    """
+    Load JSON from a binary file object the way explore_ocds loads JSON uploads,
+    parsing it as it's read. JSON Lines or concatenated JSON of packages,
+    releases or records are merged into one package.
+
+    :raises ValueError: If the JSON isn't well formed
+    """
+    try:
+        values = BulkLoadHelpers().iter_json_items(fp, use_float=False, with_numbers=True)
+        first_values = list(islice(values, 2))
+        if len(first_values) == 1:
+            return first_values[0][1]
+        packages = UpsertDataHelpers().package_ocds_items(chain(first_values, values))
+        return merge_packages([package for number, package in packages])
+    except ijson.JSONError as err:
+        raise ValueError(str(err))
+
+
+def merge_packages(packages):
+    """
+    Merge release or record packages into the first one, adding the releases,
+    records and extensions of the others to it
+    """
+    merged = packages[0]
+    for package in packages[1:]:
+        if not isinstance(merged, dict) or not isinstance(package, dict):
+            raise ValueError("Each JSON file in a zip should have an object as the top level")
+        for key in ("releases", "records"):
+            if isinstance(package.get(key), list):
+                merged.setdefault(key, []).extend(package[key])
+        for extension in package.get("extensions") or []:
+            if extension not in merged.setdefault("extensions", []):
+                merged["extensions"].append(extension)
+    return merged
+
+
+def load_json_input(file_name, workers=None):
+    """
+    Load an uploaded JSON file, or the JSON files of a zip merged into one package
+
+    :raises ValueError: If the JSON isn't well formed, or can't be decompressed
+    """
+    try:
+        if is_zip(file_name):
+            return merge_packages(map_zip_members(file_name, load_json, workers=workers))
+        with open_input(file_name) as fp:
+            return load_json(fp)
+    except (OSError, EOFError, zipfile.BadZipFile, zlib.error) as err:
+        if not is_compressed(file_name):
+            raise
+        raise ValueError(f"Couldn't decompress {os.path.basename(file_name)}: {err}")
+
+
+def write_json_input(file_name, path):
+    """
+    Write an uploaded JSON file to path as one uncompressed package, for
+    tools that read a JSON file themselves. A compressed file is copied as
+    it's decompressed, but a zip or JSON Lines upload is merged into one
+    package in memory.
+
+    :param file_name: Path of the compressed or JSON Lines upload
+    :param path: Path to write the JSON to
+    """
+    if is_zip(file_name) or is_json_lines(file_name):
+        with open(path, "w", encoding="utf-8") as fp:
+            json.dump(load_json_input(file_name), fp, default=decimal_default, ensure_ascii=False)
+    else:
+        with open_input(file_name) as input_file, open(path, "wb") as fp:
+            shutil.copyfileobj(input_file, fp)
+
+
+def merge_csv_texts(texts):
+    """
+    Merge CSVs into one, with the columns of all of them
+
+    :param texts: List of CSV contents
+    :return: CSV text
+    """
+    header_lines = set(text.split("\n", 1)[0].rstrip("\r") for text in texts)
+    if len(header_lines) == 1:
+        # The same columns, so append the rows of the others without their header
+        merged = []
+        for i, text in enumerate(texts):
+            if i:
+                text = text.split("\n", 1)[1] if "\n" in text else ""
+            if text and not text.endswith("\n"):
+                text += "\n"
+            merged.append(text)
+        return "".join(merged)
+    dfs = [pd.read_csv(io.StringIO(text), dtype=str, keep_default_na=False) for text in texts]
+    return pd.concat(dfs, ignore_index=True, sort=False).to_csv(index=False)
@@ -0,0 +1,45 @@
+"""
+Command to time mapping a large simple CSV to flat OCDS
+"""
+import logging
+import time
+
+import pandas as pd
+from django.core.management import BaseCommand
+
+from silvereye.ocds_csv_mapper import CSVMapper, read_simple_csv
+
+logger = logging.getLogger('django')
+
+
+class Command(BaseCommand):
+    help = "Times CSVMapper on a simple CSV repeated to a given number of rows"
+
+    def add_arguments(self, parser):
+        parser.add_argument("file_path", help="Simple CSV to repeat, eg. an award notice CSV")
+        parser.add_argument("--rows", type=int, default=100000, help="Number of rows to benchmark")
+        parser.add_argument("--parse_dates", action='store_true',
+                            help="Include parsing dates, which is much slower than the other steps")
+
+    def handle(self, *args, **kwargs):
+        simple_df = pd.read_csv(kwargs["file_path"])
+        repeats = -(-kwargs["rows"] // len(simple_df))
+        df = pd.concat([simple_df] * repeats, ignore_index=True).iloc[:kwargs["rows"]]
+        mapper = CSVMapper(input_df=read_simple_csv(kwargs["file_path"]))
+
+        timings = []
+        start = time.perf_counter()
+        new_df = mapper.rename_friendly_cols_to_ocds_uri(df)
+        timings.append(("rename_friendly_cols_to_ocds_uri", time.perf_counter() - start))
+        if kwargs["parse_dates"]:
+            start = time.perf_counter()
+            new_df = mapper.parse_dates(new_df)
+            timings.append(("parse_dates", time.perf_counter() - start))
+        start = time.perf_counter()
+        mapper.augment_cols(new_df)
+        timings.append(("augment_cols", time.perf_counter() - start))
+
+        logger.info("%s %s notice rows, %s reference and default fields",
+                    len(df), mapper.release_type, len(mapper.augment_mappings))
+        for step, seconds in timings:
+            logger.info("%s: %.3fs", step, seconds)
@@ -2,24 +2,26 @@
 Command to create an generate publisher metrics
 """
 import argparse
+import hashlib
 import sys
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
+from functools import lru_cache
 import json
 import logging
 import os
 from os.path import join
-import urllib.request
 import shutil
-from random import random
 
 import pandas as pd
 import numpy as np
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
-from django.core.files.base import ContentFile, File
+from django.core.files.base import ContentFile
 from django.core.management import BaseCommand
 from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, transaction
 from django.template.defaultfilters import slugify
 from ocdskit.combine import combine_release_packages
 from flattentool import unflatten
@@ -28,9 +30,14 @@ from pandas.errors import EmptyDataError
 import silvereye
 from bluetail.helpers import UpsertDataHelpers
 from libcoveocds.config import LibCoveOCDSConfig
-from silvereye.helpers import update_publisher_monthly_counts, sync_with_s3, convert_simple_csv_submission
+from silvereye.helpers import update_submission_monthly_counts, sync_with_s3, convert_simple_csv_in_memory, \
+    refresh_queued_publisher_monthly_counts, invalidate_metrics_cache, get_package_monthly_buckets, \
+    process_s3_upload_outbox
+from silvereye.harvester import ContractsFinderHarvester
+from silvereye.lib.converters import SimpleCSVSubmission
 from silvereye.ocds_csv_mapper import CSVMapper
-from silvereye.models import Publisher, FileSubmission, FieldCoverage
+from silvereye.models import ContractsFinderPeriod, Publisher, FileSubmission, \
+    FieldCoverage
 
 logger = logging.getLogger('django')
 
@@ -41,9 +48,17 @@ WORKING_DIR = os.path.join(CF_DAILY_DIR, "working_files")
 SOURCE_DIR = os.path.join(WORKING_DIR, "source")
 CLEAN_OUTPUT_DIR = join(WORKING_DIR, "cleaned")
 SAMPLE_SUBMISSIONS_DIR = join(WORKING_DIR, "submissions")
+PARTITION_DIR = join(WORKING_DIR, "partitions")
+# Rows of a source CSV read at a time
+SOURCE_CHUNK_SIZE = 20000
 CF_MAPPINGS_FILE = os.path.join(SILVEREYE_DIR, "data", "csv_mappings", "contracts_finder_mappings.csv")
 OCDS_RELEASE_SCHEMA = join(SILVEREYE_DIR, "data", "OCDS", "1.1.4-release-schema.json")
 
+# Arbitrary key for the Postgres advisory locks on publisher names
+PUBLISHER_LOCK_ID = 5170602
+# Seed for the fake spend dates, so that runs produce the same spend data
+SPEND_SEED = 0
+
 cf_mapper = CSVMapper(mappings_file=CF_MAPPINGS_FILE)
 tender_mapper = CSVMapper(release_type="tender")
 award_mapper = CSVMapper(release_type="award")
@@ -70,71 +85,56 @@ def get_publisher_names():
     return publishers
 
 
-def set_scheme(row):
-    """
-    Get buyer scheme or use default 'GB-OO' for publisher scheme.
-
-    :param row: Row of CF dataframe
-    :return: str
-    """
-    buyer_scheme = row.get('releases/0/buyer/identifier/scheme')
-    if buyer_scheme and isinstance(buyer_scheme, str):
-        return buyer_scheme
-    else:
-        return "GB-OO"
-
-
-def create_uid(row):
+@lru_cache(maxsize=None)
+def publisher_slug(publisher_name):
     """
     Slugify publisher name to create publisher uid
 
-    :param row: Row of CF dataframe
+    :param publisher_name: Publisher name
     :return: str
     """
-    return slugify(row['publisher/name'])
+    return slugify(publisher_name)
 
 
-def set_uid(row):
+@lru_cache(maxsize=None)
+def publisher_ocid_prefix(slug):
     """
-    Get buyer id or slugified publisher name for publisher/uid
+    Fake OCID prefix made from the letters of a publisher slug
 
-    :param row: Row of CF dataframe
-    :return: str
+    :param slug: Slugified publisher name
+    :return: OCID prefix e.g. ocds-123456
     """
-    buyer_id = row.get('releases/0/buyer/identifier/id')
-    if buyer_id and isinstance(buyer_id, str):
-        return buyer_id
-    else:
-        return slugify(row['publisher/name'])
+    letter_numbers = [ord(char) - 96 for char in slug.replace('-', '')]
+    return 'ocds-' + ''.join(map(str, letter_numbers))[0:6]
 
 
-def set_uri(row):
+def non_empty_strings(df, column):
     """
-    Get buyer uri or create example from uid for publisher/uid
+    Mask of the rows where a column holds a non empty string
 
-    :param row: Row of CF dataframe
-    :return: buyer uri
+    :param df: CF dataframe
+    :param column: Column name, which may be missing from the dataframe
+    :return: Boolean Series
     """
-    buyer_uri = row.get('releases/0/buyer/identifier/uri')
-    if buyer_uri and isinstance(buyer_uri, str):
-        return buyer_uri
-    else:
-        return "http://www.example.com/" + row['publisher/uid']
+    if column not in df.columns or df[column].dtype != object:
+        return pd.Series(False, index=df.index)
+    return df[column].str.len().gt(0)
 
 
-def new_ocid_prefix(row):
+def publisher_slugs(names):
     """
-    Replace OCID with fake OCID prefix using publisher name
-
-    :param row: Row of CF dataframe
-    :return: OCID with new prefix
+    Slugify a Series of publisher names, once per distinct name
     """
-    ocid = row['releases/0/ocid']
-    ocid_prefix = get_ocid_prefix(ocid)
-    uid = create_uid(row)
-    new_ocid = [ord(char) - 96 for char in uid.replace('-', '')]
-    updated_ocid_prefix = 'ocds-' + ''.join(map(str, new_ocid))[0:6]
-    return ocid.replace(ocid_prefix, updated_ocid_prefix, 1)
+    codes, uniques = pd.factorize(names)
+    slugs = pd.Series(
+        np.array([publisher_slug(name) for name in uniques], dtype=object).take(codes),
+        index=names.index,
+    )
+    # factorize leaves out missing names
+    missing = codes < 0
+    if missing.any():
+        slugs[missing] = names[missing].map(publisher_slug)
+    return slugs
 
 
 def fix_contracts_finder_flat_csv(df):
@@ -145,37 +145,50 @@ def fix_contracts_finder_flat_csv(df):
         - Use the first buyer name in the release as the publisher name and
           create example publisher attributes
     """
-    cf_mapper = CSVMapper(mappings_file=CF_MAPPINGS_FILE)
     cols_list = cf_mapper.mappings_df["contracts_finder_daily_csv_path"].to_list()
-    fixed_df = df[df.columns.intersection(cols_list)]
+    fixed_df = df[df.columns.intersection(cols_list)].copy()
     fixed_df = fixed_df.rename(columns={
         'releases/0/tag/0': 'releases/0/tag'
     })
 
-    # Create example publisher attributes
+    # Create example publisher attributes, using the buyer identifier when there is one
     fixed_df['publisher/name'] = fixed_df['releases/0/buyer/name']
-    # fixed_df['publisher/scheme'] = fixed_df['releases/0/buyer/identifier/scheme']
-    # fixed_df['publisher/uid'] = str(fixed_df['releases/0/buyer/identifier/id'])
-    # fixed_df['publisher/scheme'] = "GB-OO"
-    fixed_df['publisher/scheme'] = fixed_df.apply(lambda row: set_scheme(row), axis=1)
-    fixed_df['publisher/uid'] = fixed_df.apply(lambda row: set_uid(row), axis=1)
-    fixed_df['publisher/uri'] = fixed_df.apply(lambda row: set_uri(row), axis=1)
-    fixed_df['releases/0/ocid'] = fixed_df.apply(lambda row: new_ocid_prefix(row), axis=1)
-    fixed_df['releases/0/id'] = fixed_df.apply(lambda row: row['releases/0/id'].replace('ocds-b5fd17-', ''), axis=1)
+    slugs = publisher_slugs(fixed_df['publisher/name'])
+    has_scheme = non_empty_strings(fixed_df, 'releases/0/buyer/identifier/scheme')
+    has_id = non_empty_strings(fixed_df, 'releases/0/buyer/identifier/id')
+    has_uri = non_empty_strings(fixed_df, 'releases/0/buyer/identifier/uri')
+    fixed_df['publisher/scheme'] = "GB-OO"
+    if has_scheme.any():
+        fixed_df.loc[has_scheme, 'publisher/scheme'] = fixed_df.loc[has_scheme, 'releases/0/buyer/identifier/scheme']
+    fixed_df['publisher/uid'] = slugs
+    if has_id.any():
+        fixed_df.loc[has_id, 'publisher/uid'] = fixed_df.loc[has_id, 'releases/0/buyer/identifier/id']
+    fixed_df['publisher/uri'] = "http://www.example.com/" + fixed_df['publisher/uid']
+    if has_uri.any():
+        fixed_df.loc[has_uri, 'publisher/uri'] = fixed_df.loc[has_uri, 'releases/0/buyer/identifier/uri']
+
+    # Replace the OCID prefix with a fake one made from the publisher name
+    ocid_rest = fixed_df['releases/0/ocid'].str.replace(r'^[^-]*(?:-[^-]*)?', '', n=1, regex=True)
+    fixed_df['releases/0/ocid'] = slugs.map(publisher_ocid_prefix) + ocid_rest
+    fixed_df['releases/0/id'] = fixed_df['releases/0/id'].str.replace('ocds-b5fd17-', '', regex=False)
 
     # CF does not move info from tender section to award section, so we need to do this
     # Set award title/desc from tender as CF don't include it
-    fixed_df.loc[fixed_df['releases/0/tag'] == 'award', 'releases/0/awards/0/title'] = fixed_df['releases/0/tender/title']
-    fixed_df.loc[fixed_df['releases/0/tag'] == 'award', 'releases/0/awards/0/description'] = fixed_df['releases/0/tender/description']
-    fixed_df.loc[fixed_df['releases/0/tag'] == 'award', 'awards/0/contractPeriod/startDate'] = fixed_df['releases/0/tender/milestones/0/dueDate']
-    fixed_df.loc[fixed_df['releases/0/tag'] == 'award', 'awards/0/contractPeriod/endDate'] = fixed_df['releases/0/tender/milestones/1/dueDate']
+    is_award = fixed_df['releases/0/tag'] == 'award'
+    fixed_df.loc[is_award, 'releases/0/awards/0/title'] = fixed_df['releases/0/tender/title']
+    fixed_df.loc[is_award, 'releases/0/awards/0/description'] = fixed_df['releases/0/tender/description']
+    fixed_df.loc[is_award, 'awards/0/contractPeriod/startDate'] = fixed_df['releases/0/tender/milestones/0/dueDate']
+    fixed_df.loc[is_award, 'awards/0/contractPeriod/endDate'] = fixed_df['releases/0/tender/milestones/1/dueDate']
 
     # Copy items to awards
-    for col in fixed_df.columns:
-        if "tender/items" in col:
-            fixed_df.loc[
-                fixed_df['releases/0/tag'] == 'award', col.replace("releases/0/tender/", "releases/0/awards/0/")] = \
-                fixed_df[col]
+    item_cols = [col for col in fixed_df.columns if "tender/items" in col]
+    award_item_cols = [col.replace("releases/0/tender/", "releases/0/awards/0/") for col in item_cols]
+    new_cols = [col for col in award_item_cols if col not in fixed_df.columns]
+    if new_cols:
+        fixed_df = pd.concat([fixed_df, pd.DataFrame(np.nan, index=fixed_df.index, columns=new_cols, dtype=object)],
+                             axis=1)
+    if item_cols and is_award.any():
+        fixed_df.loc[is_award, award_item_cols] = fixed_df.loc[is_award, item_cols].to_numpy()
 
     return fixed_df
 
@@ -260,13 +273,24 @@ def create_package_from_json(contracts_finder_id, package):
     supplied_data.original_file.save("release_package.json", ContentFile(json.dumps(package, indent=2)))
     supplied_data.save()
 
-    json_string = json.dumps(
-        package,
-        indent=2,
-        sort_keys=True,
-        cls=DjangoJSONEncoder
-    )
-    UpsertDataHelpers().upsert_ocds_data(json_string, supplied_data)
+    previous_buckets = get_package_monthly_buckets(package)
+    UpsertDataHelpers().upsert_ocds_package(package, supplied_data)
+    update_submission_monthly_counts(supplied_data, refresh=False, previous_buckets=previous_buckets)
+
+
+def update_or_create_publisher(publisher_name, defaults):
+    """
+    Update or create a Publisher by name, holding a lock on the name so that
+    parallel workers loading the same publisher don't create it twice
+
+    :param publisher_name: Publisher name
+    :param defaults: Publisher fields to set
+    :return: Tuple of publisher object and created boolean
+    """
+    with transaction.atomic():
+        with connections['default'].cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s))", [PUBLISHER_LOCK_ID, publisher_name])
+        return Publisher.objects.update_or_create(publisher_name=publisher_name, defaults=defaults)
 
 
 def create_publisher_from_package_json(package):
@@ -283,8 +307,8 @@ def create_publisher_from_package_json(package):
     publisher_uri = publisher.get("uri")
     ocid_prefix = get_ocid_prefix(package["releases"][0]["ocid"])
     logger.info("Creating or updating Publisher %s (id %s)", publisher_name, publisher_id)
-    publisher, created = Publisher.objects.update_or_create(
-        publisher_name=publisher_name,
+    publisher, created = update_or_create_publisher(
+        publisher_name,
         defaults={
             "publisher_name": publisher_name,
             "publisher_id": publisher_id,
@@ -292,7 +316,6 @@ def create_publisher_from_package_json(package):
             "uri": publisher_uri,
             "ocid_prefix": ocid_prefix
         }
-
     )
     return publisher
 
@@ -329,6 +352,180 @@ def get_date_boundaries(start_date, end_date, df, days=7):
     return zip(starts, starts[1:])
 
 
+def source_file_day(file_name):
+    """
+    Date of a Contracts Finder daily CSV from its file name, eg. 20200801.csv
+
+    :return: date or None
+    """
+    try:
+        return datetime.strptime(os.path.splitext(file_name)[0], "%Y%m%d").date()
+    except ValueError:
+        return None
+
+
+def period_source_days(start, end):
+    """
+    Days whose CSVs can hold notices published in the period (start, end].
+    Notices are filed by UK date, so a day either side of the period is included.
+    """
+    first = start.date() - timedelta(days=1)
+    return [first + timedelta(days=n) for n in range((end.date() - first).days + 2)]
+
+
+def preprocess_source_chunks(source_file_path, chunk_size=None):
+    """
+    Read and preprocess a Contracts Finder CSV a chunk at a time
+
+    :param source_file_path: Path of the CSV
+    :param chunk_size: Rows per chunk, SOURCE_CHUNK_SIZE by default
+    :return: Iterator of DataFrames
+    """
+    logger.info("Preprocessing %s", source_file_path)
+    try:
+        chunks = pd.read_csv(source_file_path, escapechar='\\', chunksize=chunk_size or SOURCE_CHUNK_SIZE)
+        for df in chunks:
+            fixed_df = fix_contracts_finder_flat_csv(df)
+            fixed_df = fixed_df.replace({np.nan: None})
+            fixed_df['publishedDate'] = pd.to_datetime(fixed_df['publishedDate'])
+            yield fixed_df
+    except pd.errors.EmptyDataError:
+        pass
+
+
+def filter_publishers(source_df, publisher_names):
+    if publisher_names:
+        named_publishers = source_df['publisher/name'].isin(publisher_names)
+        source_df = source_df[named_publishers]
+    return source_df
+
+
+def period_starts(published_dates):
+    """
+    Start of the weekly period (Monday, next Monday] that each published date falls in
+    """
+    shifted = pd.to_datetime(published_dates, utc=True) - pd.Timedelta(1, unit="ns")
+    return shifted.dt.floor("D") - pd.to_timedelta(shifted.dt.weekday, unit="D")
+
+
+def partition_source_files(file_list, periods, publisher_names, publisher_submissions, partition_dir,
+                           chunk_size=None):
+    """
+    Route the rows of Contracts Finder CSVs into partition files per period
+    and publisher, reading the CSVs a chunk at a time so that only one chunk
+    is held in memory
+
+    A partition is a list of pickled DataFrame parts, which keep the dtypes
+    of the preprocessed data. Files that fail to preprocess are left out
+    completely, as when they were read in one go.
+
+    :param file_list: Paths of the CSVs, in the order to process them
+    :param periods: Tuples of start and end of the periods to keep
+    :param publisher_names: List of names of publishers to keep
+    :param publisher_submissions: Partition by publisher as well as by period
+    :param partition_dir: Directory to write the partition files to
+    :param chunk_size: Rows to read at a time
+    :return: dict of (period start, publisher name or None) to the paths of its parts, in row order
+    """
+    remake_dir(partition_dir)
+    wanted_starts = set(start for start, end in periods)
+    partitions = {}
+    part_number = 0
+    for source_file_path in file_list:
+        file_parts = []
+        try:
+            for chunk in preprocess_source_chunks(source_file_path, chunk_size):
+                chunk = filter_publishers(chunk, publisher_names)
+                chunk_starts = period_starts(chunk['publishedDate'])
+                chunk = chunk[chunk_starts.isin(wanted_starts)]
+                if chunk.empty:
+                    continue
+                chunk_starts = chunk_starts[chunk.index]
+                if publisher_submissions:
+                    publisher_keys = chunk['publisher/name']
+                else:
+                    publisher_keys = pd.Series("", index=chunk.index)
+                for (start, publisher_name), part_df in chunk.groupby([chunk_starts, publisher_keys], sort=False):
+                    key = (start, publisher_name if publisher_submissions else None)
+                    part_number += 1
+                    part_path = join(partition_dir, f"part-{part_number:06}.pkl")
+                    part_df.to_pickle(part_path)
+                    file_parts.append((key, part_path))
+        except ValueError:
+            logger.exception("error preprocessing %s", source_file_path)
+            for key, part_path in file_parts:
+                os.remove(part_path)
+            continue
+        for key, part_path in file_parts:
+            partitions.setdefault(key, []).append(part_path)
+    return partitions
+
+
+def read_partition(part_paths):
+    return pd.concat([pd.read_pickle(part_path) for part_path in part_paths])
+
+
+def period_output_tasks(start, end, partitions, publisher_submissions, load_data):
+    """
+    Replace the output directory of one period and list the create_output_files
+    calls needed to fill it
+
+    :return: Tuple of the period directory and a list of tasks for run_output_task
+    """
+    period_dir = join(CLEAN_OUTPUT_DIR, start.strftime("%Y%m%d") + "-" + end.strftime("%Y%m%d"))
+    remake_dir(period_dir)
+
+    # If grouping by publisher, create the output files per publisher,
+    # otherwise create a combined file
+    period_partitions = [
+        (publisher_name, part_paths) for (period_start, publisher_name), part_paths in partitions.items()
+        if period_start == start
+    ]
+    if publisher_submissions:
+        tasks = [
+            (slugify(publisher_name), part_paths, period_dir, load_data)
+            for publisher_name, part_paths in period_partitions
+        ]
+    else:
+        part_paths = period_partitions[0][1] if period_partitions else []
+        tasks = [('all', part_paths, period_dir, load_data)]
+    return period_dir, tasks
+
+
+def run_output_task(task):
+    """
+    Create the output files for one partition, run in a worker process when there are several workers
+    """
+    name, part_paths, parent_directory, load_data = task
+    if part_paths:
+        df = read_partition(part_paths)
+    else:
+        df = pd.DataFrame(columns=['publishedDate', 'publisher/name', 'releases/0/tag'])
+    create_output_files(name, df, parent_directory, load_data)
+
+
+def run_output_tasks(tasks, workers=1):
+    """
+    Run the tasks for the partitions in order, or across a pool of worker
+    processes that each have their own database connection.
+    The output of each task doesn't depend on the others, so it is the same
+    whatever order the workers finish in.
+
+    :param tasks: Tasks from period_output_tasks
+    :param workers: Number of worker processes
+    """
+    if not workers or workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            run_output_task(task)
+        return
+    # Forked workers mustn't share the connection of this process, they open their own
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Consume the results in order so that the first error is raised
+        for result in executor.map(run_output_task, tasks):
+            pass
+
+
 def process_contracts_finder_csv(publisher_names, start_date, end_date, options=None, file_path=None):
     """
     Load Contracts Finder API flat CSV output from the source directory,
@@ -336,6 +533,9 @@ def process_contracts_finder_csv(publisher_names, start_date, end_date, options=
     submission files if passed the publisher_submissions boolean option and
     load it into the database if passed the load_data boolean option
 
+    Only the periods whose source days or options have changed since they were
+    last processed are processed again, unless passed the force option.
+
     :param publisher_names: List of names of publishers to preprocess
     :param start_date: first date on which data might appear
     :param end_date: last date on which data might appear
@@ -346,113 +546,151 @@ def process_contracts_finder_csv(publisher_names, start_date, end_date, options=
         options = {}
     publisher_submissions = options['publisher_submissions']
     load_data = options['load_data']
-    source_data = []
-    file_list = []
-
-    # Prepare list of CSVs to process
-    if file_path:
-        file_list = [file_path]
-    else:
-        for file_name in os.listdir(SOURCE_DIR):
-            if file_name.endswith(".csv"):
-                source_file_path = join(SOURCE_DIR, file_name)
-                if file_name < start_date.replace("-", "") or file_name > end_date.replace("-", ""):
-                    continue
-                else:
-                    file_list.append(source_file_path)
-                    file_list.sort()
+    workers = options.get('workers') or 1
 
-    # Preprocess and merge all the CSV files into one dataframe
-    for source_file_path in file_list:
+    if file_path and not start_date:
         try:
-            logger.info("Preprocessing %s", source_file_path)
-            df = pd.read_csv(source_file_path, escapechar='\\')
-            fixed_df = fix_contracts_finder_flat_csv(df)
-            fixed_df = fixed_df.replace({np.nan: None})
-            fixed_df['publishedDate'] = pd.to_datetime(fixed_df['publishedDate'])
-            source_data.append(fixed_df)
-        except pd.errors.EmptyDataError:
-            pass
+            source_data = [
+                filter_publishers(chunk, publisher_names) for chunk in preprocess_source_chunks(file_path)
+            ]
         except ValueError:
-            logger.exception("error preprocessing %s", source_file_path)
+            logger.exception("error preprocessing %s", file_path)
+            return
+        if not source_data:
+            logger.info("No data in %s", file_path)
+            return
+        file_name = os.path.basename(file_path)
+        create_output_files(file_name, pd.concat(source_data), CLEAN_OUTPUT_DIR, load_data)
+        return
 
-    source_df = pd.concat(source_data, ignore_index=True)
+    if file_path:
+        periods = list(get_date_boundaries(start_date, end_date, None))
+        partitions = partition_source_files([file_path], periods, publisher_names, publisher_submissions,
+                                            PARTITION_DIR)
+        tasks = []
+        for start, end in periods:
+            period_dir, period_tasks = period_output_tasks(start, end, partitions, publisher_submissions, load_data)
+            tasks.extend(period_tasks)
+        run_output_tasks(tasks, workers)
+        shutil.rmtree(PARTITION_DIR, ignore_errors=True)
+        return
 
-    # Used to create CF mappings
-    # source_combined_path = os.path.join(WORKING_DIR, "combined.csv")
-    # source_df.to_csv(source_combined_path, index=False)
+    # Checksums of the CSVs in the range
+    source_files = {}
+    for file_name in os.listdir(SOURCE_DIR):
+        day = source_file_day(file_name)
+        if file_name.endswith(".csv") and day:
+            if file_name < start_date.replace("-", "") or file_name > end_date.replace("-", ""):
+                continue
+            source_files[day] = join(SOURCE_DIR, file_name)
+    source_hashes = ContractsFinderHarvester(SOURCE_DIR).checksums(source_files)
+
+    # Find the periods whose source days or options changed since they were processed
+    options_key = json.dumps([publisher_names, bool(publisher_submissions), bool(load_data)])
+    processed_periods = {
+        (period.start, period.end): period.source_hash
+        for period in ContractsFinderPeriod.objects.filter(
+            end__gte=datetime.strptime(start_date, "%Y-%m-%d").date()
+        )
+    }
+    periods = []
+    for start, end in get_date_boundaries(start_date, end_date, None):
+        sha256 = hashlib.sha256(options_key.encode())
+        for day in period_source_days(start, end):
+            sha256.update(f"{day}:{source_hashes.get(day, '')}".encode())
+        source_hash = sha256.hexdigest()
+        if options.get("force") or processed_periods.get((start.date(), end.date())) != source_hash:
+            periods.append((start, end, source_hash))
+
+    if not periods:
+        logger.info("No new or changed Contracts Finder days to process")
+        return
+    logger.info("Processing %s of the periods from %s to %s", len(periods), start_date, end_date)
 
-    # Filter for publisher names
+    # Preprocess only the days that the affected periods are made from
+    needed_days = set()
+    for start, end, source_hash in periods:
+        needed_days.update(period_source_days(start, end))
+    file_list = [source_files[day] for day in sorted(needed_days) if day in source_files]
     if publisher_names:
         logger.info("Filtering for named publishers")
-        named_publishers = source_df['publisher/name'].isin(publisher_names)
-        source_df = source_df[named_publishers]
+    partitions = partition_source_files(file_list, [(start, end) for start, end, source_hash in periods],
+                                        publisher_names, publisher_submissions, PARTITION_DIR)
 
-    if not start_date:
-        file_name = os.path.basename(file_path)
-        create_output_files(file_name, source_df, CLEAN_OUTPUT_DIR, load_data)
-        return
+    tasks = []
+    for start, end, source_hash in periods:
+        period_dir, period_tasks = period_output_tasks(start, end, partitions, publisher_submissions, load_data)
+        tasks.extend(period_tasks)
+    run_output_tasks(tasks, workers)
 
-    # Get the date boundaries to use for package files
-    date_boundaries = get_date_boundaries(start_date, end_date, source_df)
-
-    # Filter the data according to those boundaries
-    for start, end in date_boundaries:
-        period_dir = join(CLEAN_OUTPUT_DIR, start.strftime("%Y%m%d") + "-" + end.strftime("%Y%m%d"))
-        os.makedirs(period_dir)
-        boundary_mask = (source_df['publishedDate'] > start) & (source_df['publishedDate'] <= end)
-        period_df = source_df.loc[boundary_mask]
-
-        # If grouping by publisher, create the output files per publisher,
-        # otherwise create a combined file
-        if publisher_submissions:
-            for publisher_name in period_df['publisher/name'].unique():
-                publisher_df = period_df[period_df['publisher/name'] == publisher_name]
-                directory_name = slugify(publisher_name)
-                create_output_files(directory_name, publisher_df, period_dir, load_data)
-        else:
-            create_output_files('all', period_df, period_dir, load_data)
+    for start, end, source_hash in periods:
+        ContractsFinderPeriod.objects.update_or_create(
+            start=start.date(),
+            end=end.date(),
+            defaults={
+                "source_hash": source_hash,
+            }
+        )
+    shutil.rmtree(PARTITION_DIR, ignore_errors=True)
+
+
+def spend_day_offsets(ids, seed=SPEND_SEED):
+    """
+    Two pseudo-random offsets of 10 to 19 days for each release id, the same
+    for an id on every run whatever else is in the dataframe
+
+    :param ids: Series of release ids
+    :param seed: Seed for the offsets
+    :return: Tuple of two integer arrays
+    """
+    hashes = pd.util.hash_pandas_object(ids, index=False, hash_key=f"{seed:016d}"[-16:]).to_numpy()
+    return (hashes % 10 + 10).astype(int), (hashes // 10 % 10 + 10).astype(int)
 
 
-# Augment award with transaction
-def augment_award_row_with_spend(row):
+def augment_awards_with_spend(award_df, seed=SPEND_SEED):
     """
-    Take a row of CF dataframe and append columns with fake spend data generated from the award fields
+    Take award rows of CF dataframe and return rows with fake spend data generated from the award fields
 
-    :param row: Row of CF dataframe
-    :return: Row of CF dataframe with new columns for transactions
+    :param award_df: Award rows of CF dataframe
+    :param seed: Seed for the random dates
+    :return: CF dataframe of implementation releases with new columns for transactions
     """
-    row["releases/0/tag"] = "implementation"
+    spend_df = award_df.copy()
+    date_format = '%Y-%m-%dT%H:%M:%SZ'
+    publish_days, transaction_days = spend_day_offsets(spend_df["releases/0/id"], seed)
+
+    spend_df["releases/0/tag"] = "implementation"
     # Change IDs
-    row["releases/0/ocid"] += "_trans1"
-    row["releases/0/id"] += "_trans1"
+    spend_df["releases/0/ocid"] = spend_df["releases/0/ocid"] + "_trans1"
+    spend_df["releases/0/id"] = spend_df["releases/0/id"] + "_trans1"
     # Set published date some time later than award
-    days_between_publishing_award_and_spend = int(random() * 10) + 10
-    award_pub_datetime = datetime.strptime(row["releases/0/date"], '%Y-%m-%dT%H:%M:%SZ')
-    trans_pub_datetime = datetime.strftime(
-        award_pub_datetime + relativedelta(days=days_between_publishing_award_and_spend), '%Y-%m-%dT%H:%M:%SZ')
-    row["releases/0/date"] = trans_pub_datetime
-    row["publishedDate"] = trans_pub_datetime
+    award_published = pd.to_datetime(spend_df["releases/0/date"], format=date_format)
+    spend_published = (award_published + pd.to_timedelta(publish_days, unit="D")).dt.strftime(date_format)
+    spend_df["releases/0/date"] = spend_published
+    spend_df["publishedDate"] = spend_published
     # Set Transaction date
-    days_between_awarded_date_and_trans_date = int(random() * 10) + 10
-    awarded_datetime = datetime.strptime(row["releases/0/awards/0/date"], '%Y-%m-%dT%H:%M:%SZ')
-    trans_datetime = datetime.strftime(awarded_datetime + relativedelta(days=days_between_awarded_date_and_trans_date),
-                                       '%Y-%m-%dT%H:%M:%SZ')
-    row["releases/0/contracts/0/implementation/transactions/0/date"] = trans_datetime
+    awarded = pd.to_datetime(spend_df["releases/0/awards/0/date"], format=date_format)
+    spend_df["releases/0/contracts/0/implementation/transactions/0/date"] = \
+        (awarded + pd.to_timedelta(transaction_days, unit="D")).dt.strftime(date_format)
     # Copy award value to transaction
-    row["releases/0/contracts/0/implementation/transactions/0/value/amount"] = row["releases/0/awards/0/value/amount"]
-    row["releases/0/contracts/0/implementation/transactions/0/value/currency"] = row["releases/0/awards/0/value/currency"]
+    spend_df["releases/0/contracts/0/implementation/transactions/0/value/amount"] = \
+        spend_df["releases/0/awards/0/value/amount"]
+    spend_df["releases/0/contracts/0/implementation/transactions/0/value/currency"] = \
+        spend_df["releases/0/awards/0/value/currency"]
     # Copy items to contract
-    for col, value in row.items():
-        if "tender/items" in col:
-            row[col.replace("releases/0/tender/", "releases/0/contracts/0/")] = row[col]
+    item_cols = [col for col in award_df.columns if "tender/items" in col]
+    contract_items = spend_df[item_cols]
+    contract_items.columns = [col.replace("releases/0/tender/", "releases/0/contracts/0/") for col in item_cols]
+    spend_df = spend_df.drop(columns=[col for col in contract_items.columns if col in spend_df.columns])
+    spend_df = pd.concat([spend_df, contract_items], axis=1)
 
-    uri = row["uri"]
-    contracts_finder_id = os.path.splitext(os.path.split(uri)[1])[0]
-    spend_contracts_finder_id = contracts_finder_id[:-4] + "1234"
-    row["uri"] = row["uri"].replace(contracts_finder_id, spend_contracts_finder_id)
+    contracts_finder_ids = [os.path.splitext(os.path.split(uri)[1])[0] for uri in spend_df["uri"]]
+    spend_df["uri"] = [
+        uri.replace(contracts_finder_id, contracts_finder_id[:-4] + "1234")
+        for uri, contracts_finder_id in zip(spend_df["uri"], contracts_finder_ids)
+    ]
 
-    return row
+    return spend_df
 
 
 def create_output_files(name, df, parent_directory, load_data, unflatten_contracts_finder_data=False):
@@ -476,19 +714,15 @@ def create_output_files(name, df, parent_directory, load_data, unflatten_contrac
 
         release_name = name + "-" + release_type
         output_dir = join(parent_directory, release_name)
-        os.makedirs(output_dir)
+        remake_dir(output_dir)
         json_file_path = join(output_dir, release_name + ".json")
 
         # Filter the DataFrame
         if release_type == "spend":
             # Use award data and add fake spend
             df_release_type = df[df['releases/0/tag'] == "award"]
-            spend_df = pd.DataFrame()
-            for i, row in df_release_type.iterrows():
-                rowdf = df_release_type.loc[[i]]
-                new_row_df = rowdf.apply(augment_award_row_with_spend, axis=1)
-                spend_df = spend_df.append(new_row_df)
             if not df_release_type.empty:
+                spend_df = augment_awards_with_spend(df_release_type)
                 df_release_type = spend_df.loc[spend_df["publishedDate"] < str(datetime.now())]
         else:
             df_release_type = df[df['releases/0/tag'] == release_type]
@@ -515,7 +749,9 @@ def create_output_files(name, df, parent_directory, load_data, unflatten_contrac
                 ocds_mapper = spend_mapper
             # ocds_mapper = CSVMapper(release_type=release_type)
             simple_csv_df = ocds_mapper.output_simple_csv(ocds_1_1_release_df)
-            simple_csv_df.to_csv(open(simple_csv_file_path, "w"), index=False, header=True)
+            simple_csv_text = simple_csv_df.to_csv(index=False, header=True)
+            with open(simple_csv_file_path, "w") as simple_csv_file:
+                simple_csv_file.write(simple_csv_text)
 
             # Upload simple CSV to DB
             if load_data:
@@ -533,8 +769,8 @@ def create_output_files(name, df, parent_directory, load_data, unflatten_contrac
                     contact_email = df_release_type.iloc[0]["releases/0/buyer/contactPoint/email"]
                     contact_telephone = df_release_type.iloc[0]["releases/0/buyer/contactPoint/telephone"]
 
-                    publisher, created = Publisher.objects.update_or_create(
-                        publisher_name=publisher_name,
+                    publisher, created = update_or_create_publisher(
+                        publisher_name,
                         defaults={
                             "publisher_name": publisher_name,
                             "publisher_id": publisher_id,
@@ -565,14 +801,15 @@ def create_output_files(name, df, parent_directory, load_data, unflatten_contrac
                     supplied_data.created = published_date
                     if supplied_data.original_file and os.path.exists(supplied_data.original_file.path):
                         os.remove(supplied_data.original_file.path)
-                    supplied_data.original_file.save(simple_csv_file_name, File(open(simple_csv_file_path)))
+                    supplied_data.original_file.save(simple_csv_file_name, ContentFile(simple_csv_text))
                     supplied_data.save()
 
                     if settings.STORE_OCDS_IN_S3:
                         sync_with_s3(supplied_data)
 
                     # Store field coverage
-                    simple_csv_mapper = CSVMapper(csv_path=simple_csv_file_path)
+                    submission = SimpleCSVSubmission(text=simple_csv_text)
+                    simple_csv_mapper = submission.mapper
                     coverage_context = simple_csv_mapper.get_coverage_context()
                     average_field_completion = coverage_context.get("average_field_completion")
                     FieldCoverage.objects.update_or_create(
@@ -583,16 +820,20 @@ def create_output_files(name, df, parent_directory, load_data, unflatten_contrac
                             "spend_field_coverage": average_field_completion if simple_csv_mapper.release_type == "spend" else None,
                         }
                     )
+                    invalidate_metrics_cache()
 
                     lib_cove_ocds_config = LibCoveOCDSConfig()
 
-                    conversion_context = convert_simple_csv_submission(
-                        supplied_data,
+                    # Convert in memory, the review page converts the original file again if it's opened
+                    conversion = convert_simple_csv_in_memory(
+                        submission,
+                        publisher,
                         lib_cove_ocds_config,
-                        OCDS_RELEASE_SCHEMA
+                        OCDS_RELEASE_SCHEMA,
                     )
-                    converted_path = conversion_context.get("converted_path")
-                    UpsertDataHelpers().upsert_ocds_data(converted_path, supplied_data)
+                    previous_buckets = get_package_monthly_buckets(conversion["package"])
+                    UpsertDataHelpers().upsert_ocds_package(conversion["package"], supplied_data)
+                    update_submission_monthly_counts(supplied_data, refresh=False, previous_buckets=previous_buckets)
                 except FileNotFoundError:
                     logger.exception("Error loading data for %s in %s", name, parent_directory)
 
@@ -625,19 +866,29 @@ class Command(BaseCommand):
         parser.add_argument("--publisher_submissions", action='store_true',
                             help="Group data into publisher submissions")
         parser.add_argument("--load_data", action='store_true', help="Load data into database")
+        parser.add_argument("--force", action='store_true',
+                            help="Process every period in the range, even if its days haven't changed")
+        parser.add_argument("--download_workers", type=int,
+                            help="Number of days to download at once, CONTRACTS_FINDER_HARVESTER_WORKERS by default")
+        parser.add_argument("--workers", type=int, default=1,
+                            help="Number of processes creating and loading the output files")
 
     def handle(self, *args, **kwargs):
         """handle get_cf_data"""
 
         publisher_names = get_publisher_names()
-        remake_dir(SOURCE_DIR)
-        remake_dir(CLEAN_OUTPUT_DIR)
-        remake_dir(SAMPLE_SUBMISSIONS_DIR)
+        # SOURCE_DIR is kept between runs as a cache of the downloaded days
+        os.makedirs(SOURCE_DIR, exist_ok=True)
+        # Outputs are kept between runs, only the periods with new or changed days are replaced
+        os.makedirs(CLEAN_OUTPUT_DIR, exist_ok=True)
+        os.makedirs(SAMPLE_SUBMISSIONS_DIR, exist_ok=True)
         file_path = kwargs.get("file_path")
 
         options = {
             'publisher_submissions': kwargs.get("publisher_submissions"),
-            'load_data': kwargs.get("load_data")
+            'load_data': kwargs.get("load_data"),
+            'force': kwargs.get("force"),
+            'workers': kwargs.get("workers"),
         }
 
         start_date = kwargs.get("start_date")
@@ -655,24 +906,26 @@ class Command(BaseCommand):
             elif file_path.endswith(".csv"):
                 shutil.copy(file_path, SOURCE_DIR)
         if start_date:
-            daterange = pd.date_range(start_date, end_date)
             logger.info("Downloading needed Contracts Finder data from %s to %s", start_date, end_date)
-            for date in daterange:
-                date_string = f"{date.year}/{date.month:02}/{date.day:02}"
-                save_path = join(SOURCE_DIR, slugify(date_string) + ".csv")
-                url = f"https://www.contractsfinder.service.gov.uk/Harvester/Notices/Data/CSV/{date_string}"
-
-                try:
-                    if not os.path.exists(save_path):
-                        urllib.request.urlretrieve(url, save_path)
-                        logger.info("Downloading URL: %s", url)
-                except TypeError:
-                    logger.exception("Error with URL: %s", url)
+            harvester = ContractsFinderHarvester(SOURCE_DIR, workers=kwargs.get("download_workers"))
+            counts = harvester.harvest(
+                datetime.strptime(start_date, "%Y-%m-%d").date(),
+                datetime.strptime(end_date, "%Y-%m-%d").date(),
+            )
+            logger.info("Contracts Finder days downloaded: %(downloaded)s, unchanged: %(unchanged)s, "
+                        "already cached: %(cached)s, failed: %(failed)s", counts)
         else:
             self.print_help('manage.py', '<your command name>')
             sys.exit()
 
         process_contracts_finder_csv(publisher_names, start_date, end_date, options, file_path)
 
-        # Update publisher metrics
-        update_publisher_monthly_counts()
+        # Update publisher metrics for all the months queued by the loaded submissions in one run,
+        # use the update_publisher_metrics command for a full rebuild
+        refresh_queued_publisher_monthly_counts(force=True)
+
+        if settings.STORE_OCDS_IN_S3:
+            # Upload the submissions saved by this run before its local files are lost,
+            # when it runs somewhere other than the web process's upload_to_s3
+            counts = process_s3_upload_outbox()
+            logger.info("Uploaded %s files to S3, %s failed", counts["uploaded"], counts["failed"])
@@ -4,10 +4,10 @@ Command to import authority types from external sources
 import os
 
 from django.core.management import BaseCommand
-import pandas as pd
-import numpy as np
 
 import silvereye
+from bluetail.helpers import BulkLoadHelpers
+from silvereye.helpers import link_publisher_authority_types
 from silvereye.models import AuthorityType
 
 SILVEREYE_DIR = silvereye.__path__[0]
@@ -20,17 +20,19 @@ class Command(BaseCommand):
 
         csv_url = 'https://github.com/ajparsons/uk_local_authority_names_and_codes/raw/master/uk_local_authorities.csv'
         csv_path = os.path.join(SILVEREYE_DIR, "data", "uk_local_authorities.csv")
-        df = pd.read_csv(csv_path)
-        df = df.fillna("")
-        # df = df.replace({np.nan:None})
-
-        for i, la in df.iterrows():
-            _, created = AuthorityType.objects.get_or_create(
-                authority_name=la['official-name'],
-                authority_type=la['local-authority-type-name'],
+
+        bulk_load = BulkLoadHelpers()
+        authority_types = (
+            AuthorityType(
+                authority_name=la['official-name'] or "",
+                authority_type=la['local-authority-type-name'] or "",
                 source=csv_url,
             )
-            if created:
-                self.stdout.write(f"Created new AuthorityType for {la['official-name']}")
-            else:
-                self.stdout.write(f"Found existing AuthorityType for {la['official-name']}")
+            for la in bulk_load.iter_csv_rows(csv_path)
+        )
+        counts = bulk_load.load(AuthorityType, authority_types, ['authority_name', 'authority_type', 'source'])
+        self.stdout.write(f"Created {counts['created']} new AuthorityTypes, "
+                          f"found {counts['existing']} existing")
+
+        linked = link_publisher_authority_types()
+        self.stdout.write(f"Linked {linked} publishers to their AuthorityType")
@@ -5,13 +5,20 @@ import logging
 
 from django.core.management import BaseCommand
 
-from silvereye.helpers import update_publisher_monthly_counts
+from silvereye.helpers import rebuild_publisher_monthly_counts, refresh_queued_publisher_monthly_counts
 
 logger = logging.getLogger('django')
 
 
 class Command(BaseCommand):
-    help = "Updates publisher metrics"
+    help = "Rebuilds publisher metrics for every publisher and month"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--queued", action='store_true',
+                            help="Only refresh the publisher months queued by recent submissions")
 
     def handle(self, *args, **kwargs):
-        update_publisher_monthly_counts()
+        if kwargs.get("queued"):
+            refresh_queued_publisher_monthly_counts(force=True)
+        else:
+            rebuild_publisher_monthly_counts()
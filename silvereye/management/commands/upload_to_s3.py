@@ -0,0 +1,38 @@
+"""
+Command to upload submitted files queued in the S3 outbox
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand
+
+from silvereye.helpers import process_s3_upload_outbox, retry_failed_s3_uploads
+
+logger = logging.getLogger('django')
+
+
+class Command(BaseCommand):
+    help = "Uploads submitted files to S3 in the background, retrying failed uploads"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action='store_true',
+                            help="Upload the files that are due and exit, instead of polling")
+        parser.add_argument("--interval", type=int, default=10,
+                            help="Seconds to wait between polls of the outbox")
+        parser.add_argument("--retry-failed", action='store_true',
+                            help="Queue the uploads that were given up on to be tried again first")
+
+    def handle(self, *args, **kwargs):
+        if not settings.STORE_OCDS_IN_S3:
+            logger.info("STORE_OCDS_IN_S3 isn't set, so there is nothing to upload")
+            return
+        if kwargs.get("retry_failed"):
+            logger.info("Queued %s failed uploads to be retried", retry_failed_s3_uploads())
+        while True:
+            counts = process_s3_upload_outbox()
+            if counts["uploaded"] or counts["failed"]:
+                logger.info("Uploaded %s files to S3, %s failed", counts["uploaded"], counts["failed"])
+            if kwargs.get("once"):
+                return
+            time.sleep(kwargs["interval"])
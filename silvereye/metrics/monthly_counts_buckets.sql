@@ -0,0 +1,36 @@
+DELETE
+FROM silvereye_publishermonthlycounts m
+    USING unnest(%(publisher_ids)s::integer[], %(months)s::date[]) AS bucket (publisher_id, date)
+WHERE m.publisher_id = bucket.publisher_id
+  AND m.date = bucket.date
+  AND NOT EXISTS(
+      SELECT 1
+      FROM silvereye_publishercountsrollup r
+      WHERE r.grain = 'month'
+        AND r.publisher_id = m.publisher_id
+        AND r.date = m.date
+  );
+
+INSERT
+INTO silvereye_publishermonthlycounts
+(date,
+ count_tenders,
+ count_awards,
+ count_spend,
+ publisher_id)
+SELECT date,
+       count_tenders,
+       count_awards,
+       count_spend,
+       publisher_id
+FROM silvereye_publishercountsrollup
+WHERE grain = 'month'
+  AND (publisher_id, date) IN (
+      SELECT publisher_id, date
+      FROM unnest(%(publisher_ids)s::integer[], %(months)s::date[]) AS bucket (publisher_id, date)
+  )
+ON CONFLICT (publisher_id, date)
+DO UPDATE SET
+        count_tenders=excluded.count_tenders,
+        count_awards=excluded.count_awards,
+        count_spend=excluded.count_spend
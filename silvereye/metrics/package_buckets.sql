@@ -0,0 +1,20 @@
+SELECT DISTINCT sf.publisher_id,
+                DATE_TRUNC('month', TO_DATE(rel.release_json ->> 'date', 'YYYY-MM-DD'))::date as date
+from bluetail_ocds_release_json rel
+         INNER JOIN bluetail_ocds_package_data_json pac ON (rel.package_data_id = pac.id)
+         INNER JOIN silvereye_filesubmission sf on (pac.supplied_data_id = sf.supplied_data_id)
+where (rel.ocid, rel.release_id) IN (
+      SELECT ocid, release_id
+      FROM unnest(%(ocids)s::text[], %(release_ids)s::text[]) AS release (ocid, release_id)
+  )
+  and rel.release_json ->> 'date' notnull
+  and sf.publisher_id notnull
+UNION
+SELECT DISTINCT sf.publisher_id,
+                DATE_TRUNC('month', TO_DATE(rec.record_json -> 'compiledRelease' ->> 'date', 'YYYY-MM-DD'))::date as date
+from bluetail_ocds_record_json rec
+         INNER JOIN bluetail_ocds_package_data_json pac ON (rec.package_data_id = pac.id)
+         INNER JOIN silvereye_filesubmission sf on (pac.supplied_data_id = sf.supplied_data_id)
+where rec.ocid = ANY(%(record_ocids)s::text[])
+  and rec.record_json -> 'compiledRelease' ->> 'date' notnull
+  and sf.publisher_id notnull
@@ -0,0 +1,35 @@
+WITH target as (
+    select id
+    from silvereye_publisher_metadata
+    where %(publisher_ids)s::integer[] IS NULL
+       or id = ANY(%(publisher_ids)s::integer[])
+),
+submissions as (
+    select sf.publisher_id,
+           COUNT(DISTINCT sup.id) as submission_count,
+           MAX(sup.created)       as last_submission_at
+    from silvereye_filesubmission sf
+             INNER JOIN target on sf.publisher_id = target.id
+             INNER JOIN input_supplieddata sup on sf.supplied_data_id = sup.id
+    where exists(select 1 from bluetail_ocds_package_data_json pac where pac.supplied_data_id = sup.id)
+    group by sf.publisher_id
+),
+releases as (
+    select sf.publisher_id,
+           COUNT(*)                                                as release_count,
+           MAX(TO_DATE(rel.release_json ->> 'date', 'YYYY-MM-DD')) as last_release_date
+    from bluetail_ocds_release_json_view rel
+             INNER JOIN bluetail_ocds_package_data_json pac ON (rel.package_data_id = pac.id)
+             INNER JOIN silvereye_filesubmission sf on (pac.supplied_data_id = sf.supplied_data_id)
+             INNER JOIN target on sf.publisher_id = target.id
+    group by sf.publisher_id
+)
+UPDATE silvereye_publisher_metadata pub
+SET submission_count   = COALESCE(submissions.submission_count, 0),
+    last_submission_at = submissions.last_submission_at,
+    release_count      = COALESCE(releases.release_count, 0),
+    last_release_date  = releases.last_release_date
+FROM target
+         LEFT JOIN submissions on target.id = submissions.publisher_id
+         LEFT JOIN releases on target.id = releases.publisher_id
+WHERE pub.id = target.id
@@ -0,0 +1,64 @@
+DELETE
+FROM silvereye_publishercountsrollup;
+
+INSERT
+INTO silvereye_publishercountsrollup
+(publisher_id,
+ grain,
+ date,
+ count_tenders,
+ count_awards,
+ count_spend)
+SELECT pub.id,
+       'day',
+       TO_DATE(release_json ->> 'date', 'YYYY-MM-DD'),
+       SUM(CASE WHEN release_json -> 'tag' ->> 0 = 'tender' THEN 1 ELSE 0 END),
+       SUM(CASE WHEN release_json -> 'tag' ->> 0 = 'award' THEN 1 ELSE 0 END),
+       SUM(CASE WHEN release_json -> 'tag' ->> 0 = 'implementation' THEN 1 ELSE 0 END)
+from bluetail_ocds_release_json_view rel
+         LEFT JOIN bluetail_ocds_package_data_view pac ON (rel.package_data_id = pac.id)
+         LEFT JOIN input_supplieddata sup on (pac.supplied_data_id = sup.id)
+         INNER JOIN silvereye_filesubmission sf on sup.id = sf.supplied_data_id
+         INNER JOIN silvereye_publisher_metadata pub on sf.publisher_id = pub.id
+where rel.package_data_id notnull
+  and release_json ->> 'date' notnull
+group by pub.id,
+         TO_DATE(release_json ->> 'date', 'YYYY-MM-DD');
+
+INSERT
+INTO silvereye_publishercountsrollup
+(publisher_id,
+ grain,
+ date,
+ count_tenders,
+ count_awards,
+ count_spend)
+SELECT publisher_id,
+       'month',
+       DATE_TRUNC('month', date)::date,
+       SUM(count_tenders),
+       SUM(count_awards),
+       SUM(count_spend)
+FROM silvereye_publishercountsrollup
+WHERE grain = 'day'
+GROUP BY publisher_id,
+         DATE_TRUNC('month', date);
+
+INSERT
+INTO silvereye_publishercountsrollup
+(publisher_id,
+ grain,
+ date,
+ count_tenders,
+ count_awards,
+ count_spend)
+SELECT publisher_id,
+       'year',
+       DATE_TRUNC('year', date)::date,
+       SUM(count_tenders),
+       SUM(count_awards),
+       SUM(count_spend)
+FROM silvereye_publishercountsrollup
+WHERE grain = 'month'
+GROUP BY publisher_id,
+         DATE_TRUNC('year', date)
@@ -0,0 +1,7 @@
+SELECT DISTINCT sf.publisher_id,
+                DATE_TRUNC('month', TO_DATE(release_json ->> 'date', 'YYYY-MM-DD'))::date as date
+from bluetail_ocds_release_json_view rel
+         INNER JOIN bluetail_ocds_package_data_json pac ON (rel.package_data_id = pac.id)
+         INNER JOIN silvereye_filesubmission sf on (pac.supplied_data_id = sf.supplied_data_id)
+where pac.supplied_data_id = ANY(%(supplied_data_ids)s::uuid[])
+  and sf.publisher_id notnull
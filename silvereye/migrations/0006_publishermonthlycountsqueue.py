@@ -0,0 +1,26 @@
+# Generated by Django 2.2.16 on 2020-09-15 09:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('silvereye', '0005_authoritytype'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PublisherMonthlyCountsQueue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('queued_at', models.DateTimeField(auto_now_add=True)),
+                ('publisher', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='silvereye.Publisher')),
+            ],
+            options={
+                'unique_together': {('publisher', 'date')},
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.16 on 2020-09-16 11:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('silvereye', '0006_publishermonthlycountsqueue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PublisherCountsRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('grain', models.CharField(choices=[('day', 'Day'), ('month', 'Month'), ('year', 'Year')], max_length=8)),
+                ('date', models.DateField(help_text='First day of the day, month or year')),
+                ('count_tenders', models.IntegerField(default=0)),
+                ('count_awards', models.IntegerField(default=0)),
+                ('count_spend', models.IntegerField(default=0)),
+                ('publisher', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='silvereye.Publisher')),
+            ],
+            options={
+                'unique_together': {('publisher', 'grain', 'date')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='publishercountsrollup',
+            index=models.Index(fields=['grain', 'date'], name='silvereye_p_grain_e9abeb_idx'),
+        ),
+    ]
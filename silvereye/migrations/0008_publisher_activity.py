@@ -0,0 +1,58 @@
+# Generated by Django 2.2.16 on 2020-09-17 14:02
+
+import os
+
+from django.db import migrations, models
+
+
+def update_publisher_activity(apps, schema_editor):
+    connection = schema_editor.connection
+    # The release view is created by django-pgviews after migrating, so a new
+    # database has no releases to count yet
+    if "bluetail_ocds_release_json_view" not in connection.introspection.table_names(include_views=True):
+        return
+    sql_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "metrics", "publisher_activity.sql")
+    with open(sql_path) as sql_file:
+        sql = sql_file.read()
+    with connection.cursor() as cursor:
+        cursor.execute(sql, {"publisher_ids": None})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('silvereye', '0007_publishercountsrollup'),
+        ('bluetail', '0008_ocds_json_encoder'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='publisher',
+            name='last_release_date',
+            field=models.DateField(blank=True, help_text='Date of the most recent release', null=True),
+        ),
+        migrations.AddField(
+            model_name='publisher',
+            name='last_submission_at',
+            field=models.DateTimeField(blank=True, help_text='When the latest submission with OCDS data was made', null=True),
+        ),
+        migrations.AddField(
+            model_name='publisher',
+            name='release_count',
+            field=models.IntegerField(default=0, help_text='Number of releases published'),
+        ),
+        migrations.AddField(
+            model_name='publisher',
+            name='submission_count',
+            field=models.IntegerField(default=0, help_text='Number of submissions with OCDS data'),
+        ),
+        migrations.AddIndex(
+            model_name='publisher',
+            index=models.Index(fields=['last_submission_at'], name='silvereye_p_last_su_8b2a01_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='publisher',
+            index=models.Index(fields=['submission_count', 'publisher_name'], name='silvereye_p_submiss_3e0687_idx'),
+        ),
+        migrations.RunPython(update_publisher_activity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 2.2.16 on 2020-09-18 10:45
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+def link_publisher_authority_types(apps, schema_editor):
+    Publisher = apps.get_model('silvereye', 'Publisher')
+    AuthorityType = apps.get_model('silvereye', 'AuthorityType')
+    matching_authority_types = AuthorityType.objects \
+        .filter(authority_name=OuterRef('publisher_name')) \
+        .order_by('pk') \
+        .values('pk')[:1]
+    Publisher.objects.update(authority_type=Subquery(matching_authority_types))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('silvereye', '0008_publisher_activity'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='authoritytype',
+            name='authority_name',
+            field=models.CharField(db_index=True, max_length=1024),
+        ),
+        migrations.AddField(
+            model_name='publisher',
+            name='authority_type',
+            field=models.ForeignKey(blank=True, help_text='Set from the AuthorityType with the same name when left empty', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='publishers', to='silvereye.AuthorityType'),
+        ),
+        migrations.RunPython(link_publisher_authority_types, migrations.RunPython.noop),
+    ]
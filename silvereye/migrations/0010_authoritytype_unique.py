@@ -0,0 +1,35 @@
+# Generated by Django 2.2.16 on 2020-09-21 09:18
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_authority_types(apps, schema_editor):
+    AuthorityType = apps.get_model('silvereye', 'AuthorityType')
+    Publisher = apps.get_model('silvereye', 'Publisher')
+    duplicates = AuthorityType.objects \
+        .values('authority_name', 'authority_type', 'source') \
+        .annotate(keep_id=Min('id'), count=Count('id')) \
+        .filter(count__gt=1) \
+        .order_by()
+    for duplicate in duplicates:
+        keep_id = duplicate.pop('keep_id')
+        duplicate.pop('count')
+        others = AuthorityType.objects.filter(**duplicate).exclude(id=keep_id)
+        Publisher.objects.filter(authority_type__in=others).update(authority_type=keep_id)
+        others.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('silvereye', '0009_publisher_authority_type'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_authority_types, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='authoritytype',
+            constraint=models.UniqueConstraint(fields=('authority_name', 'authority_type', 'source'), name='unique_authority_type'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.16 on 2020-09-22 15:36
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('silvereye', '0010_authoritytype_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='S3UploadOutbox',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(help_text='Name of the file in DEFAULT_FILE_STORAGE', max_length=1024, unique=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('failed', models.BooleanField(db_index=True, default=False, help_text='Given up on after S3_UPLOAD_MAX_ATTEMPTS, until retried')),
+                ('last_error', models.TextField(blank=True, default='')),
+            ],
+        ),
+    ]
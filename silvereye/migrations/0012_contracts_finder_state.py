@@ -0,0 +1,26 @@
+# Generated by Django 2.2.16 on 2020-09-24 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('silvereye', '0011_s3uploadoutbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContractsFinderPeriod',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateField()),
+                ('end', models.DateField()),
+                ('source_hash', models.CharField(max_length=64)),
+                ('processed', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('start', 'end')},
+            },
+        ),
+    ]
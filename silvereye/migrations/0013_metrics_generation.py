@@ -0,0 +1,17 @@
+# Generated by Django 2.2.16 on 2020-09-28 09:30
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('silvereye', '0012_contracts_finder_state'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "CREATE SEQUENCE silvereye_metrics_generation",
+            "DROP SEQUENCE silvereye_metrics_generation",
+        ),
+    ]
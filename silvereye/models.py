@@ -1,7 +1,24 @@
-from cove.input.models import SuppliedData
+import tempfile
+
+import requests
+import rfc6266_parser
+from cove.input.models import CONTENT_TYPE_MAP, SuppliedData
+from django.core.files import File
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
+from django.utils import timezone
+
+# File extensions of downloaded content types, including compressed uploads
+DOWNLOAD_CONTENT_TYPE_MAP = dict(CONTENT_TYPE_MAP, **{
+    'application/gzip': 'gz',
+    'application/x-gzip': 'gz',
+    'application/x-bzip2': 'bz2',
+    'application/zip': 'zip',
+    'application/x-zip-compressed': 'zip',
+})
+# Bytes of a downloaded file read at a time
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
 
 
 class Publisher(models.Model):
@@ -29,15 +46,40 @@ class Publisher(models.Model):
     contact_name = models.CharField(max_length=1024, null=True, blank=True, default="")
     contact_email = models.CharField(max_length=1024, null=True, blank=True, default="")
     contact_telephone = models.CharField(max_length=1024, null=True, blank=True, default="")
+    authority_type = models.ForeignKey('AuthorityType',
+                                       on_delete=models.SET_NULL,
+                                       null=True,
+                                       blank=True,
+                                       related_name='publishers',
+                                       help_text='Set from the AuthorityType with the same name when left empty')
+    # Activity summary, maintained at ingest by silvereye.helpers.update_publisher_activity
+    last_submission_at = models.DateTimeField(null=True,
+                                              blank=True,
+                                              help_text='When the latest submission with OCDS data was made')
+    submission_count = models.IntegerField(default=0, help_text='Number of submissions with OCDS data')
+    release_count = models.IntegerField(default=0, help_text='Number of releases published')
+    last_release_date = models.DateField(null=True, blank=True, help_text='Date of the most recent release')
 
     class Meta:
         app_label = 'silvereye'
         db_table = 'silvereye_publisher_metadata'
         ordering = ["publisher_name"]
+        indexes = [
+            models.Index(fields=['last_submission_at']),
+            models.Index(fields=['submission_count', 'publisher_name']),
+        ]
 
     def __str__(self):
         return self.publisher_name
 
+    @receiver(pre_save, sender='silvereye.Publisher')
+    def link_authority_type(sender, instance, **kwargs):
+        if instance.authority_type_id is None and instance.publisher_name:
+            instance.authority_type = AuthorityType.objects \
+                .filter(authority_name=instance.publisher_name) \
+                .order_by('pk') \
+                .first()
+
 
 class PublisherMetrics(models.Model):
     publisher_id = models.CharField(max_length=1024, primary_key=True)
@@ -64,6 +106,84 @@ class PublisherMonthlyCounts(models.Model):
         unique_together = ('publisher', 'date',)
 
 
+class PublisherCountsRollup(models.Model):
+    """
+    Release counts per publisher at day, month and year grain
+
+    Day rows are counted from the releases, month and year rows are the sums
+    of the day rows they contain.
+    """
+    GRAIN_DAY = "day"
+    GRAIN_MONTH = "month"
+    GRAIN_YEAR = "year"
+    GRAIN_CHOICES = (
+        (GRAIN_DAY, "Day"),
+        (GRAIN_MONTH, "Month"),
+        (GRAIN_YEAR, "Year"),
+    )
+
+    publisher = models.ForeignKey(Publisher, on_delete=models.CASCADE)
+    grain = models.CharField(max_length=8, choices=GRAIN_CHOICES)
+    date = models.DateField(help_text="First day of the day, month or year")
+    count_tenders = models.IntegerField(default=0)
+    count_awards = models.IntegerField(default=0)
+    count_spend = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('publisher', 'grain', 'date',)
+        indexes = [
+            models.Index(fields=['grain', 'date']),
+        ]
+
+
+class PublisherMonthlyCountsQueue(models.Model):
+    """
+    PublisherMonthlyCounts buckets waiting to be recomputed
+    """
+    publisher = models.ForeignKey(Publisher, on_delete=models.CASCADE)
+    date = models.DateField()
+    queued_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('publisher', 'date',)
+
+
+class S3UploadOutbox(models.Model):
+    """
+    Local files waiting to be uploaded to S3 by the upload_to_s3 command
+    """
+    name = models.CharField(max_length=1024, unique=True, help_text='Name of the file in DEFAULT_FILE_STORAGE')
+    created = models.DateTimeField(auto_now_add=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now, db_index=True)
+    failed = models.BooleanField(default=False, db_index=True,
+                                 help_text='Given up on after S3_UPLOAD_MAX_ATTEMPTS, until retried')
+    last_error = models.TextField(blank=True, default="")
+
+    def __str__(self):
+        return self.name
+
+
+class ContractsFinderPeriod(models.Model):
+    """
+    Weekly periods of Contracts Finder data that get_cf_data has processed
+
+    source_hash covers the checksums of the source days the period was made
+    from and the options used, so a period is only processed again when
+    one of its days or the options change.
+    """
+    start = models.DateField()
+    end = models.DateField()
+    source_hash = models.CharField(max_length=64)
+    processed = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('start', 'end',)
+
+    def __str__(self):
+        return f"{self.start} - {self.end}"
+
+
 class FileSubmission(SuppliedData):
     supplied_data = models.OneToOneField(SuppliedData, on_delete=models.CASCADE, parent_link=True, primary_key=True, serialize=False)
     publisher = models.ForeignKey(Publisher, on_delete=models.CASCADE, null=True)
@@ -77,6 +197,37 @@ class FileSubmission(SuppliedData):
     def __str__(self):
         return f"{self.supplied_data.original_file}"
 
+    def download(self):
+        """
+        Download source_url like SuppliedData.download, streaming it to a
+        temporary file instead of holding the whole file in memory
+        """
+        if not self.source_url:
+            raise ValueError('No source_url specified.')
+        with requests.get(self.source_url, headers={'User-Agent': 'Cove (cove.opendataservice.coop)'},
+                          stream=True) as r:
+            r.raise_for_status()
+            content_type = r.headers.get('content-type', '').split(';')[0].lower()
+            file_extension = DOWNLOAD_CONTENT_TYPE_MAP.get(content_type)
+
+            if not file_extension:
+                possible_extension = rfc6266_parser.parse_requests_response(r).filename_unsafe.split('.')[-1]
+                if possible_extension in DOWNLOAD_CONTENT_TYPE_MAP.values():
+                    file_extension = possible_extension
+
+            file_name = r.url.split('/')[-1].split('?')[0][:100]
+            if file_name == '':
+                file_name = 'file'
+            if file_extension:
+                if not file_name.endswith(file_extension):
+                    file_name = file_name + '.' + file_extension
+
+            with tempfile.TemporaryFile() as temp_file:
+                for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    temp_file.write(chunk)
+                temp_file.seek(0)
+                self.original_file.save(file_name, File(temp_file))
+
 
 class FieldCoverage(models.Model):
     file_submission = models.OneToOneField(FileSubmission, on_delete=models.CASCADE, primary_key=True)
@@ -87,6 +238,11 @@ class FieldCoverage(models.Model):
 
 
 class AuthorityType(models.Model):
-    authority_name = models.CharField(max_length=1024)
+    authority_name = models.CharField(max_length=1024, db_index=True)
     authority_type = models.CharField(max_length=1024)
     source = models.CharField(max_length=1024)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['authority_name', 'authority_type', 'source'], name='unique_authority_type')
+        ]
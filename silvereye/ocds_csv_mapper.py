@@ -13,6 +13,18 @@ from django.conf import settings
 from silvereye.field_coverage import check_coverage
 
 
+def read_simple_csv(path_or_buffer):
+    """
+    Read a CSV the way CSVMapper reads its input, with missing values as None
+
+    :param path_or_buffer: Path of a CSV file, or a file object
+    :return: pandas dataframe
+    """
+    df = pd.read_csv(path_or_buffer, na_values=[""])
+    df = df.replace({np.nan: None})
+    return df
+
+
 class CSVMapper:
     """
     Class to handle mapping of CSV headers between simple CSV and flattened OCDS
@@ -25,15 +37,29 @@ class CSVMapper:
         "spend",
     ]
 
-    def __init__(self, csv_path=None, release_type=None, mappings_file=None):
+    def __init__(self, csv_path=None, release_type=None, mappings_file=None, input_df=None):
+        """
+        :param csv_path: Path of a simple CSV to read as the input
+        :param release_type: Notice type, detected from the input if not given
+        :param mappings_file: Path of the mappings CSV
+        :param input_df: Simple CSV already read with read_simple_csv, instead of csv_path
+        """
         if mappings_file:
             self.mappings_file = mappings_file
         self.mappings_df = self._read_csv_to_dataframe(self.mappings_file)
+        # OCDS uri -> simple CSV header, for the fields with a simple CSV header
+        self.csv_headers_by_uri = {
+            uri: csv_header
+            for uri, csv_header in zip(self.mappings_df["uri"], self.mappings_df["csv_header"])
+            if csv_header
+        }
         self.csv_path = csv_path
         self.release_type = release_type
         self.ocid_prefix = "ocds-testprefix-"
         if csv_path:
-            self.input_df = self._read_csv_to_dataframe(csv_path)
+            input_df = self._read_csv_to_dataframe(csv_path)
+        if input_df is not None:
+            self.input_df = input_df
             if not release_type:
                 self.detect_notice_type(self.input_df)
         else:
@@ -42,11 +68,16 @@ class CSVMapper:
             self.simple_mappings_df = self.mappings_df.loc[self.mappings_df[f'{self.release_type}_csv'] == True]
             self.simple_csv_df = self.mappings_df.loc[
                 (self.mappings_df[f'{self.release_type}_csv'] == True) & (pd.notnull(self.mappings_df['csv_header']))]
+            # (uri, default, reference) of the fields that augment_cols fills in
+            self.augment_mappings = [
+                (uri, default, reference)
+                for uri, default, reference
+                in self.simple_mappings_df[["uri", "default", "reference"]].itertuples(index=False, name=None)
+                if default or reference
+            ]
 
     def _read_csv_to_dataframe(self, mappings_csv_path):
-        df = pd.read_csv(mappings_csv_path, na_values=[""])
-        df = df.replace({np.nan: None})
-        return df
+        return read_simple_csv(mappings_csv_path)
 
     # def _map_and_crop_df(self, df, mappings_df, map_from_col="orig", map_to_col="target"):
     #     """
@@ -117,23 +148,18 @@ class CSVMapper:
         :param df: dataframe of a simple CSV with headers mapped to OCDS
         :return:
         """
-        for i, row in self.simple_mappings_df.iterrows():
-            ocds_header = row["uri"]
-            default_value = row["default"]
-            reference_header = row["reference"]
+        for ocds_header, default_value, reference_header in self.augment_mappings:
             # Set defaults from mapping sheet
             if default_value:
                 df[ocds_header] = default_value
-            # Set references
+            # Set references, keeping the existing value where the reference is empty
             if reference_header and reference_header in df.columns:
                 if not ocds_header in df.columns:
                     df.loc[:, ocds_header] = df[reference_header]
                 else:
-                    df.loc[:, ocds_header] = df.apply(
-                        lambda row: row[reference_header] if pd.notnull(row[reference_header]) else row[ocds_header],
-                        axis=1)
+                    df.loc[:, ocds_header] = df[reference_header].fillna(df[ocds_header])
 
-        df['ocid'] = df.apply(lambda row: f"{self.ocid_prefix}{str(row['id'])}", axis=1)
+        df['ocid'] = self.ocid_prefix + df['id'].astype(str)
 
         if self.release_type == "spend":
             df["tag"] = "implementation"
@@ -171,14 +197,22 @@ class CSVMapper:
         return df
 
     def convert_simple_csv_to_ocds_csv(self, csv_path):
-        df = pd.read_csv(csv_path)
+        new_df = self.convert_simple_df_to_ocds_df(pd.read_csv(csv_path))
+        new_df.to_csv(open(csv_path, "w"), index=False, header=True)
+        return new_df
+
+    def convert_simple_df_to_ocds_df(self, df):
+        """
+        Map a simple CSV read with pd.read_csv to flat OCDS release columns
+
+        :param df: pandas dataframe of a simple CSV file
+        :return: dataframe with OCDS URI headers
+        """
         new_df = self.rename_friendly_cols_to_ocds_uri(df)
         if not self.release_type:
             self.detect_notice_type(new_df)
         new_df = self.parse_dates(new_df)
-        new_df = self.augment_cols(new_df)
-        new_df.to_csv(open(csv_path, "w"), index=False, header=True)
-        return new_df
+        return self.augment_cols(new_df)
 
     def create_simple_CSV_templates(self, output_dir):
         """
@@ -0,0 +1,181 @@
+"""
+Local disk cache in front of the S3 storage for submission files
+"""
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from contextlib import closing
+
+from django.conf import settings
+from django.core.files.storage import get_storage_class
+
+logger = logging.getLogger(__name__)
+
+
+class TieredStorage():
+    """
+    Keep submission files on local disk (DEFAULT_FILE_STORAGE) with S3 (S3_FILE_STORAGE)
+    as the permanent copy
+
+    A sqlite index next to the local files records which names are known to be
+    in S3, their local size and when they were last used. Files that are local
+    and known to be in S3 are served without any S3 calls. Local copies are
+    evicted, least recently used first, when they are older than
+    S3_CACHE_MAX_AGE or the cache grows beyond S3_CACHE_MAX_SIZE.
+    Only files that are known to be in S3 are ever evicted.
+    """
+    # Bytes copied at a time when downloading
+    chunk_size = 1024 * 1024
+
+    def __init__(self, local_storage=None, remote_storage=None, index_path=None, max_size=None, max_age=None):
+        self.local_storage = local_storage or get_storage_class(settings.DEFAULT_FILE_STORAGE)()
+        self.remote_storage = remote_storage or get_storage_class(settings.S3_FILE_STORAGE)()
+        self.index_path = index_path or settings.S3_CACHE_INDEX_PATH
+        self.max_size = settings.S3_CACHE_MAX_SIZE if max_size is None else max_size
+        self.max_age = settings.S3_CACHE_MAX_AGE if max_age is None else max_age
+        self.create_index()
+
+    def connect(self):
+        connection = sqlite3.connect(self.index_path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def create_index(self):
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        with closing(self.connect()) as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS cached_file (
+                    name TEXT PRIMARY KEY,
+                    in_remote INTEGER NOT NULL DEFAULT 0,
+                    local_size INTEGER NOT NULL DEFAULT 0,
+                    last_access REAL NOT NULL
+                )
+            """)
+            connection.execute("CREATE INDEX IF NOT EXISTS cached_file_last_access ON cached_file (last_access)")
+
+    def record(self, name, in_remote=None, local_size=None):
+        """
+        Update the index entry for a name and mark it as just used
+        """
+        with closing(self.connect()) as connection:
+            connection.execute("INSERT OR IGNORE INTO cached_file (name, last_access) VALUES (?, ?)",
+                               [name, time.time()])
+            connection.execute(
+                """
+                UPDATE cached_file
+                SET last_access = ?,
+                    in_remote = COALESCE(?, in_remote),
+                    local_size = COALESCE(?, local_size)
+                WHERE name = ?
+                """,
+                [time.time(), in_remote, local_size, name]
+            )
+
+    def is_remote(self, name):
+        with closing(self.connect()) as connection:
+            row = connection.execute("SELECT in_remote FROM cached_file WHERE name = ?", [name]).fetchone()
+        return bool(row and row["in_remote"])
+
+    def remote_exists(self, name):
+        if self.is_remote(name):
+            return True
+        if self.remote_storage.exists(name):
+            self.record(name, in_remote=True)
+            return True
+        return False
+
+    def ensure_remote(self, name):
+        """
+        Upload a local file to S3 unless it is already known to be there
+
+        :return: True if the file was uploaded
+        """
+        local_size = self.local_storage.size(name)
+        if self.remote_exists(name):
+            self.record(name, local_size=local_size)
+            return False
+
+        logger.info("Storing to S3: %s", name)
+        with self.local_storage.open(name, "rb") as local_file:
+            # S3Boto3Storage uploads file objects in multipart chunks
+            saved_name = self.remote_storage.save(name, local_file)
+        if saved_name != name:
+            logger.warning("Stored %s to S3 as %s", name, saved_name)
+        self.record(name, in_remote=True, local_size=local_size)
+        self.evict(keep=name)
+        return True
+
+    def ensure_local(self, name):
+        """
+        Download a file from S3 unless there is already a local copy
+
+        :return: True if the file is available locally
+        """
+        if self.local_storage.exists(name):
+            self.record(name, local_size=self.local_storage.size(name))
+            return True
+        if not self.remote_exists(name):
+            return False
+
+        logger.info("Retrieving from S3: %s", name)
+        local_path = self.local_storage.path(name)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        partial_path = f"{local_path}.{os.getpid()}.part"
+        try:
+            with self.remote_storage.open(name, "rb") as remote_file, open(partial_path, "wb") as local_file:
+                shutil.copyfileobj(remote_file, local_file, self.chunk_size)
+            os.replace(partial_path, local_path)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        self.record(name, in_remote=True, local_size=os.path.getsize(local_path))
+        self.evict(keep=name)
+        return True
+
+    def evict(self, keep=None):
+        """
+        Delete local copies of files in S3 that are too old, then the least
+        recently used until the cache fits in max_size
+
+        :param keep: Name of a file that is about to be used, which is never evicted
+        """
+        with closing(self.connect()) as connection:
+            expired = connection.execute(
+                "SELECT name FROM cached_file WHERE in_remote = 1 AND local_size > 0 AND last_access < ?",
+                [time.time() - self.max_age]
+            ).fetchall()
+            for row in expired:
+                if row["name"] != keep:
+                    self.evict_local(connection, row["name"])
+
+            total_size = connection.execute("SELECT COALESCE(SUM(local_size), 0) FROM cached_file").fetchone()[0]
+            if total_size <= self.max_size:
+                return
+            candidates = connection.execute(
+                "SELECT name, local_size FROM cached_file WHERE in_remote = 1 AND local_size > 0 ORDER BY last_access"
+            ).fetchall()
+            for row in candidates:
+                if total_size <= self.max_size:
+                    break
+                if row["name"] == keep:
+                    continue
+                self.evict_local(connection, row["name"])
+                total_size -= row["local_size"]
+
+    def evict_local(self, connection, name):
+        logger.info("Evicting local copy of %s", name)
+        self.local_storage.delete(name)
+        connection.execute("UPDATE cached_file SET local_size = 0 WHERE name = ?", [name])
+
+
+_tiered_storage = None
+
+
+def get_tiered_storage():
+    global _tiered_storage
+    if _tiered_storage is None:
+        _tiered_storage = TieredStorage()
+    return _tiered_storage
@@ -1,7 +1,8 @@
-
+import json
 import pandas as pd
 import os
 
+from silvereye.helpers import prepare_simple_csv_validation_errors
 from silvereye.ocds_csv_mapper import CSVMapper
 
 TESTS_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -39,3 +40,32 @@ def test_check_awards_coverage():
         new = award_context[key]
         test = test_aw_context_dict[key]
         assert new == test
+
+
+def test_prepare_simple_csv_validation_errors():
+    mapper = CSVMapper(release_type="tender")
+    title_header = mapper.csv_headers_by_uri["tender/title"]
+    title_error = {
+        "header": "tender/title",
+        "message": "'tender/title' is not a string",
+        "message_safe": "<code>tender/title</code> is not a string",
+        "validator": "type",
+        "validator_value": "string",
+    }
+    validation_errors = [
+        [json.dumps(title_error), [{"header": "tender/title", "path": "releases/2/tender/title", "row_number": 3}]],
+    ]
+    required_fields_missing = {title_header: [5], "Notice ID": list(range(1, 100001))}
+
+    ocds_errors, simple_csv_errors = prepare_simple_csv_validation_errors(
+        validation_errors, mapper, required_fields_missing)
+
+    assert ocds_errors == []
+    assert [error["header"] for error, values in simple_csv_errors] == [title_header, "Notice ID"]
+    assert simple_csv_errors[0][0]["message"] == f"'{title_header}' is not a string"
+    assert simple_csv_errors[0][1][0]["row_number"] == 2
+
+    missing_rows = simple_csv_errors[1][1]
+    assert len(missing_rows) == 100000
+    assert missing_rows[0] == {"header": "Notice ID", "path": "releases/1", "row_number": 1, "sheet": "releases"}
+    assert [value["row_number"] for value in missing_rows[1:10]] == list(range(2, 11))
@@ -0,0 +1,80 @@
+import os
+from datetime import date
+
+import pandas as pd
+
+from silvereye.harvester import ContractsFinderHarvester
+from silvereye.management.commands.get_cf_data import get_date_boundaries, period_source_days, source_file_day
+
+CSV_CONTENT = "releases/0/ocid,releases/0/id\nocds-b5fd17-1,ocds-b5fd17-1-1\n"
+
+
+def test_harvester_caches_final_days(httpserver, tmp_path):
+    httpserver.serve_content(CSV_CONTENT, headers={"ETag": '"v1"'})
+    harvester = ContractsFinderHarvester(str(tmp_path), base_url=httpserver.url, workers=2, retries=0,
+                                         mutable_days=2, today=date(2020, 8, 10))
+
+    counts = harvester.harvest(date(2020, 8, 1), date(2020, 8, 3))
+    assert counts == {"downloaded": 3, "unchanged": 0, "cached": 0, "failed": 0}
+    with open(os.path.join(str(tmp_path), "20200802.csv")) as csv_file:
+        assert csv_file.read() == CSV_CONTENT
+    assert harvester.manifest["20200802.csv"]["etag"] == '"v1"'
+    assert sorted(request.path for request in httpserver.requests) == ["/2020/08/01", "/2020/08/02", "/2020/08/03"]
+
+    # Final days are served from the cache without a request
+    harvester = ContractsFinderHarvester(str(tmp_path), base_url=httpserver.url, workers=2, retries=0,
+                                         mutable_days=2, today=date(2020, 8, 10))
+    counts = harvester.harvest(date(2020, 8, 1), date(2020, 8, 3))
+    assert counts == {"downloaded": 0, "unchanged": 0, "cached": 3, "failed": 0}
+    assert len(httpserver.requests) == 3
+
+
+def test_harvester_conditional_requests(httpserver, tmp_path):
+    httpserver.serve_content(CSV_CONTENT, headers={"ETag": '"v1"'})
+    harvester = ContractsFinderHarvester(str(tmp_path), base_url=httpserver.url, workers=1, retries=0,
+                                         mutable_days=2, today=date(2020, 8, 10))
+    harvester.harvest(date(2020, 8, 10), date(2020, 8, 10))
+
+    httpserver.serve_content("", code=304)
+    counts = harvester.harvest(date(2020, 8, 10), date(2020, 8, 10))
+    assert counts == {"downloaded": 0, "unchanged": 1, "cached": 0, "failed": 0}
+    assert httpserver.requests[-1].headers["If-None-Match"] == '"v1"'
+    with open(os.path.join(str(tmp_path), "20200810.csv")) as csv_file:
+        assert csv_file.read() == CSV_CONTENT
+
+
+def test_harvester_keeps_cache_on_failure(httpserver, tmp_path):
+    httpserver.serve_content("Not found", code=404)
+    harvester = ContractsFinderHarvester(str(tmp_path), base_url=httpserver.url, workers=1, retries=0,
+                                         mutable_days=2, today=date(2020, 8, 10))
+    counts = harvester.harvest(date(2020, 8, 1), date(2020, 8, 1))
+    assert counts == {"downloaded": 0, "unchanged": 0, "cached": 0, "failed": 1}
+    assert not os.path.exists(os.path.join(str(tmp_path), "20200801.csv"))
+
+
+def test_period_source_days():
+    assert source_file_day("20200801.csv") == date(2020, 8, 1)
+    assert source_file_day("manifest.json") is None
+
+    start, end = next(iter(get_date_boundaries("2020-08-05", "2020-08-05", None)))
+    assert (start, end) == (pd.Timestamp("2020-08-03", tz="UTC"), pd.Timestamp("2020-08-10", tz="UTC"))
+    days = period_source_days(start, end)
+    assert days[0] == date(2020, 8, 2)
+    assert days[-1] == date(2020, 8, 11)
+
+
+def test_harvester_checksums(httpserver, tmp_path):
+    httpserver.serve_content(CSV_CONTENT, headers={"ETag": '"v1"'})
+    harvester = ContractsFinderHarvester(str(tmp_path), base_url=httpserver.url, workers=1, retries=0,
+                                         mutable_days=2, today=date(2020, 8, 10))
+    harvester.harvest(date(2020, 8, 1), date(2020, 8, 1))
+    downloaded = harvester.manifest["20200801.csv"]["sha256"]
+
+    # A file copied in by hand is hashed and added to the manifest
+    with open(os.path.join(str(tmp_path), "20200802.csv"), "w") as csv_file:
+        csv_file.write(CSV_CONTENT + "ocds-b5fd17-2,ocds-b5fd17-2-1\n")
+    checksums = harvester.checksums([date(2020, 8, 1), date(2020, 8, 2), date(2020, 8, 3)])
+    assert checksums[date(2020, 8, 1)] == downloaded
+    assert checksums[date(2020, 8, 2)] != downloaded
+    assert date(2020, 8, 3) not in checksums
+    assert harvester.read_manifest()["20200802.csv"]["sha256"] == checksums[date(2020, 8, 2)]
@@ -1,4 +1,5 @@
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, override_settings
 from django.urls import reverse
 
 import datetime
@@ -7,8 +8,11 @@ from datetime import date
 from django.db.models import Sum
 from django.db.models.functions import Coalesce
 
-from silvereye.models import Publisher, PublisherMonthlyCounts
-from silvereye.helpers import MetricHelpers
+from bluetail.helpers import UpsertDataHelpers
+from silvereye.models import Publisher, PublisherMonthlyCounts, FileSubmission, PublisherMonthlyCountsQueue, \
+    PublisherCountsRollup
+from silvereye.helpers import MetricHelpers, update_submission_monthly_counts, refresh_queued_publisher_monthly_counts, \
+    invalidate_metrics_cache, get_package_monthly_buckets
 
 
 class MetricHelpersTest(TestCase):
@@ -165,6 +169,26 @@ class MetricHelpersTest(TestCase):
                   'comparison_option': '2_year'}
         self.compare_bounds(params)
 
+    def test_setting_seven_day_period_preceding_comparison_bounds(self):
+        params = {'reference_date': '2020-08-28',
+                  'period_start': '2020-08-22',
+                  'period_end': '2020-08-29',
+                  'comparison_start': '2020-08-15',
+                  'comparison_end': '2020-08-22',
+                  'period_option': '7_day',
+                  'comparison_option': 'preceding'}
+        self.compare_bounds(params)
+
+    def test_setting_week_period_one_year_comparison_bounds(self):
+        params = {'reference_date': '2020-08-28',
+                  'period_start': '2020-08-24',
+                  'period_end': '2020-08-29',
+                  'comparison_start': '2019-08-24',
+                  'comparison_end': '2019-08-31',
+                  'period_option': 'week',
+                  'comparison_option': '1_year'}
+        self.compare_bounds(params)
+
     def compare_period_data(self, period_start, period_end, expected_data):
         queryset = PublisherMonthlyCounts.objects.all()
         period_start =  datetime.datetime.strptime(period_start, '%Y-%m-%d').date()
@@ -193,3 +217,169 @@ class MetricHelpersTest(TestCase):
                        'percentages': {'awards': 9, 'spend': 0, 'tenders': 0}}
         actual = self.metric_helpers.comparison_data(queryset, date(2020, 6, 1), date(2020, 7, 1), period_counts)
         self.assertEqual(actual, expected_data)
+
+    def test_metric_data_matches_single_period_queries(self):
+        cache.clear()
+        queryset = PublisherMonthlyCounts.objects.all()
+        reference_date = date(2020, 8, 28)
+        for period_option in self.metric_helpers.period_descriptions():
+            for comparison_option in self.metric_helpers.comparison_descriptions():
+                period_start, period_end = self.metric_helpers.period_bounds(reference_date, period_option)
+                expected_data = self.metric_helpers.period_data(queryset, period_start, period_end)
+                if period_option != 'all':
+                    comparison_start, comparison_end = self.metric_helpers.comparison_bounds(
+                        period_start, period_end, period_option, comparison_option)
+                    expected_data['comparison'] = self.metric_helpers.comparison_data(
+                        queryset, comparison_start, comparison_end, expected_data['counts'])
+                actual = self.metric_helpers.metric_data(queryset, reference_date, period_option, comparison_option)
+                self.assertEqual(actual, expected_data)
+
+    def test_metric_data_cache_invalidated(self):
+        cache.clear()
+        queryset = PublisherMonthlyCounts.objects.all()
+        reference_date = date(2020, 8, 28)
+        actual = self.metric_helpers.metric_data(queryset, reference_date, '1_month', 'preceding')
+        self.assertEqual(actual['counts']['tenders'], 10)
+
+        publisher = Publisher.objects.get(publisher_name='Borsetshire')
+        PublisherMonthlyCounts.objects.filter(publisher=publisher, date='2020-07-01').update(count_tenders=7)
+        actual = self.metric_helpers.metric_data(queryset, reference_date, '1_month', 'preceding')
+        self.assertEqual(actual['counts']['tenders'], 10)
+
+        invalidate_metrics_cache()
+        actual = self.metric_helpers.metric_data(queryset, reference_date, '1_month', 'preceding')
+        self.assertEqual(actual['counts']['tenders'], 12)
+
+
+class UpdateSubmissionMonthlyCountsTest(TestCase):
+    def create_submission(self, publisher, releases):
+        supplied_data = FileSubmission()
+        supplied_data.current_app = "silvereye"
+        supplied_data.publisher = publisher
+        supplied_data.save()
+        package = {
+            "publisher": {"name": publisher.publisher_name},
+            "releases": releases,
+        }
+        UpsertDataHelpers().upsert_ocds_package(package, supplied_data=supplied_data)
+        return supplied_data
+
+    def test_only_submission_buckets_are_updated(self):
+        publisher = Publisher.objects.create(publisher_name='Borsetshire')
+        other_publisher = Publisher.objects.create(publisher_name='Setborshire')
+        PublisherMonthlyCounts.objects.create(publisher=other_publisher, date='2020-07-01',
+                                              count_tenders=99, count_awards=99, count_spend=99)
+
+        supplied_data = self.create_submission(publisher, [
+            {"ocid": "ocds-123abc-1", "id": "1", "date": "2020-07-03T00:00:00Z", "tag": ["tender"]},
+            {"ocid": "ocds-123abc-2", "id": "2", "date": "2020-07-10T00:00:00Z", "tag": ["award"]},
+            {"ocid": "ocds-123abc-3", "id": "3", "date": "2020-06-10T00:00:00Z", "tag": ["tender"]},
+        ])
+
+        update_submission_monthly_counts(supplied_data)
+
+        july = PublisherMonthlyCounts.objects.get(publisher=publisher, date=date(2020, 7, 1))
+        self.assertEqual((july.count_tenders, july.count_awards, july.count_spend), (1, 1, 0))
+        june = PublisherMonthlyCounts.objects.get(publisher=publisher, date=date(2020, 6, 1))
+        self.assertEqual((june.count_tenders, june.count_awards, june.count_spend), (1, 0, 0))
+        # Buckets from other publishers are left alone
+        other = PublisherMonthlyCounts.objects.get(publisher=other_publisher)
+        self.assertEqual(other.count_tenders, 99)
+        self.assertFalse(PublisherMonthlyCountsQueue.objects.exists())
+
+    def test_queued_submissions_are_refreshed_together(self):
+        publisher = Publisher.objects.create(publisher_name='Borsetshire')
+        first = self.create_submission(publisher, [
+            {"ocid": "ocds-123abc-1", "id": "1", "date": "2020-07-03T00:00:00Z", "tag": ["tender"]},
+        ])
+        second = self.create_submission(publisher, [
+            {"ocid": "ocds-123abc-2", "id": "2", "date": "2020-07-10T00:00:00Z", "tag": ["award"]},
+        ])
+        update_submission_monthly_counts(first, refresh=False)
+        update_submission_monthly_counts(second, refresh=False)
+
+        self.assertEqual(PublisherMonthlyCountsQueue.objects.count(), 1)
+        self.assertFalse(PublisherMonthlyCounts.objects.exists())
+
+        refresh_queued_publisher_monthly_counts(force=True)
+
+        july = PublisherMonthlyCounts.objects.get(publisher=publisher, date=date(2020, 7, 1))
+        self.assertEqual((july.count_tenders, july.count_awards, july.count_spend), (1, 1, 0))
+        self.assertFalse(PublisherMonthlyCountsQueue.objects.exists())
+
+    def test_moved_release_leaves_its_old_bucket(self):
+        publisher = Publisher.objects.create(publisher_name='Borsetshire')
+        supplied_data = self.create_submission(publisher, [
+            {"ocid": "ocds-123abc-1", "id": "1", "date": "2020-07-03T00:00:00Z", "tag": ["tender"]},
+        ])
+        update_submission_monthly_counts(supplied_data)
+
+        # The release is uploaded again with a date in another month
+        package = {
+            "publisher": {"name": publisher.publisher_name},
+            "releases": [{"ocid": "ocds-123abc-1", "id": "1", "date": "2020-08-03T00:00:00Z", "tag": ["tender"]}],
+        }
+        previous_buckets = get_package_monthly_buckets(package)
+        self.assertEqual(previous_buckets, [(publisher.id, date(2020, 7, 1))])
+        UpsertDataHelpers().upsert_ocds_package(package, supplied_data=supplied_data)
+        update_submission_monthly_counts(supplied_data, previous_buckets=previous_buckets)
+
+        # The emptied month is removed rather than keeping the release's old count
+        self.assertFalse(PublisherMonthlyCounts.objects.filter(publisher=publisher, date=date(2020, 7, 1)).exists())
+        august = PublisherMonthlyCounts.objects.get(publisher=publisher, date=date(2020, 8, 1))
+        self.assertEqual(august.count_tenders, 1)
+
+    @override_settings(PUBLISHER_METRICS_MAX_STALENESS=3600)
+    def test_refresh_waits_for_max_staleness(self):
+        publisher = Publisher.objects.create(publisher_name='Borsetshire')
+        supplied_data = self.create_submission(publisher, [
+            {"ocid": "ocds-123abc-1", "id": "1", "date": "2020-07-03T00:00:00Z", "tag": ["tender"]},
+        ])
+
+        update_submission_monthly_counts(supplied_data)
+
+        self.assertFalse(PublisherMonthlyCounts.objects.exists())
+        self.assertEqual(PublisherMonthlyCountsQueue.objects.count(), 1)
+
+    def test_rollup_answers_day_windows(self):
+        cache.clear()
+        publisher = Publisher.objects.create(publisher_name='Borsetshire')
+        supplied_data = self.create_submission(publisher, [
+            {"ocid": "ocds-123abc-1", "id": "1", "date": "2020-08-03T00:00:00Z", "tag": ["tender"]},
+            {"ocid": "ocds-123abc-2", "id": "2", "date": "2020-08-24T00:00:00Z", "tag": ["award"]},
+            {"ocid": "ocds-123abc-3", "id": "3", "date": "2020-08-25T00:00:00Z", "tag": ["tender"]},
+            {"ocid": "ocds-123abc-4", "id": "4", "date": "2019-08-25T00:00:00Z", "tag": ["tender"]},
+        ])
+        update_submission_monthly_counts(supplied_data)
+
+        rollup = PublisherCountsRollup.objects.filter(publisher=publisher)
+        self.assertEqual(rollup.filter(grain=PublisherCountsRollup.GRAIN_DAY).count(), 4)
+        august = rollup.get(grain=PublisherCountsRollup.GRAIN_MONTH, date=date(2020, 8, 1))
+        self.assertEqual((august.count_tenders, august.count_awards, august.count_spend), (2, 1, 0))
+        year = rollup.get(grain=PublisherCountsRollup.GRAIN_YEAR, date=date(2019, 1, 1))
+        self.assertEqual(year.count_tenders, 1)
+
+        metric_helpers = MetricHelpers()
+        actual = metric_helpers.metric_data(rollup, date(2020, 8, 28), '7_day', '1_year')
+        self.assertEqual(actual['counts'], {'tenders': 1, 'awards': 1, 'spend': 0})
+        self.assertEqual(actual['comparison']['counts'], {'tenders': 1, 'awards': 0, 'spend': 0})
+        actual = metric_helpers.metric_data(rollup, date(2020, 8, 28), 'all', 'preceding')
+        self.assertEqual(actual['counts'], {'tenders': 3, 'awards': 1, 'spend': 0})
+
+    def test_publisher_activity_is_updated(self):
+        publisher = Publisher.objects.create(publisher_name='Borsetshire')
+        first = self.create_submission(publisher, [
+            {"ocid": "ocds-123abc-1", "id": "1", "date": "2020-07-03T00:00:00Z", "tag": ["tender"]},
+        ])
+        update_submission_monthly_counts(first)
+        second = self.create_submission(publisher, [
+            {"ocid": "ocds-123abc-2", "id": "2", "date": "2020-08-10T00:00:00Z", "tag": ["award"]},
+            {"ocid": "ocds-123abc-3", "id": "3", "date": "2020-08-01T00:00:00Z", "tag": ["tender"]},
+        ])
+        update_submission_monthly_counts(second)
+
+        publisher.refresh_from_db()
+        self.assertEqual(publisher.submission_count, 2)
+        self.assertEqual(publisher.release_count, 3)
+        self.assertEqual(publisher.last_release_date, date(2020, 8, 10))
+        self.assertEqual(publisher.last_submission_at, FileSubmission.objects.get(pk=second.pk).created)
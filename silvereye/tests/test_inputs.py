@@ -0,0 +1,107 @@
+import bz2
+import gzip
+import json
+import zipfile
+
+import pytest
+from libcove.lib.exceptions import UnrecognisedFileType
+
+from silvereye.lib.converters import read_csv_text
+from silvereye.lib.inputs import get_file_type, load_json_input, write_json_input
+
+CSV_CONTENT = "Notice ID,Tender Title\n1,Road repairs\n"
+
+
+def write_zip(path, members):
+    with zipfile.ZipFile(str(path), "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for name, content in members.items():
+            zip_file.writestr(name, content)
+    return str(path)
+
+
+def test_get_file_type_of_compressed_files(tmp_path):
+    json_gz_path = str(tmp_path / "package.json.gz")
+    with gzip.open(json_gz_path, "wt") as fp:
+        fp.write('{"releases": []}')
+    assert get_file_type(json_gz_path) == "json"
+
+    unnamed_gz_path = str(tmp_path / "package.gz")
+    with gzip.open(unnamed_gz_path, "wt") as fp:
+        fp.write('{"releases": []}')
+    assert get_file_type(unnamed_gz_path) == "json"
+
+    csv_bz2_path = str(tmp_path / "tenders.csv.bz2")
+    with bz2.open(csv_bz2_path, "wt") as fp:
+        fp.write(CSV_CONTENT)
+    assert get_file_type(csv_bz2_path) == "csv"
+
+    zip_path = write_zip(tmp_path / "tenders.zip", {"a.csv": CSV_CONTENT, "__MACOSX/._a.csv": "", "b/c.csv": ""})
+    assert get_file_type(zip_path) == "csv"
+
+    mixed_zip_path = write_zip(tmp_path / "mixed.zip", {"a.csv": CSV_CONTENT, "b.json": "{}"})
+    with pytest.raises(UnrecognisedFileType):
+        get_file_type(mixed_zip_path)
+
+
+def test_load_json_input_merges_zip_members(tmp_path):
+    zip_path = write_zip(tmp_path / "packages.zip", {
+        "b.json": json.dumps({"extensions": ["lots", "bids"], "releases": [{"ocid": "ocds-2", "value": 1.5}]}),
+        "a.json": json.dumps({"uri": "a", "extensions": ["lots"], "releases": [{"ocid": "ocds-1"}]}),
+    })
+
+    package = load_json_input(zip_path, workers=2)
+    assert package["uri"] == "a"
+    assert [release["ocid"] for release in package["releases"]] == ["ocds-1", "ocds-2"]
+    assert package["extensions"] == ["lots", "bids"]
+
+    json_path = str(tmp_path / "package.json")
+    write_json_input(zip_path, json_path)
+    with open(json_path) as fp:
+        assert json.load(fp)["releases"][1]["value"] == 1.5
+
+    with pytest.raises(ValueError):
+        load_json_input(write_zip(tmp_path / "broken.zip", {"a.json": "{"}))
+
+
+def test_read_csv_text_of_compressed_files(tmp_path):
+    csv_gz_path = str(tmp_path / "tenders.csv.gz")
+    with gzip.open(csv_gz_path, "wb") as fp:
+        fp.write(CSV_CONTENT.replace("\n", "\r\n").encode("cp1252"))
+    assert read_csv_text(csv_gz_path) == (CSV_CONTENT, "utf-8-sig")
+
+    # Read again from the start when the first encoding fails
+    csv_bz2_path = str(tmp_path / "tenders.csv.bz2")
+    with bz2.open(csv_bz2_path, "wb") as fp:
+        fp.write("Notice ID,Tender Title\n1,Caf\u00e9 repairs\n".encode("cp1252"))
+    assert read_csv_text(csv_bz2_path) == ("Notice ID,Tender Title\n1,Caf\u00e9 repairs\n", "cp1252")
+
+    zip_path = write_zip(tmp_path / "tenders.zip", {
+        "a.csv": CSV_CONTENT,
+        "b.csv": "Notice ID,Tender Title\n2,Bridge inspections",
+    })
+    text, encoding = read_csv_text(zip_path)
+    assert text == CSV_CONTENT + "2,Bridge inspections\n"
+
+    # Files with different columns are merged with the columns of all of them
+    zip_path = write_zip(tmp_path / "columns.zip", {
+        "a.csv": CSV_CONTENT,
+        "b.csv": "Notice ID,Buyer Name\n2,Highways England\n",
+    })
+    text, encoding = read_csv_text(zip_path)
+    assert text == "Notice ID,Tender Title,Buyer Name\n1,Road repairs,\n2,,Highways England\n"
+
+
+def test_load_json_input_of_json_lines(tmp_path):
+    json_lines_path = str(tmp_path / "releases.jsonl.gz")
+    with gzip.open(json_lines_path, "wt") as fp:
+        fp.write('{"ocid": "ocds-1", "id": "1", "value": 1.5}\n{"ocid": "ocds-1", "id": "2"}\n')
+    assert get_file_type(json_lines_path) == "json"
+
+    package = load_json_input(json_lines_path)
+    assert [release["id"] for release in package["releases"]] == ["1", "2"]
+    assert "publishedDate" in package
+
+    json_path = str(tmp_path / "package.json")
+    write_json_input(json_lines_path, json_path)
+    with open(json_path) as fp:
+        assert len(json.load(fp)["releases"]) == 2
@@ -0,0 +1,177 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from bluetail.models import OCDSReleaseJSON
+from silvereye.helpers import S3BackfillHelpers, process_s3_upload_outbox, queue_s3_upload, retry_failed_s3_uploads
+from silvereye.models import FileSubmission, S3UploadOutbox
+from silvereye.storage import TieredStorage
+
+
+class CountingStorage(FileSystemStorage):
+    """
+    FileSystemStorage standing in for S3, counting the calls made to it
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = 0
+
+    def exists(self, name):
+        self.calls += 1
+        return super().exists(name)
+
+    def _open(self, name, mode='rb'):
+        self.calls += 1
+        return super()._open(name, mode)
+
+    def _save(self, name, content):
+        self.calls += 1
+        return super()._save(name, content)
+
+
+class FailingStorage(CountingStorage):
+    def _save(self, name, content):
+        raise IOError("S3 unavailable")
+
+
+class TieredStorageMixin():
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.local_storage = FileSystemStorage(location=os.path.join(self.tmp_dir, "local"))
+        self.remote_storage = CountingStorage(location=os.path.join(self.tmp_dir, "remote"))
+        self.storage = TieredStorage(
+            local_storage=self.local_storage,
+            remote_storage=self.remote_storage,
+            index_path=os.path.join(self.tmp_dir, "local", "index.sqlite3"),
+            max_size=10,
+            max_age=3600,
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class TieredStorageTest(TieredStorageMixin, SimpleTestCase):
+    def test_upload_then_no_remote_calls(self):
+        self.local_storage.save("a/package.json", ContentFile(b"12345"))
+        self.assertTrue(self.storage.ensure_remote("a/package.json"))
+        self.assertTrue(self.remote_storage.exists("a/package.json"))
+
+        calls = self.remote_storage.calls
+        self.assertFalse(self.storage.ensure_remote("a/package.json"))
+        self.assertTrue(self.storage.ensure_local("a/package.json"))
+        self.assertEqual(self.remote_storage.calls, calls)
+
+    def test_download_and_evict_least_recently_used(self):
+        self.remote_storage.save("a/package.json", ContentFile(b"123456"))
+        self.remote_storage.save("b/package.json", ContentFile(b"123456"))
+
+        self.assertTrue(self.storage.ensure_local("a/package.json"))
+        with self.local_storage.open("a/package.json") as local_file:
+            self.assertEqual(local_file.read(), b"123456")
+
+        # The cache only has room for one file
+        self.assertTrue(self.storage.ensure_local("b/package.json"))
+        self.assertFalse(self.local_storage.exists("a/package.json"))
+        self.assertTrue(self.local_storage.exists("b/package.json"))
+
+        # Evicted files are fetched again without checking S3 first
+        calls = self.remote_storage.calls
+        self.assertTrue(self.storage.ensure_local("a/package.json"))
+        self.assertEqual(self.remote_storage.calls, calls + 1)
+
+    def test_missing_file(self):
+        self.assertFalse(self.storage.ensure_local("missing/package.json"))
+
+
+@override_settings(S3_UPLOAD_RETRY_DELAY=60, S3_UPLOAD_MAX_ATTEMPTS=2)
+class S3UploadOutboxTest(TieredStorageMixin, TestCase):
+    def test_upload_queued_file(self):
+        self.local_storage.save("a/package.json", ContentFile(b"12345"))
+        queue_s3_upload("a/package.json")
+        queue_s3_upload("a/package.json")
+        self.assertEqual(S3UploadOutbox.objects.count(), 1)
+
+        counts = process_s3_upload_outbox(tiered_storage=self.storage)
+        self.assertEqual(counts, {"uploaded": 1, "failed": 0})
+        self.assertTrue(self.remote_storage.exists("a/package.json"))
+        self.assertFalse(S3UploadOutbox.objects.exists())
+
+    def test_failed_upload_backs_off(self):
+        self.storage.remote_storage = FailingStorage(location=self.remote_storage.location)
+        self.local_storage.save("a/package.json", ContentFile(b"12345"))
+        queue_s3_upload("a/package.json")
+
+        counts = process_s3_upload_outbox(tiered_storage=self.storage)
+        self.assertEqual(counts, {"uploaded": 0, "failed": 1})
+        entry = S3UploadOutbox.objects.get()
+        self.assertEqual(entry.attempts, 1)
+        self.assertIn("S3 unavailable", entry.last_error)
+        self.assertGreater(entry.next_attempt_at, timezone.now())
+
+        # Not due again until the backoff has passed
+        counts = process_s3_upload_outbox(tiered_storage=self.storage)
+        self.assertEqual(counts, {"uploaded": 0, "failed": 0})
+
+    def test_failed_upload_is_given_up_and_retried(self):
+        self.storage.remote_storage = FailingStorage(location=self.remote_storage.location)
+        self.local_storage.save("a/package.json", ContentFile(b"12345"))
+        queue_s3_upload("a/package.json")
+
+        for attempt in range(2):
+            S3UploadOutbox.objects.update(next_attempt_at=timezone.now())
+            process_s3_upload_outbox(tiered_storage=self.storage)
+        entry = S3UploadOutbox.objects.get()
+        self.assertTrue(entry.failed)
+        self.assertEqual(entry.attempts, 2)
+
+        S3UploadOutbox.objects.update(next_attempt_at=timezone.now())
+        counts = process_s3_upload_outbox(tiered_storage=self.storage)
+        self.assertEqual(counts, {"uploaded": 0, "failed": 0})
+
+        self.assertEqual(retry_failed_s3_uploads(), 1)
+        self.storage.remote_storage = self.remote_storage
+        counts = process_s3_upload_outbox(tiered_storage=self.storage)
+        self.assertEqual(counts, {"uploaded": 1, "failed": 0})
+        self.assertFalse(S3UploadOutbox.objects.exists())
+
+    def test_file_from_another_host_is_left_queued(self):
+        queue_s3_upload("a/package.json")
+
+        counts = process_s3_upload_outbox(tiered_storage=self.storage)
+        self.assertEqual(counts, {"uploaded": 0, "failed": 0})
+        entry = S3UploadOutbox.objects.get()
+        self.assertEqual(entry.attempts, 0)
+        self.assertLessEqual(entry.next_attempt_at, timezone.now())
+
+
+class S3BackfillTest(TieredStorageMixin, TestCase):
+    def save_package(self, id, ocid):
+        package = {
+            "uri": "http://example.com/package.json",
+            "releases": [{"ocid": ocid, "id": f"{ocid}-1", "date": "2020-01-01T00:00:00Z", "tag": ["tender"]}],
+        }
+        self.remote_storage.save(f"{id}/20200101T120000Z.json", ContentFile(json.dumps(package).encode()))
+
+    def test_backfill_resumes_from_checkpoint(self):
+        self.storage.max_size = 1024 * 1024
+        self.save_package("4ce8e4a5-3c1b-4a3f-9e1a-3f6a9b2c0d01", "ocds-test-1")
+        self.save_package("4ce8e4a5-3c1b-4a3f-9e1a-3f6a9b2c0d02", "ocds-test-2")
+        checkpoint_path = os.path.join(self.tmp_dir, "checkpoint")
+
+        backfill = S3BackfillHelpers(workers=2, checkpoint_path=checkpoint_path, tiered_storage=self.storage)
+        self.assertEqual(backfill.run(), {"loaded": 2, "failed": 0})
+        self.assertEqual(FileSubmission.objects.count(), 2)
+        self.assertEqual(OCDSReleaseJSON.objects.filter(ocid__startswith="ocds-test-").count(), 2)
+        with open(checkpoint_path) as checkpoint_file:
+            self.assertEqual(len(checkpoint_file.readlines()), 2)
+
+        # Nothing is downloaded again
+        self.save_package("4ce8e4a5-3c1b-4a3f-9e1a-3f6a9b2c0d03", "ocds-test-3")
+        self.assertEqual(backfill.pending_ids(), ["4ce8e4a5-3c1b-4a3f-9e1a-3f6a9b2c0d03"])
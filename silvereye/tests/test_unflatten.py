@@ -1,16 +1,24 @@
 import json
 import os
 import shutil
+import warnings
+import zipfile
 from os.path import join
 
 import pytest
 import pandas as pd
 from flattentool import unflatten
+from libcoveocds.config import LibCoveOCDSConfig
 from six import StringIO
 
 import silvereye
+from silvereye.helpers import convert_simple_csv_in_memory
+from silvereye.lib.converters import SimpleCSVSubmission, build_releases, filter_conversion_warnings, \
+    get_flattened_file, get_schema_parser, unflatten_csv_text, write_simple_csv_conversion
+from silvereye.models import Publisher
 from silvereye.ocds_csv_mapper import CSVMapper
-from silvereye.management.commands.get_cf_data import fix_contracts_finder_flat_csv
+from silvereye.management.commands.get_cf_data import augment_awards_with_spend, fix_contracts_finder_flat_csv, \
+    get_date_boundaries, partition_source_files, read_partition
 
 SILVEREYE_DIR = silvereye.__path__[0]
 TESTS_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -42,6 +50,38 @@ def test_fix_contracts_finder_flat_CSV(contracts_finder_daily_csv_df):
     assert any(fixed_df["releases/0/awards/0/items/0/id"])
 
 
+def test_augment_awards_with_spend(contracts_finder_daily_csv_df):
+    fixed_df = fix_contracts_finder_flat_csv(contracts_finder_daily_csv_df)
+    award_df = fixed_df.head(3).copy()
+    award_df["releases/0/tag"] = "award"
+    award_df["releases/0/date"] = "2020-08-05T10:00:00Z"
+    award_df["releases/0/awards/0/date"] = "2020-08-04T10:00:00Z"
+    award_df["releases/0/awards/0/value/amount"] = 100
+    award_df["releases/0/awards/0/value/currency"] = "GBP"
+
+    spend_df = augment_awards_with_spend(award_df)
+    assert (spend_df["releases/0/tag"] == "implementation").all()
+    assert spend_df["releases/0/id"].str.endswith("_trans1").all()
+    assert (spend_df["releases/0/contracts/0/implementation/transactions/0/value/amount"] == 100).all()
+    assert (spend_df["releases/0/date"] >= "2020-08-15T10:00:00Z").all()
+    assert (spend_df["releases/0/date"] <= "2020-08-24T10:00:00Z").all()
+    assert "releases/0/contracts/0/items/0/id" in spend_df.columns
+    # The same awards always get the same spend
+    assert spend_df.equals(augment_awards_with_spend(award_df))
+
+
+def test_partition_source_files(tmp_path):
+    csv_path = join(CF_DIR, "export-2020-08-05.csv")
+    periods = list(get_date_boundaries("2020-08-01", "2020-08-10", None))
+    partitions = partition_source_files([csv_path], periods, None, True, str(tmp_path), chunk_size=10)
+
+    publisher_names = [publisher_name for period_start, publisher_name in partitions]
+    assert len(publisher_names) == len(set(publisher_names))
+    assert all(period_start == pd.Timestamp("2020-08-03", tz="UTC") for period_start, publisher_name in partitions)
+    rows = sum(len(read_partition(part_paths)) for part_paths in partitions.values())
+    assert rows == len(pd.read_csv(csv_path))
+
+
 def test_unflatten_cf_daily_csv_using_base_json():
     CF_DIR = join(TESTS_DIR, "fixtures", "CF_CSV")
     working_dir = join(CF_DIR, "working_files")
@@ -195,6 +235,18 @@ def test_default_referenced_award_mapping(simple_award_csv_submission_path):
     assert "awards/0/suppliers/0/id" in new_df.columns
 
 
+def test_augment_cols_keeps_defaults_for_empty_references(simple_award_csv_submission_path):
+    mapper = CSVMapper(simple_award_csv_submission_path)
+    df = pd.read_csv(simple_award_csv_submission_path)
+    df["Supplier ID"] = [None, "12345678"] + [None] * (len(df) - 2)
+    df.loc[1, "Notice ID"] = 12345
+    new_df = mapper.augment_cols(mapper.rename_friendly_cols_to_ocds_uri(df))
+
+    assert new_df.loc[0, "awards/0/suppliers/0/id"] == "supplier"
+    assert new_df.loc[1, "awards/0/suppliers/0/id"] == "12345678"
+    assert new_df.loc[1, "ocid"] == "ocds-testprefix-12345"
+
+
 @pytest.mark.parametrize(
     ("cf_header", "expected_mapping"),
     [
@@ -209,3 +261,121 @@ def test_contracts_finder_mappings(cf_header, expected_mapping):
     df = cf_mapper.mappings_df
     uri = df[df["contracts_finder_daily_csv_path"] == cf_header].iloc[0].get("uri")
     assert uri == expected_mapping
+
+
+def test_simple_csv_submission(simple_award_csv_submission_path, tmp_path):
+    submission = SimpleCSVSubmission(path=simple_award_csv_submission_path)
+    mapper = CSVMapper(csv_path=simple_award_csv_submission_path)
+    assert submission.encoding == "utf-8-sig"
+    assert submission.notice_type == mapper.release_type == "award"
+    assert submission.df.equals(mapper.input_df)
+
+    csv_path = str(tmp_path / "releases.csv")
+    shutil.copy(simple_award_csv_submission_path, csv_path)
+    CSVMapper(csv_path=csv_path).convert_simple_csv_to_ocds_csv(csv_path)
+    with open(csv_path) as csv_file:
+        assert submission.ocds_csv_text == csv_file.read()
+
+
+def test_convert_simple_csv_in_memory(simple_award_csv_submission_path, tmp_path):
+    publisher = Publisher(publisher_name="Telford & Wrekin Council", publisher_scheme="GB-LAE", publisher_id="TFW")
+    submission = SimpleCSVSubmission(path=simple_award_csv_submission_path)
+    conversion = convert_simple_csv_in_memory(submission, publisher, LibCoveOCDSConfig(), OCDS_SCHEMA)
+
+    # Same releases as unflattening the converted CSV file with flattentool
+    csv_dir = tmp_path / "csv_dir"
+    csv_dir.mkdir()
+    csv_path = str(csv_dir / "releases.csv")
+    shutil.copy(simple_award_csv_submission_path, csv_path)
+    CSVMapper(csv_path=csv_path).convert_simple_csv_to_ocds_csv(csv_path)
+    output_file = str(tmp_path / "unflattened.json")
+    unflatten(str(csv_dir), output_name=output_file, input_format="csv", root_id="ocid", schema=OCDS_SCHEMA,
+              convert_titles=True, default_configuration="RootListPath releases", disable_local_refs=True)
+    with open(output_file) as json_file:
+        expected = json.load(json_file)
+
+    assert conversion["package"]["releases"] == expected["releases"]
+    assert conversion["package"]["publisher"]["uid"] == "TFW"
+
+
+# Releases sharing an id merged across rows, an empty row and columns that
+# disagree about the shape of a field, which flattentool warns about
+MERGED_RELEASES_CSV = (
+    "ocid,id,tag,tender/title,tender/items/0/id,tender/items/0/quantity,tender,parties/0/id,parties/0/roles\n"
+    "ocds-b5fd17-1,1,tender,Road repairs,1,2,x,buyer,buyer\n"
+    ",,,,,,,,\n"
+    "ocds-b5fd17-1,1,tender,,2,3.5,,supplier,supplier;payee\n"
+    "ocds-b5fd17-2,2,award,Bridge inspections,,,,,\n"
+)
+
+# Releases of two ocids in interleaved rows, items out of column order, items
+# sharing an id, an item without an id, a release without an id and values that
+# aren't of their field's type, which build_releases builds itself
+NESTED_RELEASES_CSV = (
+    "ocid,id,date,tender/items/1/id,tender/items/1/quantity,tender/items/0/id,tender/items/0/quantity,"
+    "tender/items/2/description,tender/value/amount,tender/hasEnquiries,parties/0/id,parties/0/roles,"
+    "parties/1/id,parties/1/name\n"
+    "ocds-b5fd17-2,2,2020-08-01T00:00:00Z,b,1,a,lots,Gravel,1000.50,yes,buyer,buyer,buyer,Council\n"
+    "ocds-b5fd17-1,1,2020-08-02T00:00:00Z,a,2.5,,,,,false,,,,\n"
+    ",,,,,,,,,,,,,\n"
+    "ocds-b5fd17-2,3,2020-08-03T00:00:00Z,,,,,,200,,supplier,supplier;payee,,\n"
+    "ocds-b5fd17-2,,2020-08-04T00:00:00Z,,,,,,,,,,,\n"
+)
+
+
+def flat_releases_csv_fixture(name, request):
+    if name == "merged_releases":
+        return MERGED_RELEASES_CSV
+    if name == "nested_releases":
+        return NESTED_RELEASES_CSV
+    return SimpleCSVSubmission(path=request.getfixturevalue(name)).ocds_csv_text
+
+
+@pytest.mark.parametrize("fixture_name, built", [
+    ("simple_csv_submission_path", True),
+    ("simple_award_csv_submission_path", True),
+    ("nested_releases", True),
+    # Rows that flattentool merges and conflicting columns are left to flattentool
+    ("merged_releases", False),
+])
+def test_build_releases_matches_flattentool(fixture_name, built, request, tmp_path):
+    ocds_csv_text = flat_releases_csv_fixture(fixture_name, request)
+    config = LibCoveOCDSConfig()
+    parser = get_schema_parser(OCDS_SCHEMA, "ocid", config.config["flatten_tool"]["disable_local_refs"])
+    assert (build_releases(ocds_csv_text, parser, "ocid", "id") is not None) == built
+    package, warning_messages = unflatten_csv_text(ocds_csv_text, config, OCDS_SCHEMA, {})
+
+    csv_dir = tmp_path / "csv_dir"
+    csv_dir.mkdir()
+    (csv_dir / "releases.csv").write_text(ocds_csv_text)
+    with warnings.catch_warnings(record=True) as expected_warnings:
+        warnings.simplefilter("always")
+        unflatten(str(csv_dir), output_name=str(tmp_path / "unflattened.json"), input_format="csv", root_id="ocid",
+                  schema=OCDS_SCHEMA, convert_titles=True, default_configuration="RootListPath releases",
+                  disable_local_refs=True)
+    with open(str(tmp_path / "unflattened.json")) as json_file:
+        expected = json.load(json_file)
+
+    assert json.dumps(package["releases"]) == json.dumps(expected["releases"])
+    assert warning_messages == filter_conversion_warnings(expected_warnings)
+
+
+def test_get_flattened_file(simple_award_csv_submission_path, tmp_path):
+    config = LibCoveOCDSConfig()
+    json_path = str(tmp_path / "unflattened.json")
+    write_simple_csv_conversion(SimpleCSVSubmission(path=simple_award_csv_submission_path).ocds_csv_text, config,
+                                OCDS_SCHEMA, None, json_path, str(tmp_path / "cells.json"),
+                                str(tmp_path / "headings.json"))
+
+    xlsx_path = get_flattened_file(str(tmp_path), json_path, config, OCDS_SCHEMA, "1.1")
+    assert xlsx_path == str(tmp_path / "flattened-1.1.xlsx")
+    modified = os.path.getmtime(xlsx_path)
+    # Flattened once per schema version
+    assert get_flattened_file(str(tmp_path), json_path, config, OCDS_SCHEMA, "1.1") == xlsx_path
+    assert os.path.getmtime(xlsx_path) == modified
+
+    zip_path = get_flattened_file(str(tmp_path), json_path, config, OCDS_SCHEMA, "1.1", file_format="zip")
+    with zipfile.ZipFile(zip_path) as zip_file:
+        assert "releases.csv" in zip_file.namelist()
+    assert sorted(path.name for path in tmp_path.iterdir() if path.name.startswith(("flattened", ".flattened"))) == [
+        "flattened-1.1.xlsx", "flattened-1.1.zip"]
@@ -1,10 +1,11 @@
+from django.core.cache import cache
 from django.test import TestCase
 from django.urls import reverse
 
 from unittest import mock
 from datetime import date, datetime
 
-from silvereye.models import Publisher, PublisherMonthlyCounts
+from silvereye.models import Publisher, PublisherMonthlyCounts, PublisherCountsRollup, AuthorityType
 
 class HomeViewTest(TestCase):
     @classmethod
@@ -23,6 +24,15 @@ class HomeViewTest(TestCase):
                                                            count_tenders=count_tenders,
                                                            count_awards=count_awards,
                                                            count_spend=count_spend)
+            PublisherCountsRollup.objects.create(publisher=publisher,
+                                                 grain=PublisherCountsRollup.GRAIN_MONTH,
+                                                 date=date,
+                                                 count_tenders=count_tenders,
+                                                 count_awards=count_awards,
+                                                 count_spend=count_spend)
+
+    def setUp(self):
+        cache.clear()
 
     def test_home_url_exists_at_desired_location(self):
         response = self.client.get('/publisher-hub/')
@@ -43,3 +53,32 @@ class HomeViewTest(TestCase):
                              'comparison_option': 'preceding period'
                             }
         self.assertDictEqual(response.context['publisher_metrics'], expected_metrics)
+
+
+class PublisherListingViewTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        AuthorityType.objects.create(authority_name='Borsetshire', authority_type='County', source='test')
+        AuthorityType.objects.create(authority_name='Setborshire', authority_type='District', source='test')
+        for publisher_name in ['Borsetshire', 'Setborshire', 'Ambridge Parish']:
+            Publisher.objects.create(publisher_name=publisher_name, submission_count=1)
+        Publisher.objects.create(publisher_name='Silent Council', submission_count=0)
+
+    def test_publishers_are_linked_to_authority_types(self):
+        publisher = Publisher.objects.get(publisher_name='Borsetshire')
+        self.assertEqual(publisher.authority_type.authority_type, 'County')
+        self.assertIsNone(Publisher.objects.get(publisher_name='Ambridge Parish').authority_type)
+
+    def test_lists_publishers_with_facet_counts(self):
+        response = self.client.get(reverse('publisher-listing'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([p.publisher_name for p in response.context['publishers']],
+                         ['Ambridge Parish', 'Borsetshire', 'Setborshire'])
+        self.assertEqual(response.context['known_types'],
+                         [('County', 1, False), ('District', 1, False), ('Other', 1, False)])
+
+    def test_filters_by_authority_type(self):
+        response = self.client.get(reverse('publisher-listing'), {'authority_type': ['County', 'Other']})
+        self.assertEqual([p.publisher_name for p in response.context['publishers']],
+                         ['Ambridge Parish', 'Borsetshire'])
+        self.assertIn(('County', 1, True), response.context['known_types'])
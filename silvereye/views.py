@@ -4,7 +4,8 @@ import requests
 from django import forms
 from django.conf import settings
 from django.core.files.base import ContentFile
-from django.db.models import Count, Max, F, IntegerField
+from django.core.paginator import Paginator
+from django.db.models import Count, F, IntegerField, Q
 from django.db.models.functions import ExtractDay, Cast, TruncDate, Now
 from django.http import HttpResponse
 
@@ -14,9 +15,11 @@ from django.utils.translation import ugettext_lazy as _
 from bluetail.models import OCDSPackageData
 from silvereye.helpers import get_publisher_metrics_context, \
     get_coverage_metrics_context, get_metric_options
-from silvereye.models import Publisher, FileSubmission, PublisherMonthlyCounts, FieldCoverage, AuthorityType
+from silvereye.models import Publisher, FileSubmission, PublisherCountsRollup, FieldCoverage
 from silvereye.ocds_csv_mapper import CSVMapper
 
+PUBLISHER_LISTING_PAGE_SIZE = 50
+
 
 def home(request):
     # Get FileSubmission that have releated OCDS Json packages
@@ -26,7 +29,7 @@ def home(request):
 
     period_option, comparison_option = get_metric_options(request)
     # metrics from helper
-    publisher_metrics = PublisherMonthlyCounts.objects.all()
+    publisher_metrics = PublisherCountsRollup.objects.all()
     metrics = get_publisher_metrics_context(queryset=publisher_metrics, period_option=period_option, comparison_option=comparison_option)
 
     coverage_metrics = FieldCoverage.objects.all()
@@ -34,9 +37,9 @@ def home(request):
 
     publishers = Publisher.objects.all()
     late_publishers = publishers \
-        .annotate(last_submission=Max("filesubmission__created")) \
-        .annotate(age=Cast(ExtractDay(TruncDate(Now()) - TruncDate(F('last_submission'))), IntegerField())) \
-        .order_by('-age') \
+        .annotate(age=Cast(ExtractDay(TruncDate(Now()) - TruncDate(F('last_submission_at'))), IntegerField())) \
+        .filter(age__gt=7) \
+        .order_by('-age')
 
     context = {
         "packages": packages,
@@ -50,37 +53,40 @@ def home(request):
 
 
 def publisher_listing(request):
-    # packages = OCDSPackageData.objects.all()
-    # sorted_packages = packages.order_by("publisher_name", "-supplied_data__created")
-    # distinct = sorted_packages.distinct("publisher_name")
-
-    publishers = OCDSPackageData.objects.all() \
-        .values('publisher_name') \
-        .order_by('-supplied_data__created') \
-        .annotate(last_submission=Max("supplied_data__created")) \
-        .annotate(total=Count('publisher_name')) \
+    publishers = Publisher.objects \
+        .filter(submission_count__gt=0) \
+        .select_related('authority_type') \
         .order_by('publisher_name')
 
-    local_authority_name_to_type = {at.authority_name: at.authority_type for at in AuthorityType.objects.all()}
-    for publisher in publishers:
-        publisher['type'] = local_authority_name_to_type.get(publisher['publisher_name'], "Other")
+    # Facet counts for every authority type, publishers without one are "Other"
+    type_counts = publishers \
+        .values_list('authority_type__authority_type') \
+        .annotate(count=Count('id')) \
+        .order_by('authority_type__authority_type')
+    facet_counts = {}
+    for authority_type, count in type_counts:
+        facet_type = authority_type or "Other"
+        facet_counts[facet_type] = facet_counts.get(facet_type, 0) + count
 
     filter_authority_types = request.GET.getlist('authority_type')
     if filter_authority_types:
-        publishers = filter(lambda x: x['type'] in filter_authority_types, publishers)
+        type_filter = Q(authority_type__authority_type__in=filter_authority_types)
+        if "Other" in filter_authority_types:
+            type_filter |= Q(authority_type__isnull=True) | Q(authority_type__authority_type='')
+        publishers = publishers.filter(type_filter)
 
-    unique_authority_types = AuthorityType.objects \
-        .exclude(authority_type='') \
-        .distinct('authority_type') \
-        .order_by('authority_type') \
-        .values_list('authority_type', flat=True)
+    known_types = [(kt, count, kt in filter_authority_types) for kt, count in facet_counts.items() if kt != "Other"]
+    known_types.append(("Other", facet_counts.get("Other", 0), "Other" in filter_authority_types))
 
-    known_types = [(kt, kt in filter_authority_types) for kt in unique_authority_types]
-    known_types.extend([("Other", "Other" in filter_authority_types)])
+    paginator = Paginator(publishers, PUBLISHER_LISTING_PAGE_SIZE)
+    page = paginator.get_page(request.GET.get('page'))
+    filter_params = request.GET.copy()
+    filter_params.pop('page', None)
 
     context = {
-        'publishers': publishers,
-        # 'publisher_metrics': PublisherMetrics.objects.all(),
+        'publishers': page,
+        'page': page,
+        'filter_params': filter_params.urlencode(),
         "submission_date_yellow": datetime.today() - timedelta(days=14),
         "submission_date_red": datetime.today() - timedelta(days=30),
         "known_types": known_types,
@@ -101,7 +107,7 @@ def publisher(request, publisher_name):
     # publisher_metrics = PublisherMetrics.objects.filter(publisher_id=publisher_name).first()
 
     # metrics from helper
-    publisher_metrics = PublisherMonthlyCounts.objects.filter(publisher__publisher_name=publisher_name)
+    publisher_metrics = PublisherCountsRollup.objects.filter(publisher__publisher_name=publisher_name)
     period_option, comparison_option = get_metric_options(request)
     metrics = get_publisher_metrics_context(publisher_metrics, period_option=period_option, comparison_option=comparison_option)
 
@@ -125,7 +131,7 @@ class UploadForm(forms.ModelForm):
         model = FileSubmission
         fields = ["publisher_id", 'original_file']
         labels = {
-            'original_file': _('Upload a file (.json or .csv)')
+            'original_file': _('Upload a file (.json or .csv, which can be compressed as .gz, .bz2 or a .zip of files)')
         }
 
 
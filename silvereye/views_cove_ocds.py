@@ -8,19 +8,18 @@ import json
 import logging
 import os
 import re
-import warnings
 from collections import OrderedDict
 from decimal import Decimal
 
 from dateutil import parser
 from django.conf import settings
-from django.core.serializers.json import DjangoJSONEncoder
+from django.http import FileResponse, Http404
 from django.shortcuts import render
 from django.utils import translation
 from django.utils.html import format_html
 from django.utils.translation import ugettext_lazy as _
 from libcove.lib.common import get_spreadsheet_meta_data
-from libcove.lib.converters import convert_json, convert_spreadsheet
+from libcove.lib.converters import convert_spreadsheet
 from libcove.lib.exceptions import CoveInputDataError
 from libcoveocds.common_checks import common_checks_ocds
 from libcoveocds.config import LibCoveOCDSConfig
@@ -30,8 +29,11 @@ from strict_rfc3339 import validate_rfc3339
 from bluetail.helpers import UpsertDataHelpers
 from cove_ocds.lib.views import group_validation_errors
 from silvereye.helpers import S3_helpers, sync_with_s3, prepare_simple_csv_validation_errors, \
-    update_publisher_monthly_counts, convert_simple_csv_submission
+    update_submission_monthly_counts, convert_simple_csv_submission, invalidate_metrics_cache, \
+    get_package_monthly_buckets
 from silvereye.models import FileSubmission, FieldCoverage
+from silvereye.lib.converters import FLATTENED_FORMATS, SimpleCSVSubmission, get_flattened_file
+from silvereye.lib.inputs import get_file_type as _get_file_type, load_json_input
 from silvereye.ocds_csv_mapper import CSVMapper
 
 from cove_ocds.lib import exceptions
@@ -42,7 +44,6 @@ from cove_ocds.lib.ocds_show_extra import add_extra_fields
 
 # But we do need some dependencies
 from django.core.exceptions import ValidationError
-from libcove.lib.tools import get_file_type as _get_file_type
 
 logger = logging.getLogger(__name__)
 
@@ -128,12 +129,7 @@ def explore_data_context(request, pk, get_file_type=None):
     return (context, data, None)
 
 
-@cove_web_input_error
-def explore_ocds(request, pk):
-    context, db_data, error = explore_data_context(request, pk)
-    if error:
-        return error
-
+def get_lib_cove_ocds_config():
     lib_cove_ocds_config = LibCoveOCDSConfig()
     lib_cove_ocds_config.config["current_language"] = translation.get_language()
     lib_cove_ocds_config.config["schema_version_choices"] = settings.COVE_CONFIG[
@@ -142,116 +138,113 @@ def explore_ocds(request, pk):
     lib_cove_ocds_config.config["schema_codelists"] = settings.COVE_CONFIG[
         "schema_codelists"
     ]
+    return lib_cove_ocds_config
+
+
+@cove_web_input_error
+def explore_ocds(request, pk):
+    context, db_data, error = explore_data_context(request, pk)
+    if error:
+        return error
+
+    lib_cove_ocds_config = get_lib_cove_ocds_config()
 
     upload_dir = db_data.upload_dir()
     upload_url = db_data.upload_url()
     file_name = db_data.original_file.file.name
     file_type = context["file_type"]
 
+    # Simple CSVs are read and parsed once for conversion, coverage and the notice type
+    submission = SimpleCSVSubmission(path=file_name) if file_type == "csv" else None
+
     post_version_choice = request.POST.get("version", lib_cove_ocds_config.config["schema_version"])
     replace = False
     validation_errors_path = os.path.join(upload_dir, "validation_errors-3.json")
 
     if file_type == "json":
         # open the data first so we can inspect for record package
-        with open(file_name, encoding="utf-8") as fp:
-            try:
-                json_data = json.load(
-                    fp, parse_float=Decimal, object_pairs_hook=OrderedDict
-                )
-            except ValueError as err:
-                raise CoveInputDataError(
-                    context={
-                        "sub_title": _("Sorry, we can't process that data"),
-                        "link": "index",
-                        "link_text": _("Try Again"),
-                        "msg": _(
-                            format_html(
-                                "We think you tried to upload a JSON file, but it is not well formed JSON."
-                                '\n\n<span class="glyphicon glyphicon-exclamation-sign" aria-hidden="true">'
-                                "</span> <strong>Error message:</strong> {}",
-                                err,
-                            )
-                        ),
-                        "error": format(err),
-                    }
-                )
-
-            if not isinstance(json_data, dict):
-                raise CoveInputDataError(
-                    context={
-                        "sub_title": _("Sorry, we can't process that data"),
-                        "link": "index",
-                        "link_text": _("Try Again"),
-                        "msg": _(
-                            "OCDS JSON should have an object as the top level, the JSON you supplied does not."
-                        ),
-                    }
-                )
-
-            version_in_data = json_data.get("version", "")
-            db_data.data_schema_version = version_in_data
-            select_version = post_version_choice or db_data.schema_version
-            schema_ocds = SchemaOCDS(
-                select_version=select_version,
-                release_data=json_data,
-                lib_cove_ocds_config=lib_cove_ocds_config,
+        try:
+            json_data = load_json_input(file_name)
+        except ValueError as err:
+            raise CoveInputDataError(
+                context={
+                    "sub_title": _("Sorry, we can't process that data"),
+                    "link": "index",
+                    "link_text": _("Try Again"),
+                    "msg": _(
+                        format_html(
+                            "We think you tried to upload a JSON file, but it is not well formed JSON."
+                            '\n\n<span class="glyphicon glyphicon-exclamation-sign" aria-hidden="true">'
+                            "</span> <strong>Error message:</strong> {}",
+                            err,
+                        )
+                    ),
+                    "error": format(err),
+                }
             )
 
-            if schema_ocds.missing_package:
-                exceptions.raise_missing_package_error()
-            if schema_ocds.invalid_version_argument:
-                # This shouldn't happen unless the user sends random POST data.
-                exceptions.raise_invalid_version_argument(post_version_choice)
-            if schema_ocds.invalid_version_data:
-                if isinstance(version_in_data, str) and re.compile(
-                    "^\d+\.\d+\.\d+$"
-                ).match(version_in_data):
-                    exceptions.raise_invalid_version_data_with_patch(version_in_data)
-                else:
-                    if not isinstance(version_in_data, str):
-                        version_in_data = "{} (it must be a string)".format(
-                            str(version_in_data)
-                        )
-                    context["unrecognized_version_data"] = version_in_data
+        if not isinstance(json_data, dict):
+            raise CoveInputDataError(
+                context={
+                    "sub_title": _("Sorry, we can't process that data"),
+                    "link": "index",
+                    "link_text": _("Try Again"),
+                    "msg": _(
+                        "OCDS JSON should have an object as the top level, the JSON you supplied does not."
+                    ),
+                }
+            )
 
-            if schema_ocds.version != db_data.schema_version:
-                replace = True
-            if schema_ocds.extensions:
-                schema_ocds.create_extended_release_schema_file(upload_dir, upload_url)
-            schema_url = schema_ocds.extended_schema_file or schema_ocds.release_schema_url
+        version_in_data = json_data.get("version", "")
+        db_data.data_schema_version = version_in_data
+        select_version = post_version_choice or db_data.schema_version
+        schema_ocds = SchemaOCDS(
+            select_version=select_version,
+            release_data=json_data,
+            lib_cove_ocds_config=lib_cove_ocds_config,
+        )
 
-            if "records" in json_data:
-                context["conversion"] = None
+        if schema_ocds.missing_package:
+            exceptions.raise_missing_package_error()
+        if schema_ocds.invalid_version_argument:
+            # This shouldn't happen unless the user sends random POST data.
+            exceptions.raise_invalid_version_argument(post_version_choice)
+        if schema_ocds.invalid_version_data:
+            if isinstance(version_in_data, str) and re.compile(
+                "^\d+\.\d+\.\d+$"
+            ).match(version_in_data):
+                exceptions.raise_invalid_version_data_with_patch(version_in_data)
             else:
-                # Replace the spreadsheet conversion only if it exists already.
-                converted_path = os.path.join(upload_dir, "flattened")
-                replace_converted = replace and os.path.exists(converted_path + ".xlsx")
-
-                with warnings.catch_warnings():
-                    warnings.filterwarnings('ignore')  # flattentool uses UserWarning, so can't set a specific category
-
-                    convert_json_context = convert_json(
-                        upload_dir,
-                        upload_url,
-                        file_name,
-                        lib_cove_ocds_config,
-                        schema_url=schema_url,
-                        replace=replace_converted,
-                        request=request,
-                        flatten=request.POST.get("flatten"),
+                if not isinstance(version_in_data, str):
+                    version_in_data = "{} (it must be a string)".format(
+                        str(version_in_data)
                     )
+                context["unrecognized_version_data"] = version_in_data
 
-                context.update(convert_json_context)
+        if schema_ocds.version != db_data.schema_version:
+            replace = True
+        if schema_ocds.extensions:
+            schema_ocds.create_extended_release_schema_file(upload_dir, upload_url)
+        schema_url = schema_ocds.extended_schema_file or schema_ocds.release_schema_url
+
+        if "records" in json_data:
+            context["conversion"] = None
+        else:
+            # Spreadsheets are only flattened when they're downloaded, by explore_ocds_flattened
+            context["conversion"] = "flatten"
 
     else:
         # Use the lowest release pkg schema version accepting 'version' field
         metatab_schema_url = SchemaOCDS(
             select_version="1.1", lib_cove_ocds_config=lib_cove_ocds_config
         ).release_pkg_schema_url
-        metatab_data = get_spreadsheet_meta_data(
-            upload_dir, file_name, metatab_schema_url, file_type
-        )
+        if file_type == "csv" and not os.path.exists(os.path.join(upload_dir, "Meta.csv")):
+            # A simple CSV has no Meta sheet, so skip unflattening the upload directory for it
+            metatab_data = {}
+        else:
+            metatab_data = get_spreadsheet_meta_data(
+                upload_dir, file_name, metatab_schema_url, file_type
+            )
         if "version" not in metatab_data:
             metatab_data["version"] = "1.0"
         else:
@@ -304,14 +297,20 @@ def explore_ocds(request, pk):
                 lib_cove_ocds_config,
                 schema_url,
                 replace=replace,
+                submission=submission,
             )
 
         context.update(conversion_context)
 
-        with open(context["converted_path"], encoding="utf-8") as fp:
-            json_data = json.load(
-                fp, parse_float=Decimal, object_pairs_hook=OrderedDict
+        if submission and submission.converted_json:
+            json_data = json.loads(
+                submission.converted_json, parse_float=Decimal, object_pairs_hook=OrderedDict
             )
+        else:
+            with open(context["converted_path"], encoding="utf-8") as fp:
+                json_data = json.load(
+                    fp, parse_float=Decimal, object_pairs_hook=OrderedDict
+                )
 
     if replace:
         if os.path.exists(validation_errors_path):
@@ -404,7 +403,10 @@ def explore_ocds(request, pk):
 
     # Include field coverage report
     original_file_path = context["original_file"]["path"]
-    mapper = CSVMapper(csv_path=original_file_path)
+    if submission:
+        mapper = submission.mapper
+    else:
+        mapper = CSVMapper(csv_path=original_file_path)
     db_data.notice_type = mapper.release_type
     db_data.save()
     coverage_context = mapper.get_coverage_context()
@@ -430,13 +432,8 @@ def explore_ocds(request, pk):
         # If we don't have validation errors
         validation_errors_grouped = context["validation_errors_grouped"]
         if not validation_errors_grouped:
-            json_string = json.dumps(
-                json_data,
-                indent=2,
-                sort_keys=True,
-                cls=DjangoJSONEncoder
-            )
-            UpsertDataHelpers().upsert_ocds_data(json_string, supplied_data=db_data)
+            previous_buckets = get_package_monthly_buckets(json_data)
+            UpsertDataHelpers().upsert_ocds_package(json_data, supplied_data=db_data)
 
             average_field_completion = coverage_context.get("average_field_completion")
             inst, created = FieldCoverage.objects.update_or_create(
@@ -447,11 +444,59 @@ def explore_ocds(request, pk):
                     "spend_field_coverage": average_field_completion if mapper.release_type == "spend" else None,
                 }
             )
-            update_publisher_monthly_counts()
+            invalidate_metrics_cache()
+            update_submission_monthly_counts(db_data, previous_buckets=previous_buckets)
 
     return render(request, template, context)
 
 
+@cove_web_input_error
+def explore_ocds_flattened(request, pk, file_format):
+    """
+    Download a JSON submission flattened to xlsx or a zip of CSVs, flattening
+    it for the submission's schema version on the first download
+    """
+    context, db_data, error = explore_data_context(request, pk)
+    if error:
+        return error
+    if context["file_type"] != "json" or not db_data.schema_version or file_format not in FLATTENED_FORMATS:
+        raise Http404
+
+    lib_cove_ocds_config = get_lib_cove_ocds_config()
+    upload_dir = db_data.upload_dir()
+    # explore_ocds writes the extended schema for the submission's extensions
+    schema_url = os.path.join(upload_dir, "extended_release_schema.json")
+    if not os.path.exists(schema_url):
+        schema_url = SchemaOCDS(
+            select_version=db_data.schema_version,
+            lib_cove_ocds_config=lib_cove_ocds_config,
+        ).release_schema_url
+
+    try:
+        flattened_path = get_flattened_file(
+            upload_dir,
+            db_data.original_file.file.name,
+            lib_cove_ocds_config,
+            schema_url,
+            db_data.schema_version,
+            file_format=file_format,
+        )
+    except Exception as err:
+        logger.exception(err, extra={"request": request})
+        raise CoveInputDataError(
+            context={
+                "sub_title": _("Sorry, we can't convert that data"),
+                "link": "explore",
+                "link_args": pk,
+                "link_text": _("Go back"),
+                "msg": _("The data couldn't be converted to a spreadsheet."),
+                "error": format(err),
+            }
+        )
+
+    return FileResponse(open(flattened_path, "rb"), as_attachment=True, filename=f"flattened.{file_format}")
+
+
 # This should only be run when data is small.
 def ocds_show_data(json_data, ocds_show_deref_schema):
     new_json_data = copy.deepcopy(json_data)